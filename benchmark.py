@@ -0,0 +1,1309 @@
+"""Бенчмарки эмулятора командной строки
+
+Запуск:
+  python3 benchmark.py memory --nodes 1000000   # Память: словари vs узлы со __slots__
+  python3 benchmark.py paths --depth 100        # Разрешение глубоких путей с кешем и без
+  python3 benchmark.py cat --size-mb 500        # Пропускная способность cat на большом файле
+  python3 benchmark.py parse --lines 100000     # Скорость разбора строк команд
+  python3 benchmark.py batch --commands 100000  # Команд в секунду: стартовый скрипт vs --batch
+  python3 benchmark.py output --entries 100000  # Системные вызовы записи: print vs OutputSink
+  python3 benchmark.py pipe --size-mb 200       # Время и память конвейера cat | grep | head
+  python3 benchmark.py grep --files 20000       # grep -r: триграммный индекс vs полный перебор
+  python3 benchmark.py pgrep --size-mb 256      # grep -P: масштабирование по процессам
+  python3 benchmark.py find --entries 1000000   # find -name: индекс имён vs рекурсивный обход
+  python3 benchmark.py ls --entries 300000      # ls огромной директории: сортировка vs порядок имён
+  python3 benchmark.py serve --sessions 1,10,100 # Сервер сессий: сессий в секунду и задержки команд
+  python3 benchmark.py versions --readers 4  # Потоки: чтение версий VFS во время записи
+  python3 benchmark.py hostls --entries 100000   # ls реальной директории: listdir+isdir vs scandir
+  python3 benchmark.py hostcat --size-mb 1024    # cat файла реальной ОС: sendfile, mmap, read и системный cat
+  python3 benchmark.py mount --files 100000      # Старт и первый доступ: mount vs импорт в XML
+  python3 benchmark.py journal --ops 1000        # Восстановление после сбоя: журнал и уплотнение
+  python3 benchmark.py generate image.xml --files 100000   # Синтетический образ VFS
+  python3 benchmark.py suite --output results.json         # Набор замеров в JSON
+  python3 benchmark.py suite --baseline results.json       # Сравнение с сохранёнными результатами
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import fnmatch
+import gc
+import io
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from sys import intern
+
+from shell import (DirNode, FileNode, Histogram, OutputSink, Shell, VFS, RESOLVE_CACHE_SIZE,
+                   host_file_chunks, write_chunks, gc_paused, parse_command_line, regex_literals, tokenize_command)
+
+
+def synthetic_entries(nodes, fanout):
+    """Генерирует (номер родительской директории, имя, директория ли) для синтетического дерева
+
+    Директории нумеруются в порядке создания, корень имеет номер 0.
+    Каждая десятая запись - директория, в каждой директории до fanout записей.
+    """
+    for i in range(nodes):
+        yield i // fanout, f"entry{i % fanout}", i % 10 == 0
+
+
+def build_dict_tree(nodes, fanout):
+    """Строит дерево в прежнем формате {"type": ..., "children"/"content": ...}"""
+    root = {}
+    dirs = [root]
+    for parent, name, is_dir in synthetic_entries(nodes, fanout):
+        if is_dir:
+            children = {}
+            dirs[parent][name] = {"type": "directory", "children": children}
+            dirs.append(children)
+        else:
+            dirs[parent][name] = {"type": "file", "content": ""}
+    return root
+
+
+def build_node_tree(nodes, fanout):
+    """Строит дерево из узлов DirNode/FileNode, как это делает VFS"""
+    root = DirNode()
+    dirs = [root.children]
+    for parent, name, is_dir in synthetic_entries(nodes, fanout):
+        if is_dir:
+            node = DirNode()
+            dirs[parent][intern(name)] = node
+            dirs.append(node.children)
+        else:
+            dirs[parent][intern(name)] = FileNode(b"")
+    return root
+
+
+def measure(builder, nodes, fanout):
+    """Возвращает (память, занятая деревом, в байтах; время построения в секундах)"""
+    gc.collect()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    tree = builder(nodes, fanout)
+    elapsed = time.perf_counter() - start_time
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tree
+    return current, elapsed
+
+
+def bench_memory(args):
+    """Сравнивает расход памяти прежнего и компактного представления узлов"""
+    if args.fanout < 10:
+        raise SystemExit("fanout должен быть не меньше 10")
+
+    print(f"Синтетическое дерево: {args.nodes} узлов, до {args.fanout} записей в директории")
+    print("-" * 50)
+    results = []
+    for title, builder in (("dict-of-dicts", build_dict_tree), ("__slots__", build_node_tree)):
+        size, elapsed = measure(builder, args.nodes, args.fanout)
+        results.append(size)
+        print(f"{title:15} {size / 1024 / 1024:10.1f} МБ {size / args.nodes:8.1f} Б/узел {elapsed:8.2f} с")
+    print("-" * 50)
+    print(f"Экономия: {(1 - results[1] / results[0]) * 100:.1f}%")
+
+
+def build_deep_vfs(depth, cache_size):
+    """Создаёт VFS с цепочкой вложенных директорий и файлом на дне"""
+    vfs = VFS(cache_size=cache_size)
+    path = ""
+    for level in range(depth):
+        path += f"/level{level}"
+        vfs.create_directory(path)
+    vfs.create_file(path + "/file.txt", "content")
+    return vfs, path + "/file.txt"
+
+
+def bench_paths(args):
+    """Сравнивает разрешение глубоких путей с LRU кешем и без него"""
+    print(f"Глубина пути: {args.depth}, обращений: {args.lookups}")
+    print("-" * 50)
+    results = []
+    for title, cache_size in (("без кеша", 0), ("LRU кеш", RESOLVE_CACHE_SIZE)):
+        vfs, file_path = build_deep_vfs(args.depth, cache_size)
+        # Относительный путь с '..' и '.' тоже проходит через нормализацию
+        relative = "../" + file_path.rsplit("/", 2)[-2] + "/./file.txt"
+        parent = file_path.rsplit("/", 1)[0]
+        start_time = time.perf_counter()
+        for _ in range(args.lookups):
+            vfs.get_file_content(vfs.normalize_path(relative, parent))
+        elapsed = time.perf_counter() - start_time
+        results.append(elapsed)
+        print(f"{title:15} {elapsed:8.3f} с {elapsed / args.lookups * 1e6:10.2f} мкс/обращение")
+    print("-" * 50)
+    print(f"Ускорение: {results[0] / results[1]:.1f}x")
+
+
+def bench_cat(args):
+    """Сравнивает вывод большого файла строкой через print и блоками байтов в stdout.buffer"""
+    size = args.size_mb * 1024 * 1024
+    vfs = VFS()
+    vfs.create_file("/big.log", b"0123456789abcdef" * (size // 16))
+    print(f"Размер файла: {args.size_mb} МБ, вывод в {os.devnull}")
+    print("-" * 50)
+
+    results = []
+    with open(os.devnull, 'w', encoding='utf-8') as text_out, open(os.devnull, 'wb') as binary_out:
+        # Прежний cat: содержимое - строка, print кодирует её ещё раз
+        def print_string():
+            print(vfs.get_file_content("/big.log").decode('utf-8'), file=text_out)
+            text_out.flush()
+
+        def stream_bytes():
+            write_chunks(binary_out, vfs.get_file_content("/big.log"))
+            binary_out.flush()
+
+        for title, func in (("print(str)", print_string), ("write_chunks", stream_bytes)):
+            tracemalloc.start()
+            start_time = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start_time
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append(elapsed)
+            print(f"{title:15} {args.size_mb / elapsed:10.1f} МБ/с {peak / 1024 / 1024:10.1f} МБ доп. памяти")
+    print("-" * 50)
+    print(f"Ускорение: {results[0] / results[1]:.1f}x")
+
+
+def legacy_parse_command(command):
+    """Прежний посимвольный парсер команд (для сравнения)"""
+    if not command.strip():
+        return []
+
+    def expand_vars(text):
+        text = re.sub(r'\$\{([^}]+)\}', lambda m: os.getenv(m.group(1), f"${{{m.group(1)}}}"), text)
+        text = re.sub(r'\$([A-Za-z_][A-Za-z0-9_]*)', lambda m: os.getenv(m.group(1), f"${m.group(1)}"), text)
+        return text
+
+    parts = []
+    current_part = ""
+    in_quotes = False
+    quote_char = None
+    for char in command:
+        if char in ['"', "'"] and not in_quotes:
+            in_quotes = True
+            quote_char = char
+            current_part += char
+        elif char == quote_char and in_quotes:
+            in_quotes = False
+            quote_char = None
+            current_part += char
+        elif char == ' ' and not in_quotes:
+            if current_part.strip():
+                parts.append(expand_vars(current_part.strip()))
+            current_part = ""
+        else:
+            current_part += char
+    if current_part.strip():
+        parts.append(expand_vars(current_part.strip()))
+    return parts
+
+
+def script_lines(count, unique):
+    """Генерирует строки типичного стартового скрипта; unique - доля неповторяющихся строк"""
+    templates = [
+        'mkdir /data/dir{i}',
+        'touch /data/dir{i}/file.txt "/data/dir{i}/with space.txt"',
+        'echo "Processing $HOME item {i}" done',
+        "cp -r /data/dir{i} '/backup/dir {i}'",
+        'cat /etc/config{i}.txt ${{USER}}.log',
+        'ls /data',
+    ]
+    repeat = max(1, round(1 / unique)) if unique else count
+    return [templates[i % len(templates)].format(i=i // repeat) for i in range(count)]
+
+
+def bench_parse(args):
+    """Сравнивает прежний парсер и однопроходный токенизатор с кешем шаблонов"""
+    print(f"Строк: {args.lines}, доля уникальных: {args.unique}")
+    print("-" * 50)
+    lines = script_lines(args.lines, args.unique)
+
+    def run_new_uncached():
+        for line in lines:
+            tokenize_command.cache_clear()
+            parse_command_line(line)
+
+    def run_new_cached():
+        tokenize_command.cache_clear()
+        for line in lines:
+            parse_command_line(line)
+
+    def run_legacy():
+        for line in lines:
+            legacy_parse_command(line)
+
+    results = []
+    for title, func in (("прежний", run_legacy), ("без кеша", run_new_uncached),
+                        ("с кешем", run_new_cached)):
+        start_time = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start_time
+        results.append(elapsed)
+        print(f"{title:15} {args.lines / elapsed:12.0f} строк/с")
+    print("-" * 50)
+    print(f"Ускорение: {results[0] / results[1]:.1f}x без кеша, {results[0] / results[2]:.1f}x с кешем")
+
+
+def batch_script(path, commands):
+    """Записывает скрипт из типичных команд: создание, переходы, просмотр, вывод"""
+    templates = [
+        'mkdir /bench/d{i}',
+        'touch /bench/d{i}/file.txt',
+        'cd /bench/d{i}',
+        'ls',
+        'echo "item {i} $HOME"',
+        'cat /bench/file.txt',
+        'cd /',
+    ]
+    with open(path, 'w', encoding='utf-8') as f:
+        for n in range(commands):
+            f.write(templates[n % len(templates)].format(i=n // len(templates)) + "\n")
+
+
+def bench_batch(args):
+    """Сравнивает выполнение скрипта через --startup-script и пакетный режим --batch"""
+    print(f"Команд в скрипте: {args.commands}, вывод в {os.devnull}")
+    print("-" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        vfs_path = os.path.join(tmp, "bench.xml")
+        script_path = os.path.join(tmp, "script.txt")
+        vfs = VFS()
+        vfs.create_directory("/bench")
+        vfs.create_file("/bench/file.txt", "hello\n")
+        vfs.save_to_xml(vfs_path)
+        batch_script(script_path, args.commands)
+
+        def run_startup(shell):
+            shell.execute_startup_script()
+
+        def run_batch(shell):
+            with open(script_path, 'r', encoding='utf-8') as script:
+                shell.run_batch(script)
+
+        results = []
+        stdout = sys.stdout
+        for title, func in (("--startup-script", run_startup), ("--batch", run_batch)):
+            shell = Shell(vfs_path=vfs_path, startup_script=script_path, snapshot=False, quiet=True)
+            # Построчная буферизация, как у вывода на терминал
+            with open(os.devnull, 'w', buffering=1, encoding='utf-8') as devnull:
+                sys.stdout = devnull
+                try:
+                    start_time = time.perf_counter()
+                    func(shell)
+                    elapsed = time.perf_counter() - start_time
+                finally:
+                    sys.stdout = stdout
+            results.append(elapsed)
+            print(f"{title:18} {elapsed:8.3f} с {args.commands / elapsed:12.0f} команд/с")
+    print("-" * 50)
+    print(f"Ускорение: {results[0] / results[1]:.1f}x")
+
+
+class CountingWriter(io.RawIOBase):
+    """Двоичный поток-заглушка, считающий вызовы write (аналог системных вызовов)"""
+
+    def __init__(self):
+        self.writes = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.writes += 1
+        return len(data)
+
+
+def bench_output(args):
+    """Сравнивает вывод большого ls построчным print и через OutputSink"""
+    print(f"Файлов в директории: {args.entries}")
+    print("-" * 50)
+    with tempfile.TemporaryDirectory() as tmp:
+        vfs_path = os.path.join(tmp, "bench.xml")
+        vfs = VFS()
+        vfs.create_directory("/big")
+        for i in range(args.entries):
+            vfs.create_file(f"/big/file{i}.txt", "")
+        vfs.save_to_xml(vfs_path)
+
+        # Прежний ls: print на каждую строку в построчно буферизованный поток (терминал)
+        legacy_raw = CountingWriter()
+        text_out = io.TextIOWrapper(io.BufferedWriter(legacy_raw), encoding='utf-8',
+                                    line_buffering=True)
+        start_time = time.perf_counter()
+        for name, _ in vfs.list_directory("/big"):
+            print(name, file=text_out)
+        text_out.flush()
+        legacy_elapsed = time.perf_counter() - start_time
+
+        sink_raw = CountingWriter()
+        shell = Shell(vfs_path=vfs_path, snapshot=False, quiet=True,
+                      output=OutputSink(io.BufferedWriter(sink_raw)))
+        start_time = time.perf_counter()
+        shell.execute("ls /big")
+        shell.out.flush()
+        sink_elapsed = time.perf_counter() - start_time
+
+    for title, raw, elapsed in (("print", legacy_raw, legacy_elapsed),
+                                ("OutputSink", sink_raw, sink_elapsed)):
+        print(f"{title:15} {elapsed:8.3f} с {raw.writes:10} вызовов write")
+    print("-" * 50)
+    print(f"Ускорение: {legacy_elapsed / sink_elapsed:.1f}x")
+
+
+def bench_pipe(args):
+    """Измеряет время и пиковую память конвейеров на большом файле"""
+    lines = args.size_mb * 1024 * 1024 // 32
+    with tempfile.TemporaryDirectory() as tmp:
+        vfs_path = os.path.join(tmp, "bench.xml")
+        VFS().save_to_xml(vfs_path)
+        devnull = open(os.devnull, 'wb')
+        shell = Shell(vfs_path=vfs_path, snapshot=False, quiet=True, output=OutputSink(devnull))
+        # Строки по 32 байта, каждая тысячная - ERROR
+        body = (b"INFO request served in 12ms ok\n" * 999 + b"ERROR request failed: timeout\n")
+        shell.vfs.create_file("/big.log", body * (lines // 1000))
+    print(f"Размер файла: {args.size_mb} МБ, строк: {lines // 1000 * 1000}")
+    print("-" * 50)
+
+    for command in ("cat /big.log | head -n 5",
+                    "cat /big.log | grep ERROR | head -n 5",
+                    "cat /big.log | grep ERROR",
+                    "grep failed /big.log > /errors.log"):
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        shell.execute(command)
+        shell.out.flush()
+        elapsed = time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{command:40} {elapsed:8.3f} с {peak / 1024 / 1024:8.1f} МБ доп. памяти")
+    devnull.close()
+
+
+def build_text_vfs(files, size, fanout=100, seed=0):
+    """Создаёт VFS с текстовыми файлами из случайных слов, по fanout файлов в директории"""
+    rng = random.Random(seed)
+    words = [f"{rng.choice('bcdfghklmnprstvz')}{rng.choice('aeiou')}{rng.choice('bcdfghklmnprstvz')}"
+             f"{rng.choice('aeiou')}{i % 97}" for i in range(5000)]
+    vfs = VFS()
+    for i in range(files):
+        directory = f"/d{i // fanout}"
+        if i % fanout == 0:
+            vfs.create_directory(directory)
+        line_words = [rng.choice(words) for _ in range(size // 7)]
+        body = " ".join(line_words).encode('utf-8')
+        vfs.create_file(f"{directory}/file{i}.txt", body.replace(b" ", b"\n", body.count(b" ") // 8))
+    return vfs
+
+
+def bench_grep(args):
+    """Сравнивает grep -r по триграммному индексу с полным перебором тел файлов"""
+    vfs = build_text_vfs(args.files, args.size)
+    # Редкая строка в нескольких файлах
+    for i in range(0, args.files, max(1, args.files // 10)):
+        vfs.write_file(f"/d{i // 100}/file{i}.txt", b"\nfatal: disk quota exceeded\n", append=True)
+    total = sum(len(node.content) for _, node in vfs.walk_files("/"))
+    print(f"Файлов: {args.files}, объём: {total / 1024 / 1024:.1f} МБ")
+    print("-" * 50)
+
+    start_time = time.perf_counter()
+    index = vfs.trigram_index()
+    print(f"{'построение индекса':24} {time.perf_counter() - start_time:8.3f} с")
+
+    # Escape-последовательности \xHH, \ooo и обратные ссылки не должны попадать в литералы
+    for pattern in ("quota exceeded", r"fatal: \w+ quota", "zzzz", r"\x71uota exceeded",
+                    r"\161uota exceeded", r"\0161uota", r"(d)isk quota exc\x65eded", r"(q)\1?uota"):
+        regex = re.compile(pattern.encode('utf-8'), re.MULTILINE)
+
+        start_time = time.perf_counter()
+        brute = [path for path, node in vfs.walk_files("/") if regex.search(node.content)]
+        brute_elapsed = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        candidates = index.candidates([literal.encode('utf-8') for literal in regex_literals(pattern)])
+        indexed = [path for path, node in vfs.walk_files("/")
+                   if (candidates is None or node in candidates) and regex.search(node.content)]
+        indexed_elapsed = time.perf_counter() - start_time
+
+        assert brute == indexed, f"{pattern}: индекс нашёл {len(indexed)} файлов из {len(brute)}"
+        print(f"{pattern:24} перебор {brute_elapsed:8.3f} с, индекс {indexed_elapsed:8.3f} с "
+              f"(кандидатов: {len(candidates) if candidates is not None else 'все'}, "
+              f"ускорение {brute_elapsed / indexed_elapsed:.1f}x)")
+
+    # После cp -r дозаписи не должны оставлять в индексе прежние узлы файла
+    vfs.create_file("/d0/app.log", b"logline start\n" * 20000)
+    vfs.copy_tree("/d0", "/d0-copy")
+    tracemalloc.start()
+    for n in range(args.appends):
+        vfs.write_file("/d0/app.log", b"logline %d\n" % n, append=True)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes = len(index.candidates([b"logline"]))
+    print(f"{'дозаписи после cp -r':24} {args.appends} раз: узлов в индексе {nodes}, "
+          f"память {retained / 1024 / 1024:.1f} МБ")
+    assert nodes == 2, f"индекс хранит прежние узлы файла: {nodes}"
+
+
+def bench_pgrep(args):
+    """Измеряет масштабирование grep -r -P N по числу процессов"""
+    files = max(1, args.size_mb * 1024 // args.file_kb)
+    with tempfile.TemporaryDirectory() as tmp:
+        vfs_path = os.path.join(tmp, "bench.xml")
+        VFS().save_to_xml(vfs_path)
+        devnull = open(os.devnull, 'wb')
+        shell = Shell(vfs_path=vfs_path, snapshot=False, quiet=True, output=OutputSink(devnull))
+        lines = args.file_kb * 1024 // 48
+        for i in range(files):
+            if i % 100 == 0:
+                shell.vfs.create_directory(f"/logs{i // 100}")
+            # Тела различаются, чтобы хранилище не свело их к одному
+            body = b"".join(b"%08d INFO worker %04d request served in %03dms\n" % (i, n % 9973, n % 997)
+                            for n in range(lines))
+            shell.vfs.create_file(f"/logs{i // 100}/app{i}.log", body)
+    print(f"Файлов: {files}, объём: {args.size_mb} МБ, процессоров: {os.cpu_count()}")
+    print("-" * 50)
+
+    # Выражение без буквального начала: поиск упирается в процессор, а не в память
+    pattern = r"\w+ worker \d+7 .* in 9\d\dms"
+    # Триграммный индекс строится один раз при первом grep -r: не в замере
+    shell.vfs.trigram_index()
+    results = []
+    for workers in args.workers:
+        command = f"grep -r '{pattern}' /" if workers == 1 else f"grep -r -P {workers} '{pattern}' /"
+        elapsed = best_time(lambda: (shell.execute(command), shell.out.flush()), args.repeat)
+        results.append(elapsed)
+        print(f"процессов: {workers:3} {elapsed:8.3f} с {args.size_mb / elapsed:10.1f} МБ/с "
+              f"ускорение {results[0] / elapsed:.1f}x")
+    devnull.close()
+
+
+def build_named_vfs(entries, fanout):
+    """Создаёт VFS с entries узлами с различными именами (каждый десятый - директория)"""
+    vfs = VFS()
+    dirs = [vfs.root.children]
+    extensions = ("txt", "log", "py", "md")
+    with gc_paused():
+        for i, (parent, _, is_dir) in enumerate(synthetic_entries(entries, fanout)):
+            if is_dir:
+                node = DirNode()
+                dirs[parent][intern(f"dir{i}")] = node
+                dirs.append(node.children)
+            else:
+                dirs[parent][intern(f"file{i}.{extensions[i % 4]}")] = FileNode(b"")
+    return vfs
+
+
+def bench_find(args):
+    """Сравнивает find -name по индексу имён с рекурсивным обходом дерева"""
+    vfs = build_named_vfs(args.entries, args.fanout)
+    print(f"Узлов: {args.entries}, до {args.fanout} записей в директории")
+    print("-" * 50)
+
+    def walk(pattern):
+        results = []
+        stack = [("", vfs.root)]
+        while stack:
+            path, node = stack.pop()
+            for name, child in node.children.items():
+                child_path = path + "/" + name
+                if fnmatch.fnmatchcase(name, pattern):
+                    results.append(child_path)
+                if type(child) is DirNode:
+                    stack.append((child_path, child))
+        return sorted(results)
+
+    start_time = time.perf_counter()
+    vfs.name_index()
+    print(f"{'построение индекса':20} {time.perf_counter() - start_time:8.3f} с")
+    for pattern in ("dir7770", "file12345*", "*98.py", "*7?.md", "*"):
+        start_time = time.perf_counter()
+        expected = walk(pattern)
+        walk_elapsed = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        found = vfs.find("/", pattern)
+        index_elapsed = time.perf_counter() - start_time
+        assert found == expected
+        print(f"{pattern:20} обход {walk_elapsed * 1000:9.1f} мс, индекс {index_elapsed * 1000:9.1f} мс "
+              f"(найдено: {len(found)})")
+
+
+def legacy_list_directory(vfs, path):
+    """Прежний list_directory: словарь на каждую запись и полная сортировка при каждом вызове"""
+    items = []
+    for name, item in vfs.get_node(path).children.items():
+        items.append({"name": name, "type": "directory" if type(item) is DirNode else "file"})
+    return sorted(items, key=lambda x: (x["type"], x["name"]))
+
+
+def bench_ls(args):
+    """Сравнивает прежний ls огромной директории с поддерживаемым порядком имён и страницами"""
+    with tempfile.TemporaryDirectory() as tmp:
+        vfs_path = os.path.join(tmp, "bench.xml")
+        VFS().save_to_xml(vfs_path)
+        shell = Shell(vfs_path=vfs_path, snapshot=False, quiet=True,
+                      output=OutputSink(open(os.devnull, 'wb')))
+    vfs = shell.vfs
+    vfs.create_directory("/big")
+    rng = random.Random(0)
+    names = [f"file{rng.getrandbits(48):012x}.txt" for _ in range(args.entries)]
+    for name in names:
+        vfs.create_file("/big/" + name)
+    print(f"Записей в директории: {args.entries}")
+    print("-" * 50)
+
+    def timed(title, func, repeat=5):
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        shell.out.flush()
+        elapsed = (time.perf_counter() - start_time) / repeat
+        print(f"{title:32} {elapsed * 1000:10.2f} мс")
+
+    def legacy_ls():
+        for item in legacy_list_directory(vfs, "/big"):
+            shell.out.line(item["name"] + "/" if item["type"] == "directory" else item["name"])
+
+    timed("прежний ls", legacy_ls)
+    timed("ls (первый, строит порядок)", lambda: shell.execute("ls /big"), repeat=1)
+    timed("ls", lambda: shell.execute("ls /big"))
+    timed("ls --offset N/2 --limit 100", lambda: shell.execute(f"ls /big --offset {args.entries // 2} --limit 100"))
+    timed("touch + ls --limit 100", lambda: (vfs.create_file(f"/big/new{rng.getrandbits(32)}"),
+                                              shell.execute("ls /big --limit 100")))
+
+
+def legacy_host_ls(out, target_path):
+    """Прежний ls реальной директории: os.listdir и os.path.isdir на каждую запись"""
+    for item in sorted(os.listdir(target_path)):
+        if os.path.isdir(os.path.join(target_path, item)):
+            out.line(f"{item}/")
+        else:
+            out.line(item)
+
+
+def bench_hostls(args):
+    """Сравнивает прежний ls реальной директории с ls через os.scandir"""
+    with tempfile.TemporaryDirectory() as tmp:
+        big = os.path.join(tmp, "big")
+        os.mkdir(big)
+        for n in range(args.entries):
+            if n % 10 == 0:
+                os.mkdir(os.path.join(big, f"dir{n:07d}"))
+            else:
+                open(os.path.join(big, f"file{n:07d}.txt"), 'wb').close()
+        shell = Shell(quiet=True, output=OutputSink(open(os.devnull, 'wb')))
+        print(f"Записей в директории: {args.entries} (каждая десятая - директория)")
+        print("-" * 50)
+
+        def timed(title, func):
+            elapsed = best_time(lambda: (func(), shell.out.flush()), args.repeat)
+            print(f"{title:24} {elapsed * 1000:10.2f} мс")
+
+        timed("listdir + isdir", lambda: legacy_host_ls(shell.out, big))
+        timed("ls (scandir)", lambda: shell.execute(f"ls {big}"))
+        timed("ls -l", lambda: shell.execute(f"ls -l {big}"))
+        timed("ls -R", lambda: shell.execute(f"ls -R {tmp}"))
+        timed("ls --limit 100", lambda: shell.execute(f"ls {big} --limit 100"))
+        shell.out.stream.close()
+
+
+def bench_hostcat(args):
+    """Пропускная способность cat файла реальной ОС в файл и в канал
+
+    /dev/null не годится: запись туда не читает данные, и mmap выглядит бесплатным.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "big.log")
+        line = b"2024-01-01 12:00:00 INFO worker 42 processed request in 17ms\n"
+        block = line * (1024 * 1024 // len(line))
+        with open(path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(block)
+        size = os.path.getsize(path)
+        print(f"Размер файла: {size / 1024 / 1024:.0f} МБ")
+        print("-" * 50)
+
+        def read_loop(out):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    out.write(chunk)
+
+        def mmap_chunks(out):
+            for chunk in host_file_chunks(path):
+                out.write(chunk)
+
+        def shell_cat(out):
+            shell = Shell(quiet=True, output=OutputSink(out))
+            shell.execute(f"cat {path}")
+            shell.out.flush()
+
+        methods = [
+            ("системный cat", lambda out: subprocess.run(["cat", path], stdout=out, check=True)),
+            ("cat эмулятора", shell_cat),
+            ("блоки mmap", mmap_chunks),
+            ("read по 1 МБ", read_loop),
+        ]
+        copy_path = os.path.join(tmp, "copy.log")
+        for target in ("файл", "канал"):
+            print(f"Вывод: {target}")
+            for title, method in methods:
+                def run():
+                    if target == "файл":
+                        # Новый файл каждый раз: усечение прежней копии исказило бы замер
+                        if os.path.exists(copy_path):
+                            os.unlink(copy_path)
+                        with open(copy_path, 'wb') as out:
+                            method(out)
+                        return
+                    reader = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+                    method(reader.stdin)
+                    reader.stdin.close()
+                    reader.wait()
+                elapsed = best_time(run, args.repeat)
+                print(f"  {title:20} {elapsed * 1000:9.1f} мс {size / elapsed / 1024 ** 3:7.2f} ГБ/с")
+
+
+def bench_mount(args):
+    """Сравнивает старт с импортом дерева в XML и с монтированием того же дерева
+
+    Импорт разбирает все тела при старте; монтирование читает записи и
+    тела при первом обращении, поэтому замеряется и первое чтение.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = os.path.join(tmp, "image.xml")
+        paths = generate_image(xml_path, args.files, file_size=args.file_size, base64_ratio=0)
+        host = os.path.join(tmp, "host")
+        for path in paths:
+            target = host + path
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(path.encode('ascii').ljust(args.file_size, b"x"))
+        empty = os.path.join(tmp, "empty.xml")
+        with open(empty, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<vfs>\n</vfs>\n')
+        sample = paths[len(paths) // 2]
+        leaf = sample.rpartition("/")[0]
+        print(f"Файлов: {args.files} по {args.file_size} байт")
+        print("-" * 50)
+
+        def timed(title, func):
+            start = time.perf_counter()
+            result = func()
+            print(f"{title:34} {(time.perf_counter() - start) * 1000:10.2f} мс")
+            return result
+
+        vfs = timed("старт: импорт XML", lambda: VFS(xml_path, snapshot=False, verbose=False))
+        timed("ls листовой директории", lambda: list(vfs.list_directory(leaf)))
+        timed("cat файла", lambda: vfs.get_file_content(sample))
+        del vfs
+        gc.collect()
+
+        vfs = timed("старт: mount", lambda: VFS(empty, snapshot=False, verbose=False,
+                                                 mounts=[(host, "/mnt")]))
+        timed("первый ls листовой директории", lambda: list(vfs.list_directory("/mnt" + leaf)))
+        timed("повторный ls", lambda: list(vfs.list_directory("/mnt" + leaf)))
+        timed("первый cat файла", lambda: vfs.get_file_content("/mnt" + sample))
+        timed("повторный cat (кеш тел)", lambda: vfs.get_file_content("/mnt" + sample))
+        timed("du всего монтирования", lambda: vfs.usage("/mnt"))
+
+
+def leaf_directory(index, depth, fanout):
+    """Путь листовой директории с номером index синтетического образа
+
+    Номер записывается depth цифрами в системе счисления fanout; старшая
+    цифра не ограничена, если листьев больше fanout ** depth.
+    """
+    parts = []
+    for _ in range(depth - 1):
+        index, digit = divmod(index, fanout)
+        parts.append(f"d{digit}")
+    parts.append(f"d{index}")
+    return "/" + "/".join(reversed(parts))
+
+
+def generate_image(path, files, depth=3, fanout=10, file_size=1024, base64_ratio=0.1, seed=0):
+    """Записывает синтетический XML образ VFS и возвращает пути его файлов
+
+    Файлы лежат по fanout штук в листовых директориях глубины depth (каждая
+    промежуточная директория содержит до fanout поддиректорий). Доля
+    base64_ratio файлов - случайные двоичные данные в base64, остальные -
+    текст. Тела различаются, чтобы дедупликация не искажала замеры.
+    """
+    rng = random.Random(seed)
+    words = [f"word{n}" for n in range(1000)]
+    text = " ".join(rng.choice(words) for _ in range(file_size // 5 + 1)).encode('ascii')
+    binary = rng.randbytes(file_size)
+    paths = []
+    open_parts = []
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<vfs>\n')
+        for leaf in range(-(-files // fanout)):
+            parts = leaf_directory(leaf, depth, fanout).split("/")[1:]
+            common = 0
+            while common < len(open_parts) and open_parts[common] == parts[common]:
+                common += 1
+            for level in range(len(open_parts), common, -1):
+                f.write("  " * level + "</directory>\n")
+            for level in range(common, len(parts)):
+                f.write("  " * (level + 1) + f'<directory name="{parts[level]}">\n')
+            open_parts = parts
+
+            indent = "  " * (len(parts) + 1)
+            for number in range(leaf * fanout, min(files, (leaf + 1) * fanout)):
+                header = f"{number:010d}".encode('ascii')
+                name = f"f{number}.dat" if rng.random() < base64_ratio else f"f{number}.txt"
+                if name.endswith(".dat"):
+                    body = base64.b64encode(header + binary[len(header):]).decode('ascii')
+                    f.write(f'{indent}<file name="{name}" encoding="base64">{body}</file>\n')
+                else:
+                    f.write(f'{indent}<file name="{name}">{(header + text[len(header):file_size]).decode()}</file>\n')
+                paths.append("/" + "/".join(parts) + "/" + name)
+        for level in range(len(open_parts), 0, -1):
+            f.write("  " * level + "</directory>\n")
+        f.write('</vfs>\n')
+    return paths
+
+
+def best_time(func, repeat=3):
+    """Лучшее из repeat времён вызова func в секундах (меньше всего зависит от шума)"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def run_suite_scale(tmp, files, args):
+    """Замеры для одного масштаба образа: метрика -> секунды (меньше - лучше)"""
+    xml_path = os.path.join(tmp, f"image{files}.xml")
+    paths = generate_image(xml_path, files, args.depth, args.fanout, args.file_size,
+                           args.base64_ratio, args.seed)
+    rng = random.Random(args.seed)
+    sample = [rng.choice(paths) for _ in range(args.samples)]
+    leaves = sorted({path.rsplit("/", 1)[0] for path in sample})
+    repeat = args.repeat
+    results = {}
+
+    results["load_xml"] = best_time(lambda: VFS(xml_path, snapshot=False, verbose=False), repeat)
+    VFS(xml_path, verbose=False)  # записывает снимок
+    results["load_snapshot"] = best_time(lambda: VFS(xml_path, verbose=False), repeat)
+
+    devnull = open(os.devnull, 'wb')
+    shell = Shell(vfs_path=xml_path, quiet=True, output=OutputSink(devnull))
+    vfs = shell.vfs
+    results["lookup"] = best_time(lambda: [vfs.get_file_content(path) for path in sample],
+                                  repeat) / len(sample)
+    results["ls"] = best_time(lambda: [shell.execute(f"ls {leaf}") for leaf in leaves],
+                              repeat) / len(leaves)
+    results["cat"] = best_time(lambda: [shell.execute(f"cat {path}") for path in sample],
+                               repeat) / len(sample)
+
+    # Каждый прогон изменяющих замеров работает со своими путями
+    runs = iter(range(10 ** 9))
+    results["cp"] = best_time(lambda: [vfs.copy_file(path, f"{path}.copy{run}")
+                                       for run in [next(runs)] for path in sample], repeat) / len(sample)
+    top = leaf_directory(0, args.depth, args.fanout).split("/")[1]
+    results["cp_r"] = best_time(lambda: vfs.copy_tree(f"/{top}", f"/{top}_copy{next(runs)}"), repeat)
+
+    def script(run):
+        lines = []
+        for n, path in enumerate(sample):
+            lines += [f"mkdir /bench{run}_{n}", f"touch /bench{run}_{n}/new.txt",
+                      f"cd {path.rsplit('/', 1)[0]}", "ls", f'echo "line {n} $HOME"',
+                      f"cat {path}", "cd /"]
+        return lines
+
+    lines = script("parse")
+    results["script"] = best_time(lambda: shell.run_batch(script(next(runs))), repeat) / len(lines)
+    results["parse"] = best_time(lambda: [parse_command_line(line) for line in lines], repeat) / len(lines)
+    devnull.close()
+    return results
+
+
+def compare_results(results, baseline, threshold):
+    """Печатает отношение результатов к базовым и возвращает число регрессий"""
+    regressions = 0
+    print(f"{'масштаб':>10} {'метрика':15} {'база':>12} {'сейчас':>12} {'отношение':>10}")
+    for scale, metrics in results["results"].items():
+        for metric, value in metrics.items():
+            base = baseline.get("results", {}).get(scale, {}).get(metric)
+            if not base:
+                continue
+            ratio = value / base
+            mark = ""
+            if ratio > threshold:
+                mark = "  регрессия"
+                regressions += 1
+            print(f"{scale:>10} {metric:15} {base:12.6f} {value:12.6f} {ratio:10.2f}{mark}")
+    return regressions
+
+
+def bench_generate(args):
+    """Записывает синтетический образ VFS"""
+    paths = generate_image(args.path, args.files, args.depth, args.fanout, args.file_size,
+                           args.base64_ratio, args.seed)
+    print(f"{args.path}: файлов {len(paths)}, размер {os.path.getsize(args.path) / 1024 / 1024:.1f} МБ")
+
+
+def bench_suite(args):
+    """Набор замеров на синтетических образах нескольких масштабов с выводом в JSON"""
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": {key: getattr(args, key) for key in
+                       ("scales", "depth", "fanout", "file_size", "base64_ratio", "samples", "repeat",
+                        "seed")},
+        },
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for files in args.scales:
+            print(f"Масштаб: {files} файлов...", file=sys.stderr)
+            results["results"][str(files)] = run_suite_scale(tmp, files, args)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    elif not args.baseline:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        print("-" * 50)
+        print(f"Регрессий (медленнее базы более чем в {args.threshold}x): {regressions}")
+        if regressions:
+            raise SystemExit(1)
+
+
+def add_image_arguments(parser):
+    """Параметры синтетического образа VFS"""
+    parser.add_argument('--depth', type=int, default=3, help='Глубина листовых директорий')
+    parser.add_argument('--fanout', type=int, default=10,
+                        help='Поддиректорий в директории и файлов в листовой директории')
+    parser.add_argument('--file-size', type=int, default=1024, help='Размер файла в байтах')
+    parser.add_argument('--base64-ratio', type=float, default=0.1, help='Доля двоичных файлов в base64')
+    parser.add_argument('--seed', type=int, default=0, help='Начальное значение генератора')
+
+
+async def serve_session(socket_path, commands, latency):
+    """Одна сессия клиента: подключение, команды, exit; задержки команд - в latency"""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+
+    async def response():
+        status, length, _ = (await reader.readline()).decode('utf-8').split(" ", 2)
+        await reader.readexactly(int(length))
+        return int(status)
+
+    await response()
+    for command in commands + ["exit"]:
+        start_time = time.perf_counter()
+        writer.write(command.encode('utf-8') + b"\n")
+        await response()
+        latency.add(time.perf_counter() - start_time)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def serve_load(socket_path, sessions, concurrency, commands):
+    """Открывает sessions сессий, не более concurrency одновременно"""
+    latency = Histogram()
+    limit = asyncio.Semaphore(concurrency)
+
+    async def limited(n):
+        async with limit:
+            await serve_session(socket_path, commands(n), latency)
+
+    await asyncio.gather(*(limited(n) for n in range(sessions)))
+    return latency
+
+
+def bench_serve(args):
+    """Нагрузочный тест сервера сессий: сессий в секунду и задержки команд"""
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = os.path.join(tmp, "image.xml")
+        socket_path = os.path.join(tmp, "shell.sock")
+        paths = generate_image(xml_path, args.files)
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                "shell.py"),
+                                   "--serve", socket_path, "--vfs-path", xml_path],
+                                  stdout=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(socket_path):
+                if server.poll() is not None:
+                    raise SystemExit("Сервер не запустился")
+                time.sleep(0.05)
+            rng = random.Random(0)
+
+            def commands(n):
+                path = rng.choice(paths)
+                return [f"cd {path.rsplit('/', 1)[0]}", "ls", "pwd", f"cat {path}",
+                        f"echo session {n}", "cd /", f"du -s {path.split('/')[1]}"][:args.commands]
+
+            print(f"Файлов в VFS: {args.files}, команд в сессии: {min(args.commands, 7)} + exit")
+            print(f"{'одновременно':>12} {'сессий/с':>10} {'p50 мкс':>10} {'p95 мкс':>10} {'p99 мкс':>10}")
+            for concurrency in args.sessions:
+                total = max(args.total, concurrency)
+                start_time = time.perf_counter()
+                latency = asyncio.run(serve_load(socket_path, total, concurrency, commands))
+                elapsed = time.perf_counter() - start_time
+                print(f"{concurrency:>12} {total / elapsed:10.0f} "
+                      + " ".join(f"{latency.percentile(q) * 1e6:10.0f}" for q in (50, 95, 99)))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def version_violations(view, src_names):
+    """Нарушения согласованности дерева /work, видимые читателю
+
+    Каждая копия cp -r должна быть полной, а итоги /work - равны сумме
+    итогов его записей (добавление узла и пересчёт итогов - одна операция).
+    """
+    violations = 0
+    entries = list(view.list_directory("/work", long=True))
+    size, count = view.usage("/work")
+    if (size != sum(entry[2] for entry in entries)
+            or count != sum(entry[3] + entry[1] for entry in entries)):
+        violations += 1
+    for name, is_dir, *_ in entries:
+        if is_dir and name.startswith("copy"):
+            if [entry[0] for entry in view.list_directory(f"/work/{name}")] != src_names:
+                violations += 1
+    return violations
+
+
+def stress_versions(vfs, readers, ops, versioned):
+    """Один писатель и readers читателей (версий или живого дерева); возвращает сводку прогона"""
+    stop = threading.Event()
+    latency = Histogram()
+    results = {"reads": 0, "violations": 0, "errors": 0, "stale": 0}
+    src_names = [name for name, _ in vfs.list_directory("/work/src")]
+    lock = threading.Lock()
+
+    def reader():
+        reads = violations = errors = stale = 0
+        last = -1
+        while not stop.is_set():
+            start_time = time.perf_counter()
+            try:
+                view = vfs.version() if versioned else vfs
+                if versioned:
+                    if view.version < last:
+                        stale += 1
+                    last = view.version
+                violations += version_violations(view, src_names)
+            except Exception:
+                # Живое дерево меняется во время обхода
+                errors += 1
+            latency.add(time.perf_counter() - start_time)
+            reads += 1
+        with lock:
+            for key, value in (("reads", reads), ("violations", violations), ("errors", errors),
+                               ("stale", stale)):
+                results[key] += value
+
+    threads = [threading.Thread(target=reader) for _ in range(readers)]
+    for thread in threads:
+        thread.start()
+    rng = random.Random(0)
+    start_time = time.perf_counter()
+    for n in range(ops):
+        vfs.copy_tree("/work/src", f"/work/copy{n}")
+        vfs.create_file(f"/work/f{n}.txt", b"x" * rng.randrange(1, 4096))
+        vfs.write_file(f"/work/src/file{n % len(src_names)}.txt", b"y" * rng.randrange(1, 4096))
+    results["seconds"] = time.perf_counter() - start_time
+    stop.set()
+    for thread in threads:
+        thread.join()
+    results["latency"] = latency
+    return results
+
+
+def bench_versions(args):
+    """Стресс-тест версий VFS: читатели в потоках во время записи"""
+    sys.setswitchinterval(args.switch_interval)
+    print(f"Читателей: {args.readers}, операций записи: {args.ops * 3}, "
+          f"переключение потоков: {args.switch_interval * 1e6:.0f} мкс")
+    print(f"{'чтение':14} {'записей/с':>10} {'чтений':>8} {'нарушений':>10} {'ошибок':>7} "
+          f"{'p50 мкс':>8} {'p99 мкс':>8}")
+    for title, versioned in (("живое дерево", False), ("версии", True)):
+        vfs = VFS(verbose=False)
+        vfs.create_directory("/work")
+        vfs.create_directory("/work/src")
+        for n in range(args.files):
+            vfs.create_file(f"/work/src/file{n}.txt", b"z" * 256)
+        results = stress_versions(vfs, args.readers, args.ops, versioned)
+        latency = results["latency"]
+        print(f"{title:14} {args.ops * 3 / results['seconds']:10.0f} {results['reads']:8} "
+              f"{results['violations'] + results['stale']:10} {results['errors']:7} "
+              f"{latency.percentile(50) * 1e6:8.0f} {latency.percentile(99) * 1e6:8.0f}")
+        if versioned and (results["violations"] or results["errors"] or results["stale"]):
+            raise SystemExit("Читатель версии увидел несогласованное дерево")
+
+
+def vfs_state(vfs):
+    """Содержимое дерева VFS: путь -> тело файла (None для директорий)"""
+    state = {}
+    stack = ["/"]
+    while stack:
+        path = stack.pop()
+        for name, is_dir in vfs.list_directory(path):
+            child = path.rstrip("/") + "/" + name
+            if is_dir:
+                state[child] = None
+                stack.append(child)
+            else:
+                state[child] = bytes(vfs.get_file_content(child))
+    return state
+
+
+def journal_workload(vfs, ops):
+    """Изменения всех видов, которые пишутся в журнал: mkdir, touch, >, >>, cp, cp -r"""
+    vfs.create_directory("/logs")
+    vfs.create_directory("/logs/old")
+    for n in range(ops):
+        vfs.create_file(f"/logs/f{n}.txt", f"line {n}\n")
+        vfs.write_file("/logs/app.log", f"event {n}\n", append=True)
+        if n % 10 == 0:
+            vfs.write_file(f"/logs/f{n}.txt", b"rewritten\n")
+    vfs.copy_file("/logs/f1.txt", "/logs/old/copy.txt")
+    vfs.copy_tree("/logs/old", "/backup")
+    vfs.write_file("/backup/copy.txt", b"changed after cp -r\n")
+
+
+def crash(vfs):
+    """Обрывает работу VFS как при сбое: журнал закрывается без уплотнения"""
+    vfs._journal.close()
+
+
+def reopen(xml_path):
+    """Загружает VFS с журналом заново; предупреждения о журнале возвращаются вторым значением"""
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        vfs = VFS(xml_path, persist=True, verbose=False)
+    return vfs, messages.getvalue()
+
+
+def bench_journal(args):
+    """Восстановление после сбоя: каждый сценарий сравнивает дерево после перезапуска с деревом до сбоя"""
+    print(f"Операций: {args.ops}")
+    print("-" * 50)
+    failures = []
+
+    def check(title, vfs, expected, note=""):
+        ok = vfs_state(vfs) == expected
+        if not ok:
+            failures.append(title)
+        print(f"{title:48} {'совпадает' if ok else 'НЕ СОВПАДАЕТ'}{note}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for scenario in ("restart", "torn", "xml", "xml+snapshot"):
+            xml_path = os.path.join(tmp, f"{scenario.replace('+', '_')}.xml")
+            VFS().save_to_xml(xml_path)
+            vfs, _ = reopen(xml_path)
+            journal_workload(vfs, args.ops)
+            expected = vfs_state(vfs)
+            journal_path = xml_path + ".journal"
+
+            if scenario == "restart":
+                crash(vfs)
+                size = os.path.getsize(journal_path)
+                start_time = time.perf_counter()
+                vfs, _ = reopen(xml_path)
+                elapsed = time.perf_counter() - start_time
+                check("перезапуск: журнал воспроизведён", vfs, expected,
+                      f" (журнал {size / 1024:.0f} КБ, загрузка {elapsed * 1000:.1f} мс)")
+            elif scenario == "torn":
+                # Последняя запись оборвана на середине, как при сбое во время write
+                size = os.path.getsize(journal_path)
+                vfs.create_file("/torn.txt", b"t" * 1000)
+                crash(vfs)
+                with open(journal_path, 'r+b') as f:
+                    f.truncate(size + 500)
+                vfs, messages = reopen(xml_path)
+                check("оборванная запись отброшена", vfs, expected)
+                if os.path.getsize(journal_path) != size or "оборван" not in messages:
+                    failures.append("torn")
+                    print(f"{'журнал не усечён до целых записей':48} НЕ СОВПАДАЕТ")
+                # Дозапись после усечения должна пережить следующий перезапуск
+                vfs.create_file("/after.txt", b"after restart\n")
+                expected = vfs_state(vfs)
+                crash(vfs)
+                vfs, _ = reopen(xml_path)
+                check("запись после усечения воспроизведена", vfs, expected)
+            else:
+                # Уплотнение прервано: XML (и снимок) подменены, журнал ещё не очищен
+                vfs.save_to_xml(xml_path)
+                if scenario == "xml+snapshot":
+                    vfs.save_snapshot(xml_path, 0.0)
+                crash(vfs)
+                vfs, _ = reopen(xml_path)
+                check(f"уплотнение прервано после {scenario}", vfs, expected)
+                crash(vfs)
+                vfs, _ = reopen(xml_path)
+                check(f"уплотнение прервано после {scenario}, повтор", vfs, expected)
+            crash(vfs)
+
+        # Обе стороны cp -r получают свои копии словаря: ссылки исходного
+        # словаря должны перейти к последней копии, а не остаться в хранилище
+        xml_path = os.path.join(tmp, "cow.xml")
+        VFS().save_to_xml(xml_path)
+        vfs, _ = reopen(xml_path)
+        old_body = b"o" * 200
+        vfs.create_directory("/a")
+        vfs.create_file("/a/f", old_body)
+        vfs.copy_tree("/a", "/b")
+        vfs.create_file("/b/n")
+        vfs.create_file("/a/n")
+        vfs.write_file("/a/f", b"a" * 200)
+        vfs.write_file("/b/f", b"b" * 200)
+        expected = vfs_state(vfs)
+        leaked = vfs.blobs.digest(old_body) in vfs.blobs._blobs
+        if leaked:
+            failures.append("cp -r")
+        print(f"{'cp -r: старое тело освобождено':48} {'НЕТ' if leaked else 'да'} "
+              f"(тел в хранилище: {vfs.stats()['unique_blobs']})")
+        crash(vfs)
+        vfs, _ = reopen(xml_path)
+        check("cp -r: журнал воспроизведён", vfs, expected)
+        crash(vfs)
+
+    if failures:
+        raise SystemExit(f"Восстановление после сбоя не совпало с деревом до сбоя: {', '.join(failures)}")
+
+
+def parse_arguments():
+    """Парсит аргументы командной строки"""
+    parser = argparse.ArgumentParser(description='Бенчмарки эмулятора командной строки')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    memory = subparsers.add_parser('memory', help='Память: словари vs узлы со __slots__')
+    memory.add_argument('--nodes', type=int, default=1000000, help='Количество узлов')
+    memory.add_argument('--fanout', type=int, default=20, help='Записей в директории')
+    memory.set_defaults(func=bench_memory)
+
+    paths = subparsers.add_parser('paths', help='Разрешение глубоких путей с кешем и без')
+    paths.add_argument('--depth', type=int, default=100, help='Глубина вложенности')
+    paths.add_argument('--lookups', type=int, default=100000, help='Количество обращений')
+    paths.set_defaults(func=bench_paths)
+
+    cat = subparsers.add_parser('cat', help='Пропускная способность cat на большом файле')
+    cat.add_argument('--size-mb', type=int, default=500, help='Размер файла в МБ')
+    cat.set_defaults(func=bench_cat)
+
+    parse = subparsers.add_parser('parse', help='Скорость разбора строк команд')
+    parse.add_argument('--lines', type=int, default=100000, help='Количество строк')
+    parse.add_argument('--unique', type=float, default=0.1, help='Доля неповторяющихся строк')
+    parse.set_defaults(func=bench_parse)
+
+    batch = subparsers.add_parser('batch', help='Команд в секунду: стартовый скрипт vs --batch')
+    batch.add_argument('--commands', type=int, default=100000, help='Количество команд в скрипте')
+    batch.set_defaults(func=bench_batch)
+
+    output = subparsers.add_parser('output', help='Системные вызовы записи: print vs OutputSink')
+    output.add_argument('--entries', type=int, default=100000, help='Количество файлов в директории')
+    output.set_defaults(func=bench_output)
+
+    pipe = subparsers.add_parser('pipe', help='Время и память конвейера cat | grep | head')
+    pipe.add_argument('--size-mb', type=int, default=200, help='Размер файла в МБ')
+    pipe.set_defaults(func=bench_pipe)
+
+    grep = subparsers.add_parser('grep', help='grep -r: триграммный индекс vs полный перебор')
+    grep.add_argument('--files', type=int, default=20000, help='Количество файлов')
+    grep.add_argument('--size', type=int, default=4096, help='Размер файла в байтах')
+    grep.add_argument('--appends', type=int, default=300, help='Дозаписей >> после cp -r')
+    grep.set_defaults(func=bench_grep)
+
+    pgrep = subparsers.add_parser('pgrep', help='grep -P: масштабирование по процессам')
+    pgrep.add_argument('--size-mb', type=int, default=256, help='Объём тел файлов в МБ')
+    pgrep.add_argument('--file-kb', type=int, default=1024, help='Размер файла в КБ')
+    pgrep.add_argument('--workers', type=lambda value: [int(n) for n in value.split(",")],
+                       default=[1, 2, 4, 8], help='Числа процессов через запятую')
+    pgrep.add_argument('--repeat', type=int, default=3, help='Повторов замера (берётся лучший)')
+    pgrep.set_defaults(func=bench_pgrep)
+
+    find = subparsers.add_parser('find', help='find -name: индекс имён vs рекурсивный обход')
+    find.add_argument('--entries', type=int, default=1000000, help='Количество узлов')
+    find.add_argument('--fanout', type=int, default=20, help='Записей в директории')
+    find.set_defaults(func=bench_find)
+
+    ls = subparsers.add_parser('ls', help='ls огромной директории: сортировка vs порядок имён')
+    ls.add_argument('--entries', type=int, default=300000, help='Количество файлов в директории')
+    ls.set_defaults(func=bench_ls)
+
+    serve = subparsers.add_parser('serve', help='Сервер сессий: сессий в секунду и задержки команд')
+    serve.add_argument('--sessions', type=lambda value: [int(n) for n in value.split(",")],
+                       default=[1, 10, 100], help='Уровни одновременности через запятую')
+    serve.add_argument('--total', type=int, default=500, help='Сессий на каждый уровень')
+    serve.add_argument('--commands', type=int, default=7, help='Команд в сессии (до 7)')
+    serve.add_argument('--files', type=int, default=10000, help='Файлов в образе VFS')
+    serve.set_defaults(func=bench_serve)
+
+    versions = subparsers.add_parser('versions', help='Потоки: чтение версий VFS во время записи')
+    versions.add_argument('--readers', type=int, default=4, help='Потоков-читателей')
+    versions.add_argument('--ops', type=int, default=2000, help='Циклов записи (cp -r, создание, перезапись)')
+    versions.add_argument('--files', type=int, default=20, help='Файлов в копируемой директории')
+    versions.add_argument('--switch-interval', type=float, default=1e-5,
+                          help='sys.setswitchinterval: чаще переключать потоки (секунды)')
+    versions.set_defaults(func=bench_versions)
+
+    hostls = subparsers.add_parser('hostls', help='ls реальной директории: listdir+isdir vs scandir')
+    hostls.add_argument('--entries', type=int, default=100000, help='Количество записей в директории')
+    hostls.add_argument('--repeat', type=int, default=5, help='Повторов замера (берётся лучший)')
+    hostls.set_defaults(func=bench_hostls)
+
+    hostcat = subparsers.add_parser('hostcat', help='cat файла реальной ОС: sendfile, mmap, read и системный cat')
+    hostcat.add_argument('--size-mb', type=int, default=1024, help='Размер файла в мегабайтах')
+    hostcat.add_argument('--repeat', type=int, default=3, help='Повторов замера (берётся лучший)')
+    hostcat.set_defaults(func=bench_hostcat)
+
+    mount = subparsers.add_parser('mount', help='Старт и первый доступ: mount vs импорт в XML')
+    mount.add_argument('--files', type=int, default=100000, help='Количество файлов')
+    mount.add_argument('--file-size', type=int, default=1024, help='Размер файла в байтах')
+    mount.set_defaults(func=bench_mount)
+
+    journal = subparsers.add_parser('journal', help='Восстановление после сбоя: журнал и уплотнение')
+    journal.add_argument('--ops', type=int, default=1000, help='Операций в журнале до сбоя')
+    journal.set_defaults(func=bench_journal)
+
+    generate = subparsers.add_parser('generate', help='Синтетический образ VFS')
+    generate.add_argument('path', help='Путь к XML файлу')
+    generate.add_argument('--files', type=int, default=100000, help='Количество файлов')
+    add_image_arguments(generate)
+    generate.set_defaults(func=bench_generate)
+
+    suite = subparsers.add_parser('suite', help='Набор замеров в JSON и сравнение с базой')
+    suite.add_argument('--scales', type=lambda value: [int(n) for n in value.split(",")],
+                       default=[1000, 10000, 100000], help='Количества файлов через запятую')
+    suite.add_argument('--samples', type=int, default=200, help='Путей в выборке для lookup, cat, cp')
+    suite.add_argument('--repeat', type=int, default=5, help='Повторов замера (берётся лучший)')
+    suite.add_argument('--output', help='Записать JSON в файл (по умолчанию - в stdout)')
+    suite.add_argument('--baseline', help='JSON с базовыми результатами для сравнения')
+    suite.add_argument('--threshold', type=float, default=1.2,
+                       help='Во сколько раз медленнее базы считается регрессией')
+    add_image_arguments(suite)
+    suite.set_defaults(func=bench_suite)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    args.func(args)
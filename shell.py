@@ -1,189 +1,2596 @@
 import os
 import sys
-import readline
+import errno
+import io
 import re
 import argparse
 import xml.etree.ElementTree as ET
+import xml.parsers.expat as expat
 import base64
+import math
+import time
+import struct
+import mmap
+import hashlib
+import gc
+import zlib
+import getpass
+import asyncio
+import socket
+import json
+import multiprocessing
+import threading
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase, translate
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
 from pathlib import Path
 from datetime import datetime
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import islice
+from stat import S_ISLNK, S_ISREG, filemode
+from sys import intern
+
+try:
+    import pwd
+except ImportError:  # Windows
+    pwd = None
+
+# Размер XML файла, начиная с которого при загрузке показывается прогресс
+PROGRESS_MIN_SIZE = 16 * 1024 * 1024
+# Как часто (в элементах) обновлять строку прогресса
+PROGRESS_EVERY = 10000
+# Размер буфера вывода команд (в байтах) в интерактивном режиме
+OUTPUT_BUFFER_SIZE = 64 * 1024
+# Размер буфера вывода в пакетном режиме (--batch / -c)
+BATCH_BUFFER_SIZE = 1024 * 1024
+# Максимальное число путей в кеше разрешения путей VFS
+RESOLVE_CACHE_SIZE = 4096
+# Сколько байт прочитанных тел файлов смонтированных директорий хранит кеш
+HOST_BODY_CACHE_SIZE = 64 * 1024 * 1024
+
+# Хранилище тел файлов: длина хеша и минимальный размер тела, которое
+# имеет смысл дедуплицировать (меньшие тела дешевле хранить как есть)
+BLOB_DIGEST_SIZE = 16
+BLOB_MIN_SIZE = 128
+
+# Бинарный снимок VFS (<xml>.snap):
+#   заголовок: сигнатура, mtime_ns и размер XML, хеш XML, время загрузки XML,
+#              количество узлов (без корня), количество тел, размер блока имён
+#   записи узлов фиксированного размера: тип, номер родительской директории
+#              (директории нумеруются в порядке записи, корень - 0), номер тела
+#   таблица уникальных тел: смещение, длина и хеш содержимого
+#   имена узлов в UTF-8 через '\0' (в XML 1.0 этот символ недопустим)
+#   тела файлов подряд - при загрузке отображаются через mmap без копирования
+SNAPSHOT_SUFFIX = ".snap"
+SNAPSHOT_MAGIC = b"VFSSNAP3"
+SNAPSHOT_HEADER = struct.Struct("<8sqQ32sdQQQ")
+SNAPSHOT_RECORD = struct.Struct("<BIQ")
+SNAPSHOT_BLOB = struct.Struct(f"<QQ{BLOB_DIGEST_SIZE}s")
+SNAPSHOT_KIND_DIR = 0
+SNAPSHOT_KIND_FILE = 1
+
+# Журнал изменений VFS (<xml>.journal): сигнатура, затем записи
+#   длина данных, crc32 (операция + данные), операция, данные - поля
+#   вида (длина, байты UTF-8). Запись с неверной длиной или crc32 считается
+#   оборванной при сбое: она и всё после неё отбрасываются при воспроизведении.
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_MAGIC = b"VFSJRNL1"
+JOURNAL_RECORD = struct.Struct("<IIB")
+JOURNAL_FIELD = struct.Struct("<I")
+JOURNAL_MKDIR = 1
+JOURNAL_CREATE = 2
+JOURNAL_COPY = 3
+JOURNAL_COPY_TREE = 4
+JOURNAL_WRITE = 5
+# Дозапись >>: путь, длина тела до дозаписи (JOURNAL_LENGTH) и дописанные байты
+JOURNAL_APPEND = 6
+JOURNAL_LENGTH = struct.Struct("<Q")
+# После скольких записей журнал уплотняется в XML и снимок
+JOURNAL_COMPACT_RECORDS = 10000
+# Вызывать fsync после каждой записи журнала
+JOURNAL_FSYNC = True
+
+# Размер блока, которым cat пишет тело файла в stdout
+CAT_CHUNK_SIZE = 1024 * 1024
+# Файлы реальной ОС меньше этого размера читаются одним read; большие cat
+# передаёт через os.sendfile, а конвейер читает блоками отображения mmap
+HOST_ZERO_COPY_MIN = 256 * 1024
+# Сколько байт передаёт один вызов os.sendfile
+SENDFILE_CHUNK = 64 * 1024 * 1024
+# tail читает файл с конца блоками такого размера
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Гистограммы задержек (--profile): число интервалов на каждую степень двойки
+# (относительная погрешность процентилей - около 3%)
+HISTOGRAM_SUB_BUCKETS = 16
+
+# Параллельный grep (-P): примерный объём тел файлов в одном задании процесса
+PARALLEL_TASK_SIZE = 8 * 1024 * 1024
+
+# ls -l в реальной ФС: записи получают lstat пачками такого размера (пачка
+# выводится сразу после своих stat), большие пачки делятся между потоками -
+# os.lstat отпускает GIL, и задержки сетевых ФС перекрываются
+LS_STAT_BATCH = 1024
+LS_STAT_WORKERS = 8
+LS_STAT_PARALLEL_MIN = 256
+
+# Сколько различных строк команд хранит кеш разобранных шаблонов
+PARSE_CACHE_SIZE = 1024
+
+# Триграммный индекс grep -r: тела больше этого размера не индексируются
+# и всегда проверяются полным поиском
+TRIGRAM_MAX_SIZE = 1024 * 1024
+
+# DirNode.shared для директорий опубликованной версии дерева (см. VFS.version):
+# их тоже нельзя менять на месте, но, в отличие от копий cp -r, копия при
+# записи забирает словарь детей себе, а не делит его с другой живой копией
+FROZEN = 2
+
+# Символы, которые нельзя сохранить текстом в XML без искажений
+XML_UNSAFE_TEXT = re.compile('[\x00-\x08\x0b-\x1f\ud800-\udfff\ufffe\uffff]')
+# Элементы шаблонов find -name: *, ? и класс [...] (непарная '[' - обычный символ)
+GLOB_TOKEN = re.compile(r'\*|\?|\[!?\]?[^\]]*\]')
+# Встроенный флаг (?x) меняет смысл пробелов в выражении
+VERBOSE_FLAG = re.compile(r'\(\?[aiLmsu]*x')
+# Цифры escape-последовательностей \xHH и \ooo в выражениях
+HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+OCTAL_DIGITS = frozenset("01234567")
+
+@contextmanager
+def gc_paused():
+    """Отключает циклический сборщик мусора на время массового создания узлов
+
+    Узлы VFS не образуют циклов, а частые проходы сборщика по растущему
+    дереву заметно замедляют загрузку больших образов.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+def format_size(size, human=False):
+    """Размер для du: в блоках по 1 КБ с округлением вверх или (human) в K/M/G/T"""
+    if not human:
+        return str(-(-size // 1024))
+    if size < 1024:
+        return str(size)
+    value = float(size)
+    for unit in "KMGTP":
+        value /= 1024
+        if value < 1024 or unit == "P":
+            break
+    return f"{value:.1f}{unit}" if value < 10 else f"{math.ceil(value)}{unit}"
+
+
+@lru_cache(maxsize=None)
+def host_owner(uid):
+    """Имя пользователя реальной ОС по uid (число, если имени нет)"""
+    if pwd is not None:
+        try:
+            return pwd.getpwuid(uid).pw_name
+        except KeyError:
+            pass
+    return str(uid)
+
+
+def lstat_entries(entries):
+    """lstat для записей os.scandir в их порядке (None - запись недоступна)"""
+    result = []
+    for entry in entries:
+        try:
+            result.append(entry.stat(follow_symlinks=False))
+        except OSError:
+            result.append(None)
+    return result
+
+
+def format_duration(seconds):
+    """Время в формате time из bash: 0m0.012s"""
+    minutes, seconds = divmod(seconds, 60)
+    return f"{int(minutes)}m{seconds:.3f}s"
+
+
+def iter_chunks(data, chunk_size=CAT_CHUNK_SIZE):
+    """Отдаёт байты блоками memoryview без промежуточных копий"""
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def write_chunks(out, data, chunk_size=CAT_CHUNK_SIZE):
+    """Пишет байты в двоичный поток блоками без промежуточных копий"""
+    for chunk in iter_chunks(data, chunk_size):
+        out.write(chunk)
+
+
+def host_file_chunks(path, offset=0, chunk_size=CAT_CHUNK_SIZE):
+    """Блоки файла реальной ОС начиная со смещения offset
+
+    Небольшой файл (и файл без размера, как в /proc) читается одним read,
+    большой отдаётся блоками memoryview на отображение mmap без копий.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size - offset < HOST_ZERO_COPY_MIN:
+            f.seek(offset)
+            yield f.read()
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield from iter_chunks(memoryview(mapped)[offset:], chunk_size)
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # Получатель ещё держит блок; отображение закроется вместе с ним
+                pass
+
+
+def tail_start(read, size, count, block_size=TAIL_BLOCK_SIZE):
+    """Смещение начала последних count строк данных размера size
+
+    read(offset, length) возвращает байты. Блоки читаются с конца, поэтому
+    объём чтения зависит от длины хвоста, а не от размера данных.
+    Завершающий перевод строки не начинает новую строку.
+    """
+    if count == 0:
+        return size
+    newlines = 0
+    position = size
+    while position > 0:
+        start = max(0, position - block_size)
+        block = read(start, position - start)
+        index = len(block)
+        while True:
+            index = block.rfind(b"\n", 0, index)
+            if index < 0:
+                break
+            if start + index == size - 1:
+                continue
+            newlines += 1
+            if newlines == count:
+                return start + index + 1
+        position = start
+    return 0
+
+
+def iter_line_blocks(chunks):
+    """Перегруппирует поток блоков байтов в блоки из целых строк
+
+    В памяти держится только текущий блок и начало незаконченной строки;
+    последний блок может не заканчиваться переводом строки.
+    """
+    pending = b""
+    for chunk in chunks:
+        data = pending + chunk if pending else bytes(chunk)
+        end = data.rfind(b"\n") + 1
+        if end:
+            yield data[:end]
+        pending = data[end:]
+    if pending:
+        yield pending
+
+
+def iter_lines(chunks):
+    """Разбивает поток блоков байтов на строки (с b"\\n" на конце, кроме, может быть, последней)"""
+    for block in iter_line_blocks(chunks):
+        start = 0
+        while start < len(block):
+            end = block.find(b"\n", start) + 1 or len(block)
+            yield block[start:end]
+            start = end
+
+
+class OutputSink:
+    """Приёмник вывода команд Shell
+
+    Строки и небольшие блоки байтов копятся в списке и уходят в двоичный
+    поток одним блоком, когда набирается buffer_size байт, а также в явных
+    точках сброса
+    (перед приглашением, в конце скрипта, при выходе). stream=None -
+    текущий sys.stdout; поток io.BytesIO позволяет перехватить вывод
+    (тесты, встраивание) и получить его через getvalue().
+    """
+
+    def __init__(self, stream=None, buffer_size=OUTPUT_BUFFER_SIZE, encoding=None):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.encoding = encoding or (sys.stdout.encoding if stream is None else "utf-8") or "utf-8"
+        self._pending = []
+        self._pending_size = 0
+        # Сколько байт прошло через приёмник (для --profile)
+        self.written = 0
+
+    def _target(self):
+        """Двоичный поток, в который уходит вывод"""
+        if self.stream is not None:
+            return self.stream
+        # Текстовый слой sys.stdout может держать вывод, напечатанный через print
+        sys.stdout.flush()
+        return sys.stdout.buffer
+
+    def _drain(self, target):
+        """Передаёт накопленный вывод в поток без его сброса"""
+        if self._pending:
+            target.write(b"".join(self._pending))
+            self._pending.clear()
+            self._pending_size = 0
+
+    def write(self, text):
+        """Добавляет текст в буфер"""
+        self._append(text.encode(self.encoding, "replace"))
+
+    def _append(self, data):
+        """Добавляет байты в буфер и сбрасывает его при переполнении"""
+        self._pending.append(data)
+        self._pending_size += len(data)
+        self.written += len(data)
+        if self._pending_size >= self.buffer_size:
+            self._drain(self._target())
+
+    def line(self, text=""):
+        """Добавляет строку с переводом строки (замена print)"""
+        self.write(f"{text}\n")
+
+    def write_bytes(self, data):
+        """Пишет байты (содержимое файлов); большие блоки - сразу, без копирования"""
+        if len(data) < self.buffer_size:
+            self._append(data)
+            return
+        target = self._target()
+        self._drain(target)
+        write_chunks(target, data)
+        self.written += len(data)
+
+    def write_file(self, f):
+        """Пишет содержимое открытого двоичного файла и возвращает его последний байт
+
+        Небольшой файл читается одним read. Большой уходит в дескриптор
+        вывода через os.sendfile (копирование внутри ядра), а если вывод -
+        не файловый дескриптор или sendfile недоступен, - блоками mmap.
+        """
+        size = os.fstat(f.fileno()).st_size
+        if size < HOST_ZERO_COPY_MIN:
+            data = f.read()
+            self.write_bytes(data)
+            return data[-1:]
+        
+        target = self._target()
+        self._drain(target)
+        target.flush()
+        sent = self._sendfile(target, f, size)
+        if sent < size:
+            for chunk in host_file_chunks(f.name, sent):
+                target.write(chunk)
+        self.written += size
+        f.seek(size - 1)
+        return f.read(1)
+
+    @staticmethod
+    def _sendfile(target, f, size):
+        """Передаёт файл в дескриптор потока target средствами ядра; возвращает число байт
+
+        В обычный файл - через os.copy_file_range (как системный cat), в канал
+        и терминал - через os.sendfile.
+        """
+        try:
+            out_fd = target.fileno()
+            to_file = S_ISREG(os.fstat(out_fd).st_mode)
+        except (AttributeError, OSError, ValueError):
+            return 0
+        in_fd = f.fileno()
+        offset = 0
+        try:
+            while offset < size:
+                count = min(size - offset, SENDFILE_CHUNK)
+                if to_file:
+                    sent = os.copy_file_range(in_fd, out_fd, count, offset)
+                else:
+                    sent = os.sendfile(out_fd, in_fd, offset, count)
+                if not sent:
+                    break
+                offset += sent
+        except (AttributeError, OSError) as e:
+            # Нет нужного вызова или вывод его не поддерживает (macOS: sendfile - только в сокеты;
+            # copy_file_range - не между любыми ФС и не в файл с O_APPEND)
+            if offset or getattr(e, "errno", None) not in (None, errno.EINVAL, errno.ENOSYS, errno.EXDEV,
+                                                           errno.EBADF, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+        return offset
+
+    def flush(self):
+        """Сбрасывает буфер в поток"""
+        target = self._target()
+        self._drain(target)
+        target.flush()
+
+    def isatty(self):
+        """Идёт ли вывод на терминал"""
+        target = self.stream if self.stream is not None else sys.stdout
+        return target.isatty()
+
+    def end_output(self, last):
+        """Завершает вывод команды, чьи последние байты - last
+
+        На терминале приглашение не должно прилипать к выводу без перевода строки.
+        """
+        if last and last[-1:] != b"\n" and self.isatty():
+            self.write("\n")
+
+    def getvalue(self):
+        """Весь перехваченный вывод (для потока io.BytesIO)"""
+        self.flush()
+        return self.stream.getvalue().decode(self.encoding)
+
+
+class Histogram:
+    """Гистограмма с логарифмическими интервалами для задержек и размеров
+
+    Значение попадает в один из HISTOGRAM_SUB_BUCKETS интервалов своей
+    степени двойки: добавление - это frexp и одно обращение к словарю,
+    а память не зависит от числа значений.
+    """
+    __slots__ = ("buckets", "count", "total", "max", "zero")
+
+    def __init__(self):
+        # номер интервала -> число значений
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        # Нулевые значения (например, команда без вывода)
+        self.zero = 0
+
+    def add(self, value):
+        """Добавляет значение"""
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zero += 1
+            return
+        mantissa, exponent = math.frexp(value)
+        key = exponent * HISTOGRAM_SUB_BUCKETS + int((mantissa - 0.5) * 2 * HISTOGRAM_SUB_BUCKETS)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    @staticmethod
+    def _upper(key):
+        """Верхняя граница интервала"""
+        exponent, sub = divmod(key, HISTOGRAM_SUB_BUCKETS)
+        return math.ldexp(0.5 + (sub + 1) / (2 * HISTOGRAM_SUB_BUCKETS), exponent)
+
+    def percentile(self, percent):
+        """Значение, не меньше которого percent процентов значений (по верхней границе интервала)"""
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(self.count * percent / 100))
+        seen = self.zero
+        if seen >= rank:
+            return 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                return min(self._upper(key), self.max)
+        return self.max
+
+    def to_dict(self):
+        """Гистограмма для JSON: итоги, процентили и интервалы [верхняя граница, число]"""
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "buckets": [[0, self.zero]] * bool(self.zero) +
+                       [[self._upper(key), self.buckets[key]] for key in sorted(self.buckets)],
+        }
+
+
+class CommandProfiler:
+    """Задержки команд Shell (--profile, stats on)
+
+    Для каждого имени команды (у конвейера - имена этапов через '|')
+    хранятся гистограммы времени разбора, времени выполнения и объёма вывода.
+    """
+    METRICS = ("parse", "handler", "output")
+
+    def __init__(self):
+        # имя команды -> (разбор, выполнение, вывод)
+        self.commands = {}
+
+    def record(self, name, parse_seconds, handler_seconds, output_bytes):
+        """Запоминает одно выполнение команды"""
+        histograms = self.commands.get(name)
+        if histograms is None:
+            histograms = self.commands[name] = (Histogram(), Histogram(), Histogram())
+        histograms[0].add(parse_seconds)
+        histograms[1].add(handler_seconds)
+        histograms[2].add(output_bytes)
+
+    def to_dict(self):
+        """Все гистограммы для JSON"""
+        return {name: {metric: histogram.to_dict() for metric, histogram in zip(self.METRICS, histograms)}
+                for name, histograms in sorted(self.commands.items())}
+
+
+class BlobStore:
+    """Хранилище тел файлов с адресацией по содержимому
+
+    Одинаковые тела хранятся в одном экземпляре под ключом - хешем
+    содержимого. Счётчик ссылок показывает, сколько узлов FileNode
+    используют тело; тело удаляется вместе с последней ссылкой.
+    """
+
+    def __init__(self):
+        # хеш -> [тело, число ссылок]
+        self._blobs = {}
+        self.physical_size = 0
+
+    def __len__(self):
+        return len(self._blobs)
+
+    @staticmethod
+    def digest(data):
+        """Возвращает ключ тела в хранилище"""
+        return hashlib.blake2b(data, digest_size=BLOB_DIGEST_SIZE).digest()
+
+    def add(self, data, digest=None):
+        """Добавляет ссылку на тело и возвращает его общий экземпляр"""
+        if len(data) < BLOB_MIN_SIZE:
+            return data
+        if digest is None:
+            digest = self.digest(data)
+
+        entry = self._blobs.get(digest)
+        if entry is None:
+            self._blobs[digest] = [data, 1]
+            self.physical_size += len(data)
+            return data
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, data):
+        """Убирает ссылку на тело"""
+        if len(data) < BLOB_MIN_SIZE:
+            return
+        digest = self.digest(data)
+        entry = self._blobs.get(digest)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if not entry[1]:
+            del self._blobs[digest]
+            self.physical_size -= len(data)
+
+
+class TrigramIndex:
+    """Триграммный индекс тел файлов для grep -r
+
+    Для каждой последовательности из трёх байтов хранится множество узлов
+    FileNode, в телах которых она встречается. Тела индексируются в нижнем
+    регистре (ASCII), поэтому индекс подходит и для поиска с -i; итоговое
+    совпадение всегда подтверждается регулярным выражением.
+    """
+
+    def __init__(self):
+        # триграмма -> множество узлов FileNode
+        self._postings = {}
+        # Узлы с телами больше TRIGRAM_MAX_SIZE - кандидаты при любом запросе
+        self._unindexed = set()
+
+    @staticmethod
+    def trigrams(data):
+        """Множество триграмм байтов в нижнем регистре (кортежи из трёх чисел)"""
+        data = bytes(data).lower()
+        return set(zip(data, data[1:], data[2:]))
+
+    def add(self, node):
+        """Индексирует тело файла"""
+        if len(node.content) > TRIGRAM_MAX_SIZE:
+            self._unindexed.add(node)
+            return
+        postings = self._postings
+        for trigram in self.trigrams(node.content):
+            nodes = postings.get(trigram)
+            if nodes is None:
+                postings[trigram] = {node}
+            else:
+                nodes.add(node)
+
+    def discard(self, node):
+        """Убирает файл из индекса"""
+        if len(node.content) > TRIGRAM_MAX_SIZE:
+            self._unindexed.discard(node)
+            return
+        postings = self._postings
+        for trigram in self.trigrams(node.content):
+            nodes = postings.get(trigram)
+            if nodes is not None:
+                nodes.discard(node)
+                if not nodes:
+                    del postings[trigram]
+
+    def candidates(self, literals):
+        """Узлы, которые могут содержать все строки literals (байты)
+
+        Возвращает None, если в строках нет ни одной триграммы и индекс
+        не сужает поиск.
+        """
+        trigrams = set()
+        for literal in literals:
+            trigrams |= self.trigrams(literal)
+        if not trigrams:
+            return None
+
+        # Пересечение начинается с самого короткого списка
+        postings = sorted((self._postings.get(trigram, ()) for trigram in trigrams), key=len)
+        result = set(postings[0])
+        for nodes in postings[1:]:
+            if not result:
+                break
+            result &= nodes
+        return result | self._unindexed
+
+
+class NameIndex:
+    """Глобальный индекс имён для find
+
+    Для каждого имени хранится словарь путь родительской директории ->
+    директория ли узел. Строка пути родителя общая для всех его детей,
+    поэтому индекс почти не тратит память на пути. Отсортированные списки
+    имён и перевёрнутых имён позволяют бинарным поиском найти имена для
+    шаблонов вида "prefix*" и "*suffix", не перебирая все имена.
+    """
+
+    def __init__(self):
+        # имя -> {путь родителя: директория ли}
+        self._names = {}
+        # Отсортированные имена; имена в порядке перевёрнутых имён и сами
+        # перевёрнутые имена для поиска по суффиксу (None - ещё не построены)
+        self._sorted = None
+        self._by_suffix = None
+        self._suffixes = None
+
+    def add(self, parent, name, is_dir):
+        """Добавляет узел name в директории parent"""
+        parents = self._names.get(name)
+        if parents is None:
+            parents = self._names[name] = {}
+            if self._sorted is not None:
+                insort(self._sorted, name)
+                position = bisect_left(self._suffixes, name[::-1])
+                self._suffixes.insert(position, name[::-1])
+                self._by_suffix.insert(position, name)
+        parents[parent] = is_dir
+
+    def sort(self):
+        """Строит отсортированные списки имён (после массового заполнения индекса)"""
+        self._sorted = sorted(self._names)
+        self._by_suffix = sorted(self._names, key=lambda name: name[::-1])
+        self._suffixes = [name[::-1] for name in self._by_suffix]
+
+    @staticmethod
+    def _range(keys, prefix):
+        """Границы элементов отсортированного списка, начинающихся с prefix"""
+        start = bisect_left(keys, prefix)
+        return start, bisect_left(keys, prefix + "\U0010ffff", start)
+
+    def names(self, pattern):
+        """Имена из индекса, подходящие под шаблон (с учётом регистра, как find -name)"""
+        tokens = list(GLOB_TOKEN.finditer(pattern))
+        if not tokens:
+            return [pattern] if pattern in self._names else []
+        
+        if self._sorted is None:
+            self.sort()
+        prefix = pattern[:tokens[0].start()]
+        suffix = pattern[tokens[-1].end():]
+        if prefix:
+            start, end = self._range(self._sorted, prefix)
+            names = self._sorted[start:end]
+        elif suffix:
+            start, end = self._range(self._suffixes, suffix[::-1])
+            names = self._by_suffix[start:end]
+        else:
+            names = self._sorted
+        return list(filter(re.compile(translate(pattern)).match, names))
+
+    def entries(self, pattern):
+        """Пары (путь родителя, имя, директория ли) для имён под шаблоном"""
+        for name in self.names(pattern):
+            for parent, is_dir in self._names[name].items():
+                yield parent, name, is_dir
+
+
+def _escape_end(pattern, char, index):
+    """Индекс за концом буквенно-цифровой escape-последовательности \\<char>..., начатой до index"""
+    if char in ("x", "u", "U"):
+        width = {"x": 2, "u": 4, "U": 8}[char]
+        while width and pattern[index:index + 1] in HEX_DIGITS:
+            index += 1
+            width -= 1
+    elif char == "N" and pattern.startswith("{", index):
+        index = pattern.find("}", index) + 1 or len(pattern)
+    elif char == "0":
+        # \0 и до двух восьмеричных цифр
+        for _ in range(2):
+            if pattern[index:index + 1] not in OCTAL_DIGITS:
+                break
+            index += 1
+    elif char.isdigit():
+        # Три восьмеричные цифры - код символа, иначе обратная ссылка \1..\99
+        if (char in OCTAL_DIGITS and pattern[index:index + 1] in OCTAL_DIGITS
+                and pattern[index + 1:index + 2] in OCTAL_DIGITS):
+            index += 2
+        elif pattern[index:index + 1].isdigit():
+            index += 1
+    return index
+
+
+def regex_literals(pattern):
+    """Строки, которые обязательно входят в любое совпадение с регулярным выражением
+
+    Разбор консервативный: при чередовании '|' ничего не возвращается,
+    метасимволы, символьные классы и группы разрывают строку и в неё
+    не попадают, символ перед *, ? и {m,n} отбрасывается как необязательный.
+    Буквенно-цифровые escape-последовательности (\\d, \\x41, \\101, \\1,
+    \\N{...}) разбираются целиком и тоже разрывают строку.
+    """
+    if "|" in pattern.replace("\\\\", "").replace("\\|", "") or VERBOSE_FLAG.match(pattern):
+        return []
+
+    literals = []
+    current = []
+    depth = 0
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        index += 1
+        literal = None
+        if char == "\\":
+            char = pattern[index:index + 1]
+            index += 1
+            if char and not char.isalnum():
+                literal = char
+            else:
+                index = _escape_end(pattern, char, index)
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth = max(depth - 1, 0)
+        elif char == "[":
+            # Класс пропускается целиком; ']' сразу после '[' или '[^' входит в класс
+            if pattern.startswith("^", index):
+                index += 1
+            if pattern.startswith("]", index):
+                index += 1
+            while index < len(pattern) and pattern[index] != "]":
+                index += 2 if pattern[index] == "\\" else 1
+            index += 1
+        elif char == "{":
+            index = pattern.find("}", index) + 1 or len(pattern)
+        elif char not in ".^$*+?}":
+            literal = char
+
+        if literal is not None and depth == 0 and not pattern.startswith(("*", "?", "{"), index):
+            current.append(literal)
+        elif current:
+            literals.append("".join(current))
+            current = []
+    if current:
+        literals.append("".join(current))
+    return literals
+
+
+class FileNode:
+    """Файл VFS
+
+    Узлы хранятся в компактном виде: __slots__ вместо словаря атрибутов
+    и без строки типа - тип узла определяется его классом.
+    content - байты; тело файла из снимка - memoryview на отображённый снимок.
+    """
+    __slots__ = ("content",)
+
+    def __init__(self, content=b""):
+        self.content = content
+
+
+class DirNode:
+    """Директория VFS
+
+    children - словарь имя -> узел. В ленивом режиме children равен None,
+    пока поддерево не разобрано, а offset хранит смещение <directory> в XML.
+    В смонтированной директории реальной ОС offset - её источник HostDir.
+    shared - узел или его словарь детей доступны из нескольких мест дерева
+    (SharedChildren, после cp -r) или из опубликованной версии дерева
+    (FROZEN), поэтому перед изменением узел заменяется копией.
+    size и count - суммарный размер тел файлов и число узлов в поддереве
+    (для du и ls -l). None - итоги ещё не подсчитаны (ленивый режим или
+    готовый словарь детей); тогда не подсчитаны и итоги всех предков.
+    order - пара отсортированных списков имён (директории, файлы) для ls;
+    строится при первом просмотре директории и дальше поддерживается
+    вставкой через bisect. None - порядок ещё не построен.
+    """
+    __slots__ = ("children", "offset", "shared", "size", "count", "order")
+
+    def __init__(self, children=None, offset=None, shared=False, size=None, count=None, order=None):
+        if children is None and offset is None:
+            children = {}
+            if size is None:
+                size = count = 0
+        self.children = children
+        self.offset = offset
+        self.shared = shared
+        self.size = size
+        self.count = count
+        self.order = order
+
+
+class SharedChildren:
+    """Значение DirNode.shared у директорий, чей словарь детей делят копии cp -r
+
+    owners - сколько мест живого дерева ещё пользуются этим словарём.
+    Последняя из копий забирает словарь (и ссылки на тела) себе, остальные
+    получают собственные копии с новыми ссылками.
+    """
+    __slots__ = ("owners",)
+
+    def __init__(self, owners):
+        self.owners = owners
+
+
+class HostDir:
+    """Источник смонтированной директории реальной ОС (DirNode.offset)
+
+    mount - пара (директория реальной ОС, путь VFS) монтирования; mtime -
+    время изменения директории при последнем чтении её записей (None - не читалась).
+    """
+    __slots__ = ("path", "mount", "mtime")
+
+    def __init__(self, path, mount):
+        self.path = path
+        self.mount = mount
+        self.mtime = None
+
+    def vfs_path(self):
+        """Путь этой директории в VFS"""
+        host_root, vfs_root = self.mount
+        relative = self.path[len(host_root):].replace(os.sep, "/")
+        return (vfs_root.rstrip("/") + relative) or "/"
+
+
+class HostFile:
+    """Тело файла смонтированной директории (FileNode.content) до чтения
+
+    Само тело читается при обращении (см. VFS.body); len() - размер файла,
+    который берётся из stat при первом запросе.
+    """
+    __slots__ = ("path", "mount", "size")
+
+    def __init__(self, path, mount):
+        self.path = path
+        self.mount = mount
+        self.size = None
+
+    def __len__(self):
+        if self.size is None:
+            try:
+                self.size = os.stat(self.path).st_size
+            except OSError:
+                self.size = 0
+        return self.size
+
 
 class VFS:
     """Виртуальная файловая система"""
     
-    def __init__(self, xml_path=None):
-        self.root = {}
+    def __init__(self, xml_path=None, lazy=False, cache_size=RESOLVE_CACHE_SIZE, snapshot=True,
+                 persist=False, verbose=True, mounts=()):
+        self.root = DirNode()
         self.current_path = "/"
         self.xml_path = xml_path
+        self.lazy = lazy
+        self.snapshot = snapshot
+        # Печатать ли сообщения о загрузке (предупреждения и ошибки печатаются всегда)
+        self.verbose = verbose
+        # LRU кеш разрешения путей: нормализованный путь -> (узел, поколение)
+        self.cache_size = cache_size
+        self._resolve_cache = OrderedDict()
+        # Увеличивается при каждом изменении дерева
+        self._generation = 0
+        # Ленивый режим: смещение начала <directory> -> смещение её закрывающего тега
+        self._spans = {}
+        self._xml_encoding = None
+        # Отображение снимка в память, на которое ссылаются тела файлов
+        self._snapshot_map = None
+        # Откуда и за сколько загружена VFS (для --timing)
+        self.load_stats = {}
+        # Тела файлов с дедупликацией по содержимому
+        self.blobs = BlobStore()
+        # Есть ли в дереве разделяемые после cp -r узлы
+        self._cow = False
+        # Файлы, оказавшиеся после cp -r в нескольких директориях: узел -> число директорий
+        self._shared_files = {}
+        # Журнал изменений (только с persist=True)
+        self._journal = None
+        self._journal_records = 0
+        # Триграммный индекс тел файлов: строится при первом grep -r
+        self._trigrams = None
+        # Индекс имён: строится при первом find
+        self._names = None
+        # Писатели работают по очереди; под этой же блокировкой разбираются
+        # ленивые директории
+        self._lock = threading.RLock()
+        self._write_depth = 0
+        # Последняя опубликованная версия дерева (None - версии не запрашивались)
+        self._published = None
+        # Смонтированные директории реальной ОС: путь VFS -> директория реальной ОС
+        self.mounts = {}
+        # LRU кеш тел их файлов: HostFile -> (mtime, тело)
+        self._host_bodies = OrderedDict()
+        self._host_bodies_size = 0
         
         if xml_path and os.path.exists(xml_path):
-            self.load_from_xml(xml_path)
+            if snapshot and self.load_snapshot(xml_path):
+                pass
+            elif lazy:
+                self.index_xml(xml_path)
+            elif self.load_from_xml(xml_path) and snapshot:
+                self.save_snapshot(xml_path, self.load_stats["seconds"])
         elif xml_path:
             print(f"Предупреждение: VFS файл не найден: {xml_path}")
+        # Монтирования не журналируются: копии из них журнал хранит содержимым, а не путями
+        for host_path, path in mounts:
+            if not self.mount(host_path, path):
+                print(f"Предупреждение: не удалось смонтировать {host_path} в {path}")
+        if persist and xml_path and os.path.exists(xml_path):
+            self.open_journal(xml_path)
     
-    def load_from_xml(self, xml_path):
-        """Загружает VFS из XML файла"""
+    def load_from_xml(self, xml_path, show_progress=None):
+        """Загружает VFS из XML файла потоково (iterparse)
+
+        Каждый элемент превращается в узел VFS по событию "end" и сразу
+        удаляется из дерева ElementTree, поэтому в памяти никогда не
+        находится весь DOM одновременно с готовой структурой VFS.
+        """
+        start_time = time.perf_counter()
         try:
-            tree = ET.parse(xml_path)
-            root = tree.getroot()
-            self.root = self._parse_xml_element(root)
-            print(f"VFS загружена из {xml_path}")
+            total_size = os.path.getsize(xml_path)
+            if show_progress is None:
+                show_progress = total_size >= PROGRESS_MIN_SIZE
+
+            self._resolve_cache.clear()
+            self._trigrams = None
+            self._names = None
+            self.blobs = BlobStore()
+            with open(xml_path, 'rb') as f, gc_paused():
+                self.root, count = self._build_tree(
+                    ET.iterparse(f, events=("start", "end")),
+                    f if show_progress else None,
+                    total_size
+                )
+
+            elapsed = time.perf_counter() - start_time
+            if show_progress:
+                sys.stderr.write("\r" + " " * 60 + "\r")
+                sys.stderr.flush()
+            self.load_stats = {"source": "xml", "seconds": elapsed}
+            if self.verbose:
+                print(f"VFS загружена из {xml_path} за {elapsed:.3f} с (элементов: {count})")
+            return True
         except Exception as e:
             print(f"Ошибка загрузки VFS: {e}")
-            self.root = {}
-    
-    def _parse_xml_element(self, element):
-        """Рекурсивно парсит XML элемент в структуру VFS"""
-        result = {}
-        
-        for child in element:
-            if child.tag == "directory":
-                name = child.get("name", "")
-                result[name] = {
-                    "type": "directory",
-                    "children": self._parse_xml_element(child)
-                }
-            elif child.tag == "file":
-                name = child.get("name", "")
-                content = child.text or ""
-                
-                # Проверяем, является ли содержимое base64
-                if child.get("encoding") == "base64":
+            self.root = DirNode()
+            return False
+
+    def _build_tree(self, events, progress_file=None, total_size=0):
+        """Строит структуру VFS из потока событий iterparse
+
+        Возвращает пару (корень VFS, количество обработанных элементов).
+        Элементы вне <directory>/<file> (и всё их содержимое) пропускаются,
+        как и раньше.
+        """
+        root = DirNode()
+        # Стек контейнеров: директория или None для пропускаемых веток
+        containers = []
+        # Стек XML элементов, чтобы удалять обработанных детей из родителя
+        elements = []
+        count = 0
+
+        for event, elem in events:
+            if event == "start":
+                if not elements:
+                    # Корневой элемент документа (<vfs>)
+                    containers.append(root)
+                else:
+                    parent = containers[-1]
+                    if parent is not None and elem.tag == "directory":
+                        node = DirNode()
+                        parent.children[intern(elem.get("name", ""))] = node
+                        containers.append(node)
+                    else:
+                        containers.append(None)
+                elements.append(elem)
+                continue
+
+            elements.pop()
+            node = containers.pop()
+            if elements:
+                parent = containers[-1]
+                if parent is not None and elem.tag == "file":
+                    content = self.blobs.add(self._decode_content(elem.text, elem.get("encoding")))
+                    parent.children[intern(elem.get("name", ""))] = FileNode(content)
+                    parent.size += len(content)
+                    parent.count += 1
+                elif node is not None:
+                    # Закрылась директория - её итоги входят в итоги родителя
+                    parent.size += node.size
+                    parent.count += node.count + 1
+                # Элемент обработан - освобождаем его вместе с содержимым
+                elem.clear()
+                del elements[-1][-1]
+
+            count += 1
+            if progress_file is not None and count % PROGRESS_EVERY == 0:
+                percent = progress_file.tell() * 100 // max(total_size, 1)
+                sys.stderr.write(f"\rЗагрузка VFS: {percent}% (элементов: {count})")
+                sys.stderr.flush()
+
+        return root, count
+
+    def _decode_content(self, text, encoding=None):
+        """Возвращает содержимое файла (байты) по тексту XML элемента"""
+        text = text or ""
+
+        # Проверяем, является ли содержимое base64
+        if encoding == "base64":
+            try:
+                return base64.b64decode(text)
+            except ValueError:
+                pass
+
+        return text.encode('utf-8')
+
+    def index_xml(self, xml_path):
+        """Индексирует XML файл для ленивой загрузки
+
+        За один проход expat (без построения узлов и декодирования base64)
+        запоминает, где начинается и заканчивается каждая непустая
+        <directory>. Сразу материализуется только корневой уровень,
+        остальные поддеревья разбираются при первом обращении.
+        """
+        start_time = time.perf_counter()
+        try:
+            parser = expat.ParserCreate()
+            spans = {}
+            # Стек открытых элементов: [смещение начала, есть ли дочерние элементы, тег]
+            stack = []
+            root_info = {}
+
+            def xml_decl(version, encoding, standalone):
+                self._xml_encoding = encoding
+
+            def start_element(name, attrs):
+                if stack:
+                    stack[-1][1] = True
+                stack.append([parser.CurrentByteIndex, False, name])
+
+            def end_element(name):
+                start, has_children, tag = stack.pop()
+                # Пустые директории не индексируются - их дети известны заранее
+                if has_children and (tag == "directory" or not stack):
+                    spans[start] = parser.CurrentByteIndex
+                if not stack:
+                    root_info["start"] = start
+                    root_info["tag"] = tag
+
+            parser.XmlDeclHandler = xml_decl
+            parser.StartElementHandler = start_element
+            parser.EndElementHandler = end_element
+
+            with open(xml_path, 'rb') as f:
+                parser.ParseFile(f)
+
+            self._spans = spans
+            self._resolve_cache.clear()
+            self._trigrams = None
+            self._names = None
+            self.blobs = BlobStore()
+            self.root = DirNode(self._load_span(root_info["start"], root_info["tag"]))
+
+            elapsed = time.perf_counter() - start_time
+            self.load_stats = {"source": "index", "seconds": elapsed}
+            if self.verbose:
+                print(f"VFS проиндексирована из {xml_path} за {elapsed:.3f} с (директорий: {len(spans)})")
+        except Exception as e:
+            print(f"Ошибка загрузки VFS: {e}")
+            self.root = DirNode()
+            self._spans = {}
+
+    def _load_span(self, start, tag="directory"):
+        """Разбирает только непосредственных детей элемента, начинающегося со смещения start"""
+        end = self._spans.pop(start, None)
+        if end is None:
+            return {}
+
+        with open(self.xml_path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+
+        parser = expat.ParserCreate(self._xml_encoding)
+        parser.buffer_text = True
+        children = {}
+        # depth 1 - сам элемент, depth 2 - его непосредственные дети
+        state = {"depth": 0, "file": None}
+        text = []
+
+        def start_element(name, attrs):
+            state["depth"] += 1
+            if state["depth"] != 2:
+                return
+            if name == "directory":
+                children[intern(attrs.get("name", ""))] = DirNode(
+                    offset=start + parser.CurrentByteIndex
+                )
+            elif name == "file":
+                state["file"] = attrs
+                text.clear()
+
+        def end_element(name):
+            state["depth"] -= 1
+            if state["depth"] == 1 and state["file"] is not None:
+                attrs = state["file"]
+                children[intern(attrs.get("name", ""))] = FileNode(self.blobs.add(
+                    self._decode_content("".join(text), attrs.get("encoding"))
+                ))
+                state["file"] = None
+
+        def character_data(data):
+            if state["depth"] == 2 and state["file"] is not None:
+                text.append(data)
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CharacterDataHandler = character_data
+        parser.Parse(data, False)
+        parser.Parse(f"</{tag}>".encode(self._xml_encoding or "utf-8"), True)
+        return children
+
+    def _xml_fingerprint(self, xml_path):
+        """Возвращает (mtime_ns, размер, хеш) XML файла для проверки снимка"""
+        stat = os.stat(xml_path)
+        digest = hashlib.blake2b(digest_size=32)
+        with open(xml_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return stat.st_mtime_ns, stat.st_size, digest.digest()
+
+    def save_snapshot(self, xml_path, xml_seconds=0.0):
+        """Записывает бинарный снимок текущего дерева рядом с XML файлом
+
+        Снимок пишется во временный файл и атомарно подменяет старый.
+        """
+        snapshot_path = xml_path + SNAPSHOT_SUFFIX
+        try:
+            mtime_ns, size, digest = self._xml_fingerprint(xml_path)
+            records = bytearray()
+            blobs = bytearray()
+            names = []
+            bodies = []
+            # Ключ тела -> номер в таблице тел. Общие экземпляры из хранилища
+            # узнаются по id, маленькие тела - по значению
+            blob_index = {}
+            data_size = 0
+
+            # Обход в ширину: родитель всегда записан раньше своих детей
+            queue = [self.root]
+            for parent_index, directory in enumerate(queue):
+                for name, node in self._children(directory).items():
+                    if type(node) is DirNode and type(node.offset) is HostDir:
+                        continue  # Монтирования не сохраняются
+                    names.append(name)
+                    if type(node) is DirNode:
+                        records += SNAPSHOT_RECORD.pack(SNAPSHOT_KIND_DIR, parent_index, 0)
+                        queue.append(node)
+                        continue
+
+                    body = self.body(node)
+                    key = id(body) if len(body) >= BLOB_MIN_SIZE else bytes(body)
+                    index = blob_index.get(key)
+                    if index is None:
+                        index = blob_index[key] = len(bodies)
+                        blobs += SNAPSHOT_BLOB.pack(data_size, len(body), BlobStore.digest(body))
+                        bodies.append(body)
+                        data_size += len(body)
+                    records += SNAPSHOT_RECORD.pack(SNAPSHOT_KIND_FILE, parent_index, index)
+            encoded_names = "\0".join(names).encode('utf-8')
+
+            tmp_path = snapshot_path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, mtime_ns, size, digest, xml_seconds,
+                                             len(names), len(bodies), len(encoded_names)))
+                f.write(records)
+                f.write(blobs)
+                f.write(encoded_names)
+                for body in bodies:
+                    f.write(body)
+            os.replace(tmp_path, snapshot_path)
+            return True
+        except OSError as e:
+            print(f"Предупреждение: не удалось записать снимок VFS {snapshot_path}: {e}")
+            return False
+
+    def load_snapshot(self, xml_path):
+        """Загружает VFS из бинарного снимка, если он соответствует XML файлу
+
+        Возвращает False, если снимка нет или XML изменился с момента его записи.
+        """
+        snapshot_path = xml_path + SNAPSHOT_SUFFIX
+        if not os.path.exists(snapshot_path):
+            return False
+
+        start_time = time.perf_counter()
+        try:
+            with open(snapshot_path, 'rb') as f:
+                snapshot_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            (magic, mtime_ns, size, digest, xml_seconds,
+             count, blob_count, names_size) = SNAPSHOT_HEADER.unpack_from(snapshot_map, 0)
+            if magic != SNAPSHOT_MAGIC or (mtime_ns, size, digest) != self._xml_fingerprint(xml_path):
+                snapshot_map.close()
+                return False
+
+            view = memoryview(snapshot_map)
+            records_start = SNAPSHOT_HEADER.size
+            blobs_start = records_start + count * SNAPSHOT_RECORD.size
+            names_start = blobs_start + blob_count * SNAPSHOT_BLOB.size
+            data_start = names_start + names_size
+            names = str(view[names_start:data_start], 'utf-8').split("\0") if count else []
+            records = SNAPSHOT_RECORD.iter_unpack(view[records_start:blobs_start])
+
+            # Одно представление memoryview на каждое уникальное тело
+            bodies = []
+            digests = []
+            for offset, length, blob_digest in SNAPSHOT_BLOB.iter_unpack(view[blobs_start:names_start]):
+                offset += data_start
+                bodies.append(view[offset:offset + length])
+                digests.append(blob_digest)
+
+            root = DirNode()
+            blob_store = BlobStore()
+            # Директории в порядке их номеров в снимке и номера их родителей
+            directories = [root]
+            parents = [None]
+            with gc_paused():
+                for name, (kind, parent_index, index) in zip(names, records):
+                    parent = directories[parent_index]
+                    if kind == SNAPSHOT_KIND_DIR:
+                        node = DirNode()
+                        directories.append(node)
+                        parents.append(parent_index)
+                    else:
+                        node = FileNode(blob_store.add(bodies[index], digests[index]))
+                        parent.size += len(node.content)
+                        parent.count += 1
+                    parent.children[intern(name)] = node
+                # Дети записаны после родителей: итоги поднимаются снизу вверх
+                for node_index in range(len(directories) - 1, 0, -1):
+                    node = directories[node_index]
+                    parent = directories[parents[node_index]]
+                    parent.size += node.size
+                    parent.count += node.count + 1
+
+            self.root = root
+            self.blobs = blob_store
+            self._resolve_cache.clear()
+            self._trigrams = None
+            self._names = None
+            self._snapshot_map = snapshot_map
+            elapsed = time.perf_counter() - start_time
+            self.load_stats = {"source": "snapshot", "seconds": elapsed, "xml_seconds": xml_seconds}
+            if self.verbose:
+                print(f"VFS загружена из снимка {snapshot_path} за {elapsed:.3f} с (узлов: {count})")
+            return True
+        except Exception as e:
+            print(f"Предупреждение: снимок VFS {snapshot_path} не прочитан: {e}")
+            return False
+
+    def open_journal(self, xml_path):
+        """Воспроизводит журнал изменений поверх загруженного дерева и открывает его для дозаписи
+
+        Операции журнала либо только создают узлы и ничего не делают, если
+        узел уже существует, либо (запись через >) задают итоговое
+        содержимое файла целиком, либо (дозапись >>) сначала обрезают тело
+        до длины перед дозаписью, поэтому повторное воспроизведение записей,
+        уже попавших в XML при прерванном уплотнении, безопасно.
+        """
+        journal_path = xml_path + JOURNAL_SUFFIX
+        replayed = 0
+        valid_size = len(JOURNAL_MAGIC)
+        try:
+            with open(journal_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+
+        if data.startswith(JOURNAL_MAGIC):
+            pos = valid_size
+            while pos + JOURNAL_RECORD.size <= len(data):
+                length, crc, op = JOURNAL_RECORD.unpack_from(data, pos)
+                start = pos + JOURNAL_RECORD.size
+                payload = data[start:start + length]
+                if len(payload) != length or zlib.crc32(payload, op) != crc:
+                    break
+                self._replay(op, payload)
+                replayed += 1
+                pos = valid_size = start + length
+            if valid_size < len(data):
+                print(f"Предупреждение: журнал VFS {journal_path} оборван, "
+                      f"отброшено байт: {len(data) - valid_size}")
+        elif data:
+            print(f"Предупреждение: журнал VFS {journal_path} повреждён и будет пересоздан")
+
+        if data.startswith(JOURNAL_MAGIC):
+            self._journal = open(journal_path, 'r+b')
+            self._journal.truncate(valid_size)
+            self._journal.seek(valid_size)
+        else:
+            self._journal = open(journal_path, 'wb')
+            self._journal.write(JOURNAL_MAGIC)
+            self._journal.flush()
+        self._journal_records = replayed
+        if replayed and self.verbose:
+            print(f"Журнал VFS: воспроизведено изменений: {replayed}")
+
+    def _replay(self, op, payload):
+        """Применяет одну запись журнала к дереву"""
+        fields = []
+        pos = 0
+        while pos < len(payload):
+            (length,) = JOURNAL_FIELD.unpack_from(payload, pos)
+            pos += JOURNAL_FIELD.size
+            fields.append(payload[pos:pos + length])
+            pos += length
+
+        if op == JOURNAL_MKDIR:
+            self._add_node(fields[0].decode('utf-8', 'surrogatepass'), DirNode())
+        elif op == JOURNAL_CREATE:
+            self._add_file(fields[0].decode('utf-8', 'surrogatepass'), fields[1])
+        elif op == JOURNAL_COPY:
+            self._copy(fields[0].decode('utf-8', 'surrogatepass'),
+                       fields[1].decode('utf-8', 'surrogatepass'))
+        elif op == JOURNAL_COPY_TREE:
+            self._copy_tree(fields[0].decode('utf-8', 'surrogatepass'),
+                            fields[1].decode('utf-8', 'surrogatepass'))
+        elif op == JOURNAL_WRITE:
+            path = fields[0].decode('utf-8', 'surrogatepass')
+            if not self._replace_file(path, fields[1]):
+                self._add_file(path, fields[1])
+        elif op == JOURNAL_APPEND:
+            path = fields[0].decode('utf-8', 'surrogatepass')
+            (length,) = JOURNAL_LENGTH.unpack(fields[1])
+            node = self._lookup(self.normalize_path(path))
+            head = bytes(node.content[:length]) if type(node) is FileNode else b""
+            if not self._replace_file(path, head + fields[2]):
+                self._add_file(path, head + fields[2])
+
+    def _log(self, op, *fields):
+        """Дописывает изменение в журнал (стоимость зависит только от размера изменения)"""
+        if self._journal is None:
+            return
+
+        payload = bytearray()
+        for field in fields:
+            # Пути - строки, содержимое файлов - уже байты
+            encoded = field.encode('utf-8', 'surrogatepass') if isinstance(field, str) else field
+            payload += JOURNAL_FIELD.pack(len(encoded))
+            payload += encoded
+        self._journal.write(JOURNAL_RECORD.pack(len(payload), zlib.crc32(payload, op), op))
+        self._journal.write(payload)
+        self._journal.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(self._journal.fileno())
+
+        self._journal_records += 1
+        if self._journal_records >= JOURNAL_COMPACT_RECORDS:
+            self.compact()
+
+    def compact(self):
+        """Уплотняет журнал: переписывает XML (и снимок) и очищает журнал
+
+        Порядок важен для восстановления после сбоя: сначала атомарно
+        подменяется XML, затем снимок, и только потом очищается журнал.
+        """
+        if self._journal is None:
+            return False
+
+        with self._lock:
+            self.save_to_xml(self.xml_path)
+            if self.snapshot:
+                stats = self.load_stats
+                self.save_snapshot(self.xml_path, stats.get("xml_seconds", stats.get("seconds", 0.0)))
+            self._journal.seek(len(JOURNAL_MAGIC))
+            self._journal.truncate()
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal_records = 0
+        return True
+
+    def save_to_xml(self, xml_path):
+        """Записывает дерево в XML файл (через временный файл и атомарную подмену)"""
+        tmp_path = xml_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<vfs>\n')
+            # Стек итераторов по детям открытых директорий
+            stack = [iter(self._children(self.root).items())]
+            while stack:
+                entry = next(stack[-1], None)
+                if entry is None:
+                    stack.pop()
+                    if stack:
+                        f.write("    " * len(stack) + "</directory>\n")
+                    continue
+
+                indent = "    " * len(stack)
+                name, node = entry
+                name = escape(name, {'"': "&quot;"})
+                if type(node) is DirNode:
+                    if type(node.offset) is HostDir:
+                        continue  # Монтирования не сохраняются
+                    f.write(f'{indent}<directory name="{name}">\n')
+                    stack.append(iter(self._children(node).items()))
+                else:
+                    # Текст пишется как есть, двоичные данные - в base64
+                    body = self.body(node)
                     try:
-                        content = base64.b64decode(content).decode('utf-8')
-                    except:
-                        content = child.text or ""
-                
-                result[name] = {
-                    "type": "file",
-                    "content": content
-                }
+                        text = str(body, 'utf-8')
+                    except UnicodeDecodeError:
+                        text = None
+                    if text is None or XML_UNSAFE_TEXT.search(text):
+                        encoded = base64.b64encode(body).decode('ascii')
+                        f.write(f'{indent}<file name="{name}" encoding="base64">{encoded}</file>\n')
+                    else:
+                        f.write(f'{indent}<file name="{name}">{escape(text)}</file>\n')
+            f.write('</vfs>\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, xml_path)
+
+    def _children(self, node):
+        """Возвращает детей директории, при необходимости разбирая её поддерево"""
+        offset = node.offset
+        if offset is None:
+            return node.children
+        if type(offset) is HostDir:
+            return self._host_children(node, offset)
+        # Одну директорию могут одновременно встретить читатели версий из других потоков
+        with self._lock:
+            children = node.children
+            if children is None:
+                children = node.children = self._load_span(offset)
+                node.offset = None
+        return children
+
+    def _host_children(self, node, source):
+        """Дети смонтированной директории реальной ОС
+
+        Записи читаются через os.scandir при первом обращении и читаются
+        заново, когда меняется mtime директории; узлы уже известных
+        записей при этом сохраняются. Символьные ссылки на директории
+        не раскрываются (от циклов), на файлы - раскрываются.
+        """
+        try:
+            mtime = os.stat(source.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        children = node.children
+        if children is not None and mtime == source.mtime:
+            return children
         
-        return result
-    
+        with self._lock:
+            old = children or {}
+            children = {}
+            if mtime is not None:
+                try:
+                    with os.scandir(source.path) as scan:
+                        for entry in scan:
+                            name = intern(entry.name)
+                            child = old.get(name)
+                            if entry.is_dir(follow_symlinks=False):
+                                if type(child) is not DirNode:
+                                    child = DirNode(offset=HostDir(entry.path, source.mount))
+                            elif entry.is_file():
+                                if type(child) is FileNode:
+                                    child.content.size = None  # Размер мог измениться
+                                else:
+                                    child = FileNode(HostFile(entry.path, source.mount))
+                            else:
+                                continue
+                            children[name] = child
+                except OSError:
+                    pass
+            node.children = children
+            node.order = None
+            if source.mtime is not None:
+                # Записи изменились: итоги du могли устареть
+                self._forget_totals(source.vfs_path())
+            source.mtime = mtime
+        return children
+
+    def _forget_totals(self, path):
+        """Отмечает итоги директории path и всех её предков неизвестными"""
+        node = self.root
+        parts = iter(self.get_path_parts(path))
+        while type(node) is DirNode:
+            node.size = node.count = None
+            part = next(parts, None)
+            if part is None or node.children is None:
+                break
+            node = node.children.get(part)
+
+    def body(self, node):
+        """Тело файла FileNode (None, если файл смонтированной директории исчез)
+
+        Тело файла реальной ОС читается при обращении: небольшое - через
+        read с кешем, который проверяется по mtime, большое - отображается
+        через mmap без чтения целиком.
+        """
+        content = node.content
+        if type(content) is not HostFile:
+            return content
+        
+        try:
+            st = os.stat(content.path)
+        except OSError:
+            return None
+        if content.size is not None and st.st_size != content.size:
+            # Файл изменился на месте: итоги du его директории устарели
+            self._forget_totals(HostDir(content.path, content.mount).vfs_path().rpartition("/")[0] or "/")
+        content.size = st.st_size
+        
+        cache = self._host_bodies
+        cached = cache.get(content)
+        if cached is not None and cached[0] == st.st_mtime_ns and len(cached[1]) == st.st_size:
+            cache.move_to_end(content)
+            return cached[1]
+        try:
+            with open(content.path, 'rb') as f:
+                if st.st_size >= HOST_ZERO_COPY_MIN:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        
+        with self._lock:
+            if cached is not None:
+                self._host_bodies_size -= len(cached[1])
+            cache[content] = (st.st_mtime_ns, data)
+            self._host_bodies_size += len(data)
+            while self._host_bodies_size > HOST_BODY_CACHE_SIZE:
+                _, (_, evicted) = cache.popitem(last=False)
+                self._host_bodies_size -= len(evicted)
+        return data
+
+    def _mount_of(self, path):
+        """Путь VFS монтирования, внутри которого лежит нормализованный path, или None"""
+        for mount_path in self.mounts:
+            if path == mount_path or path.startswith(mount_path + "/"):
+                return mount_path
+        return None
+
+    def mount(self, host_path, path):
+        """Монтирует директорию реальной ОС host_path в новую или пустую директорию VFS path
+
+        Ничего не читается заранее: записи директорий читаются, когда до
+        них впервые доходят get_node или list_directory, тела файлов - при
+        обращении. Монтирование доступно только для чтения и не попадает
+        в XML, снимок и журнал; cp -r из него копирует данные в VFS.
+        """
+        host_path = os.path.abspath(host_path)
+        path = self.normalize_path(path)
+        if not os.path.isdir(host_path) or path == "/":
+            return False
+        
+        with self._writing():
+            if self._mount_of(path) is not None:
+                return False
+            source = HostDir(host_path, (host_path, path))
+            node = self._lookup(path)
+            if node is None:
+                if not self._add_node(path, DirNode(offset=source)):
+                    return False
+            elif type(node) is DirNode and not self._children(node) and not any(
+                    mount_path.startswith(path + "/") for mount_path in self.mounts):
+                node = self._mutable_dir(path)
+                node.children = node.order = None
+                node.offset = source
+                self._update_totals(path, None, None)
+                self._invalidate(path, node)
+            else:
+                return False
+            self.mounts[path] = host_path
+            return True
+
     def get_path_parts(self, path):
         """Разбивает путь на части"""
         if path == "/":
             return []
         return [part for part in path.split("/") if part]
     
-    def get_node(self, path):
-        """Получает узел по пути"""
+    def normalize_path(self, path, cwd="/"):
+        """Приводит путь к абсолютному виду
+
+        Относительные пути разрешаются от cwd, '.' и повторные '/'
+        отбрасываются, '..' поднимается на уровень выше (выше корня - остаётся в корне).
+        """
+        if not path.startswith("/"):
+            path = cwd + "/" + path
+        elif "//" not in path and "/." not in path and (path == "/" or path[-1] != "/"):
+            return path  # Уже нормализован
+        
+        parts = []
+        for part in path.split("/"):
+            if not part or part == ".":
+                continue
+            if part == "..":
+                if parts:
+                    parts.pop()
+            else:
+                parts.append(part)
+        
+        return "/" + "/".join(parts)
+    
+    def _lookup(self, path):
+        """Возвращает узел (файл или директорию) по нормализованному пути или None
+
+        Результаты хранятся в ограниченном LRU кеше путь -> узел. Найденные
+        узлы остаются верными, пока их не удалили, а отрицательные
+        результаты действительны только до следующего изменения дерева.
+        Пути внутри смонтированных директорий не кешируются (см. _host_lookup).
+        """
+        if self.mounts:
+            mount_path = self._mount_of(path)
+            if mount_path is not None and mount_path != path:
+                return self._host_lookup(mount_path, path)
+        
+        cache = self._resolve_cache
+        entry = cache.get(path)
+        if entry is not None:
+            node, generation = entry
+            if node is not None or generation == self._generation:
+                cache.move_to_end(path)
+                return node
+        
         if path == "/":
             return self.root
         
-        parts = self.get_path_parts(path)
-        current = self.root
+        # Ищем ближайшего предка, который уже есть в кеше
+        node = self.root
+        end = len(path)
+        while True:
+            end = path.rfind("/", 0, end)
+            if end <= 0:
+                end = 0
+                break
+            entry = cache.get(path[:end])
+            if entry is not None and entry[0] is not None:
+                node = entry[0]
+                break
+        
+        # Спускаемся от него, запоминая каждую промежуточную директорию
+        prefix = path[:end]
+        for part in path[end + 1:].split("/"):
+            if type(node) is not DirNode:
+                node = None
+                break
+            node = self._children(node).get(part)
+            prefix = prefix + "/" + part
+            if node is not None:
+                self._cache_put(prefix, node)
         
-        for part in parts:
-            if part not in current or current[part]["type"] != "directory":
+        if node is None:
+            self._cache_put(path, None)
+        return node
+    
+    def _cache_put(self, path, node):
+        """Добавляет результат разрешения пути в LRU кеш"""
+        if not self.cache_size:
+            return
+        cache = self._resolve_cache
+        cache[path] = (node, self._generation)
+        cache.move_to_end(path)
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+    
+    def _host_lookup(self, mount_path, path):
+        """Разрешает путь внутри монтирования mount_path без кеша путей
+
+        Каталоги реальной ОС меняются без ведома VFS, поэтому на каждом
+        шаге _children сверяет mtime директории и при изменении перечитывает
+        её: новые файлы находятся сразу, удалённые перестают разрешаться.
+        """
+        node = self._lookup(mount_path)
+        for part in path[len(mount_path) + 1:].split("/"):
+            if type(node) is not DirNode:
                 return None
-            current = current[part]["children"]
-        
-        return current
+            node = self._children(node).get(part)
+            if node is None:
+                return None
+        return node
+    
+    def _invalidate(self, path, node=None):
+        """Отмечает изменение дерева по пути path
+
+        Все отрицательные результаты в кеше устаревают, а для path
+        сразу запоминается новый узел.
+        """
+        self._generation += 1
+        self._resolve_cache.pop(path, None)
+        if node is not None:
+            self._cache_put(path, node)
+    
+    def _split_parent(self, path):
+        """Возвращает (путь родителя, имя) для абсолютного пути"""
+        path = self.normalize_path(path)
+        if path == "/":
+            return None, None
+        parent_path, _, name = path.rpartition("/")
+        return parent_path or "/", name
+    
+    def get_node(self, path):
+        """Получает узел директории по пути"""
+        node = self._lookup(self.normalize_path(path))
+        if type(node) is not DirNode:
+            return None
+        return node
     
     def get_parent_node(self, path):
         """Получает родительский узел"""
-        if path == "/":
+        parent_path, _ = self._split_parent(path)
+        if parent_path is None:
             return None
-        
-        parts = self.get_path_parts(path)
-        if len(parts) <= 1:
-            return self.root
-        
-        parent_path = "/" + "/".join(parts[:-1])
         return self.get_node(parent_path)
     
-    def list_directory(self, path="/"):
-        """Список содержимого директории"""
+    def list_directory(self, path="/", long=False, offset=0, limit=None):
+        """Содержимое директории: ленивый итератор записей или None, если её нет
+
+        Запись - пара (имя, директория ли); с long=True к ней добавляются
+        размер в байтах и число узлов (для директории - итоги поддерева).
+        Сначала идут директории, затем файлы, каждые по имени; offset и
+        limit выбирают страницу без обхода пропущенных записей.
+        """
         node = self.get_node(path)
-        if not node:
+        if node is None:
+            return None
+        return self._iter_order(node, long, offset, limit)
+    
+    def _order(self, node):
+        """Возвращает порядок имён директории, строя его при первом просмотре"""
+        if type(node.offset) is HostDir:
+            self._children(node)  # Смонтированная директория могла измениться на диске
+        order = node.order
+        if order is None:
+            children = self._children(node)
+            order = node.order = (
+                sorted(name for name, child in children.items() if type(child) is DirNode),
+                sorted(name for name, child in children.items() if type(child) is not DirNode))
+        return order
+    
+    def _iter_order(self, node, long, offset, limit):
+        """Отдаёт записи директории из её отсортированного порядка имён"""
+        dirs, files = self._order(node)
+        children = node.children
+        total = len(dirs) + len(files)
+        end = total if limit is None else min(total, offset + limit)
+        for index in range(offset, end):
+            is_dir = index < len(dirs)
+            name = dirs[index] if is_dir else files[index - len(dirs)]
+            if long:
+                yield (name, is_dir, *self._usage(children[name]))
+            else:
+                yield name, is_dir
+    
+    def _usage(self, node):
+        """Возвращает (байт, узлов) для узла; итоги директории подсчитываются при необходимости"""
+        if type(node) is not DirNode:
+            return len(node.content), 1
+        if type(node.offset) is HostDir:
+            self._children(node)
+        if node.size is None:
+            self._fill_totals(node)
+        return node.size, node.count
+    
+    def _fill_totals(self, node):
+        """Подсчитывает неизвестные итоги поддерева (ленивый режим) обходом в глубину"""
+        stack = [(node, False)]
+        while stack:
+            directory, ready = stack.pop()
+            children = self._children(directory)
+            if not ready:
+                stack.append((directory, True))
+                stack.extend((child, False) for child in children.values()
+                             if type(child) is DirNode and child.size is None)
+                continue
+            size = count = 0
+            for child in children.values():
+                if type(child) is DirNode:
+                    size += child.size
+                    count += child.count + 1
+                else:
+                    size += len(child.content)
+                    count += 1
+            # size последним: по нему читатели судят, что итоги готовы
+            directory.count = count
+            directory.size = size
+    
+    def usage(self, path):
+        """Возвращает (байт, узлов) для файла или поддерева директории path или None
+
+        После загрузки итоги хранятся в директориях, поэтому это O(1).
+        """
+        node = self._lookup(self.normalize_path(path))
+        if node is None:
             return None
+        return self._usage(node)
+    
+    def walk_usage(self, path):
+        """Директории под path с размерами поддеревьев в порядке du: пары
+        (путь относительно path, байт), поддиректории раньше родителя"""
+        node = self._lookup(self.normalize_path(path))
+        if type(node) is not DirNode:
+            return
+        self._usage(node)
         
-        items = []
-        for name, item in node.items():
-            items.append({
-                "name": name,
-                "type": item["type"]
-            })
+        stack = [("", node, iter(sorted(self._children(node).items())))]
+        while stack:
+            prefix, directory, items = stack[-1]
+            entry = next(items, None)
+            if entry is None:
+                stack.pop()
+                yield prefix, directory.size
+                continue
+            name, child = entry
+            if type(child) is DirNode:
+                stack.append((f"{prefix}/{name}", child, iter(sorted(self._children(child).items()))))
+    
+    def walk_files(self, path):
+        """Файлы под path в порядке имён: пары (путь относительно path, узел FileNode)
+
+        Путь самого path - пустая строка, остальные начинаются с '/'.
+        """
+        node = self._lookup(self.normalize_path(path))
+        if type(node) is FileNode:
+            yield "", node
+            return
+        if node is None:
+            return
         
-        return sorted(items, key=lambda x: (x["type"], x["name"]))
+        # Стек (префикс, итератор по отсортированным детям)
+        stack = [("", iter(sorted(self._children(node).items())))]
+        while stack:
+            prefix, items = stack[-1]
+            entry = next(items, None)
+            if entry is None:
+                stack.pop()
+                continue
+            name, child = entry
+            if type(child) is DirNode:
+                stack.append((f"{prefix}/{name}", iter(sorted(self._children(child).items()))))
+            else:
+                yield f"{prefix}/{name}", child
     
-    def get_file_content(self, path):
-        """Получает содержимое файла"""
-        parts = self.get_path_parts(path)
-        if not parts:
+    def trigram_index(self):
+        """Возвращает триграммный индекс тел файлов, строя его при первом обращении
+
+        Дальше индекс обновляется при создании, копировании и замене файлов.
+        """
+        if self._trigrams is None:
+            index = TrigramIndex()
+            seen = set()
+            stack = [self.root]
+            with gc_paused():
+                while stack:
+                    for child in self._children(stack.pop()).values():
+                        if type(child) is DirNode:
+                            # Файлы смонтированных директорий не индексируются
+                            if type(child.offset) is not HostDir:
+                                stack.append(child)
+                        elif child not in seen:
+                            # После cp -r один узел бывает доступен по нескольким путям
+                            seen.add(child)
+                            index.add(child)
+            self._trigrams = index
+        return self._trigrams
+    
+    def name_index(self):
+        """Возвращает индекс имён, строя его при первом обращении
+
+        Дальше индекс обновляется при создании и копировании узлов.
+        """
+        if self._names is None:
+            self._names = NameIndex()
+            with gc_paused():
+                for name, node in self._children(self.root).items():
+                    self._index_names("/", name, node)
+                self._names.sort()
+        return self._names
+    
+    def _index_names(self, parent_path, name, node):
+        """Добавляет узел и (для директории) всё его поддерево в индекс имён"""
+        index = self._names
+        index.add(parent_path, name, type(node) is DirNode)
+        if type(node) is not DirNode or type(node.offset) is HostDir:
+            return  # Содержимое смонтированных директорий find обходит сам
+        
+        # После cp -r поддерево общее с источником, но его пути новые
+        stack = [(parent_path.rstrip("/") + "/" + name, node)]
+        while stack:
+            path, directory = stack.pop()
+            for child_name, child in self._children(directory).items():
+                is_dir = type(child) is DirNode
+                index.add(path, child_name, is_dir)
+                if is_dir and type(child.offset) is not HostDir:
+                    stack.append((path + "/" + child_name, child))
+    
+    def find(self, path, pattern="*", kind=None):
+        """Отсортированные пути узлов под path (включая сам path), чьи имена подходят под шаблон
+
+        kind - "f" (только файлы), "d" (только директории) или None.
+        Возвращает None, если path не существует.
+        """
+        path = self.normalize_path(path)
+        node = self._lookup(path)
+        if node is None:
             return None
         
-        filename = parts[-1]
-        parent_path = "/" + "/".join(parts[:-1]) if len(parts) > 1 else "/"
+        results = []
+        own_name = path.rpartition("/")[2]
+        if own_name and fnmatchcase(own_name, pattern) and (kind is None or (kind == "d") == (type(node) is DirNode)):
+            results.append(path)
+        if type(node) is not DirNode:
+            return results
         
-        parent_node = self.get_node(parent_path)
-        if not parent_node or filename not in parent_node:
-            return None
+        base = path.rstrip("/") + "/"
+        if self._mount_of(path) is None:
+            for parent, name, is_dir in self.name_index().entries(pattern):
+                if kind is not None and (kind == "d") != is_dir:
+                    continue
+                if parent == path or parent.startswith(base):
+                    results.append(parent.rstrip("/") + "/" + name)
+            mounts = [(mount_path, self._lookup(mount_path)) for mount_path in self.mounts
+                      if mount_path.startswith(base)]
+        else:
+            mounts = [(path, node)]
         
-        file_node = parent_node[filename]
-        if file_node["type"] != "file":
+        # Смонтированные директории не входят в индекс имён и обходятся напрямую
+        stack = [(parent, directory) for parent, directory in mounts if type(directory) is DirNode]
+        while stack:
+            parent, directory = stack.pop()
+            for name, child in self._children(directory).items():
+                is_dir = type(child) is DirNode
+                child_path = parent.rstrip("/") + "/" + name
+                if fnmatchcase(name, pattern) and (kind is None or (kind == "d") == is_dir):
+                    results.append(child_path)
+                if is_dir:
+                    stack.append((child_path, child))
+        results.sort()
+        return results
+    
+    def get_file_content(self, path):
+        """Получает содержимое файла"""
+        file_node = self._lookup(self.normalize_path(path))
+        if type(file_node) is not FileNode:
             return None
         
-        return file_node["content"]
+        return self.body(file_node)
     
-    def create_directory(self, path):
-        """Создает директорию"""
-        parts = self.get_path_parts(path)
-        if not parts:
-            return False
+    def stats(self):
+        """Возвращает статистику хранения тел файлов
+
+        Логический размер - сумма размеров всех файлов дерева, физический -
+        сумма размеров различных буферов, реально занятых телами. В ленивом
+        режиме учитываются только уже разобранные директории.
+        """
+        files = 0
+        logical = 0
+        physical = 0
+        seen = set()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.children is None:
+                continue
+            for child in node.children.values():
+                if type(child) is DirNode:
+                    if type(child.offset) is not HostDir:  # Тела монтирований не хранятся в VFS
+                        stack.append(child)
+                    continue
+                files += 1
+                logical += len(child.content)
+                if id(child.content) not in seen:
+                    seen.add(id(child.content))
+                    physical += len(child.content)
         
-        dirname = parts[-1]
-        parent_path = "/" + "/".join(parts[:-1]) if len(parts) > 1 else "/"
+        return {
+            "files": files,
+            "unique_blobs": len(self.blobs),
+            "logical_size": logical,
+            "physical_size": physical,
+            "dedup_ratio": logical / physical if physical else 1.0
+        }
+    
+    def _mutable_dir(self, path):
+        """Получает директорию по пути для изменения (копирование при записи)
+
+        Разделяемые директории на пути от корня заменяются в уже
+        собственных родителях неглубокими копиями, так что изменение
+        не видно через другие копии поддерева.
+        """
+        if not self._cow:
+            return self.get_node(path)
         
-        parent_node = self.get_node(parent_path)
-        if not parent_node:
+        node = self.root
+        cloned = False
+        if node.shared:
+            node = self.root = self._clone(node)
+            cloned = True
+        for part in self.get_path_parts(self.normalize_path(path)):
+            children = self._children(node)
+            child = children.get(part)
+            if type(child) is not DirNode:
+                return None
+            if child.shared:
+                child = children[part] = self._clone(child)
+                cloned = True
+            node = child
+        
+        if cloned:
+            # Закешированные пути могут указывать на заменённые узлы
+            self._resolve_cache.clear()
+        return node
+    
+    def _clone(self, node):
+        """Возвращает собственную копию разделяемой директории
+
+        Копируется только словарь детей этой директории. Пока словарь
+        делят другие копии cp -r, вложенные директории остаются общими и
+        получают ещё одного владельца, а тела файлов - по ссылке от копии
+        (их можно будет заменить через > независимо от источника).
+        Последний владелец словаря, как и директория опубликованной
+        версии, в живом дереве его больше не делит: дети только
+        замораживаются, а ссылки на тела переходят к копии.
+        """
+        children = dict(self._children(node))
+        sharing = node.shared
+        copied = type(sharing) is SharedChildren and sharing.owners > 1
+        if copied:
+            sharing.owners -= 1
+        shared_files = self._shared_files
+        for child in children.values():
+            if type(child) is DirNode:
+                if not copied:
+                    if not child.shared:
+                        child.shared = FROZEN
+                elif type(child.shared) is SharedChildren:
+                    child.shared.owners += 1
+                else:
+                    child.shared = SharedChildren(2)
+            elif copied:
+                self.blobs.add(child.content)
+                shared_files[child] = shared_files.get(child, 1) + 1
+        order = None if node.order is None else (list(node.order[0]), list(node.order[1]))
+        return DirNode(children, size=node.size, count=node.count, order=order)
+    
+    def _add_node(self, path, node):
+        """Добавляет узел по пути, если родитель существует, а имя свободно"""
+        parent_path, name = self._split_parent(path)
+        if parent_path is None or self._mount_of(parent_path) is not None:
+            return False  # Смонтированные директории только для чтения
+        
+        parent_node = self._mutable_dir(parent_path)
+        if parent_node is None:
             return False
         
-        if dirname in parent_node:
+        children = self._children(parent_node)
+        if name in children:
             return False  # Уже существует
         
-        parent_node[dirname] = {
-            "type": "directory",
-            "children": {}
-        }
+        name = intern(name)
+        children[name] = node
+        if parent_node.order is not None:
+            insort(parent_node.order[type(node) is not DirNode], name)
+        self._invalidate(parent_path.rstrip("/") + "/" + name, node)
+        if type(node) is DirNode:
+            self._update_totals(parent_path, node.size, None if node.count is None else node.count + 1)
+        else:
+            self._update_totals(parent_path, len(node.content), 1)
+        if self._names is not None:
+            self._index_names(parent_path, name, node)
         return True
     
-    def create_file(self, path, content=""):
-        """Создает файл"""
-        parts = self.get_path_parts(path)
-        if not parts:
+    def _update_totals(self, path, size, count):
+        """Добавляет size байт и count узлов к итогам директории path и всех её предков
+
+        Директории на пути уже собственные (см. _mutable_dir). Если итоги
+        добавленного поддерева неизвестны (size равен None), неизвестными
+        становятся и итоги предков.
+        """
+        node = self.root
+        parts = iter(self.get_path_parts(path))
+        while node is not None:
+            if node.size is not None:
+                if size is None:
+                    node.size = node.count = None
+                else:
+                    node.size += size
+                    node.count += count
+            part = next(parts, None)
+            node = None if part is None else node.children[part]
+    
+    @contextmanager
+    def _writing(self):
+        """Изменение дерева: писатели по очереди, в конце публикуется новая версия"""
+        with self._lock:
+            self._write_depth += 1
+            try:
+                yield
+            finally:
+                self._write_depth -= 1
+            published = self._published
+            if not self._write_depth and published is not None and published.version != self._generation:
+                self._publish()
+    
+    def _publish(self):
+        """Делает текущее дерево версией для читателей
+
+        Корень замораживается, поэтому следующее изменение скопирует
+        директории на пути от корня (см. _mutable_dir), а не поменяет их
+        на месте; остальное дерево остаётся общим с версией.
+        """
+        root = self.root
+        if not root.shared:
+            root.shared = FROZEN
+        self._cow = True
+        self._published = VFSVersion(self, root, self._generation)
+    
+    def version(self):
+        """Последняя опубликованная версия дерева для чтения из любого потока
+
+        Версия неизменяема: изменения после её получения создают новую
+        версию, а не правят узлы старой, поэтому чтение не ждёт писателей
+        и никогда не видит наполовину выполненную операцию. Первый вызов
+        включает публикацию версий после каждого изменения.
+        """
+        published = self._published
+        if published is None:
+            with self._lock:
+                if self._published is None:
+                    self._publish()
+                published = self._published
+        return published
+    
+    def create_directory(self, path):
+        """Создает директорию"""
+        with self._writing():
+            if not self._add_node(path, DirNode()):
+                return False
+            self._log(JOURNAL_MKDIR, self.normalize_path(path))
+            return True
+    
+    def create_file(self, path, content=b""):
+        """Создает файл (строковое содержимое сохраняется в UTF-8)"""
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        with self._writing():
+            if not self._add_file(path, content):
+                return False
+            self._log(JOURNAL_CREATE, self.normalize_path(path), content)
+            return True
+    
+    def write_file(self, path, content=b"", append=False):
+        """Записывает файл целиком или дописывает в конец (перенаправление > и >>)
+
+        Несуществующий файл создаётся через create_file. В журнал пишется
+        итоговое содержимое, а для дозаписи - длина тела до неё и дописанные
+        байты, поэтому воспроизведение идемпотентно, а размер записи журнала
+        зависит только от размера изменения.
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        path = self.normalize_path(path)
+        with self._writing():
+            node = self._lookup(path)
+            if node is None:
+                return self.create_file(path, content)
+            if type(node) is not FileNode or self._mount_of(path) is not None:
+                return False
+            
+            if append:
+                length = len(node.content)
+                if not self._replace_file(path, bytes(node.content) + content):
+                    return False
+                self._log(JOURNAL_APPEND, path, JOURNAL_LENGTH.pack(length), content)
+                return True
+            if not self._replace_file(path, content):
+                return False
+            self._log(JOURNAL_WRITE, path, content)
+            return True
+    
+    def _replace_file(self, path, content):
+        """Заменяет тело существующего файла без записи в журнал"""
+        parent_path, name = self._split_parent(path)
+        if parent_path is None or self._mount_of(parent_path) is not None:
             return False
         
-        filename = parts[-1]
-        parent_path = "/" + "/".join(parts[:-1]) if len(parts) > 1 else "/"
-        
-        parent_node = self.get_node(parent_path)
-        if not parent_node:
+        parent_node = self._mutable_dir(parent_path)
+        if parent_node is None:
             return False
         
-        if filename in parent_node:
-            return False  # Уже существует
+        children = self._children(parent_node)
+        old = children.get(name)
+        if type(old) is not FileNode:
+            return False
         
-        parent_node[filename] = {
-            "type": "file",
-            "content": content
-        }
+        node = children[name] = FileNode(self.blobs.add(content))
+        self.blobs.release(old.content)
+        self._invalidate(parent_path.rstrip("/") + "/" + name, node)
+        self._update_totals(parent_path, len(node.content) - len(old.content), 0)
+        # После cp -r старый узел может остаться в другой копии директории
+        places = self._shared_files.pop(old, 1)
+        if places > 2:
+            self._shared_files[old] = places - 1
+        if self._trigrams is not None:
+            if places == 1:
+                self._trigrams.discard(old)
+            self._trigrams.add(node)
         return True
     
     def copy_file(self, src_path, dst_path):
         """Копирует файл"""
+        with self._writing():
+            if not self._copy(src_path, dst_path):
+                return False
+            if self._mount_of(self.normalize_path(src_path)) is not None:
+                self._log_tree(self.normalize_path(dst_path))
+                return True
+            # В журнал пишутся только пути, а не содержимое
+            self._log(JOURNAL_COPY, self.normalize_path(src_path), self.normalize_path(dst_path))
+            return True
+    
+    def _copy(self, src_path, dst_path):
+        """Копирует файл без записи в журнал"""
         content = self.get_file_content(src_path)
         if content is None:
             return False
         
-        return self.create_file(dst_path, content)
+        return self._add_file(dst_path, content)
+    
+    def _add_file(self, path, content):
+        """Создает файл с телом из хранилища, не оставляя лишней ссылки при неудаче"""
+        if type(content) is mmap.mmap:
+            # Большой файл смонтированной директории: в VFS копируются сами байты
+            with content:
+                content = content[:]
+        node = FileNode(self.blobs.add(content))
+        if self._add_node(path, node):
+            if self._trigrams is not None:
+                self._trigrams.add(node)
+            return True
+        self.blobs.release(node.content)
+        return False
+    
+    def copy_tree(self, src_path, dst_path):
+        """Рекурсивно копирует файл или директорию (cp -r)
+
+        Копия директории разделяет с источником словарь детей и тела
+        файлов; реальное копирование происходит только при изменении
+        одной из сторон и только для изменяемых директорий.
+        """
+        with self._writing():
+            if not self._copy_tree(src_path, dst_path):
+                return False
+            if self._mount_of(self.normalize_path(src_path)) is not None:
+                self._log_tree(self.normalize_path(dst_path))
+                return True
+            self._log(JOURNAL_COPY_TREE, self.normalize_path(src_path), self.normalize_path(dst_path))
+            return True
+    
+    def _log_tree(self, path):
+        """Пишет в журнал файл или поддерево path записями MKDIR/CREATE с содержимым
+
+        Так журналируются копии из смонтированных директорий: монтирование
+        не сохраняется, и при воспроизведении источника может не быть или
+        он может измениться.
+        """
+        node = self._lookup(path)
+        if type(node) is FileNode:
+            self._log(JOURNAL_CREATE, path, node.content)
+            return
+        self._log(JOURNAL_MKDIR, path)
+        stack = [(path, node)]
+        while stack:
+            parent, directory = stack.pop()
+            for name, child in self._children(directory).items():
+                child_path = parent.rstrip("/") + "/" + name
+                if type(child) is DirNode:
+                    self._log(JOURNAL_MKDIR, child_path)
+                    stack.append((child_path, child))
+                else:
+                    self._log(JOURNAL_CREATE, child_path, child.content)
+    
+    def _copy_tree(self, src_path, dst_path):
+        """Рекурсивно копирует без записи в журнал"""
+        src_path = self.normalize_path(src_path)
+        dst_path = self.normalize_path(dst_path)
+        node = self._lookup(src_path)
+        if type(node) is FileNode:
+            content = self.body(node)
+            return content is not None and self._add_file(dst_path, content)
+        if node is None:
+            return False
+        
+        # Нельзя скопировать директорию внутрь самой себя
+        if dst_path == src_path or dst_path.startswith(src_path.rstrip("/") + "/"):
+            return False
+        if self._mount_of(src_path) is not None:
+            return self._import_tree(node, dst_path)
+        if any(mount_path.startswith(src_path.rstrip("/") + "/") for mount_path in self.mounts):
+            return False  # Монтирование внутри копии делило бы источник
+        
+        # Словарь детей и порядок имён общие, пока одна из сторон не изменится
+        copy = DirNode(self._children(node), size=node.size, count=node.count, order=node.order)
+        if not self._add_node(dst_path, copy):
+            return False
+        # Отметку берём после _add_node: копирование родителей могло её изменить
+        sharing = node.shared if type(node.shared) is SharedChildren else SharedChildren(1)
+        sharing.owners += 1
+        node.shared = copy.shared = sharing
+        self._cow = True
+        return True
+    
+    def _import_tree(self, node, dst_path):
+        """Копирует поддерево смонтированной директории в VFS (cp -r из монтирования)
+
+        Директории и тела файлов читаются с диска и становятся обычными
+        узлами VFS; итоги поддерева подсчитываются по ходу обхода.
+        """
+        copy = DirNode({})
+        stack = [(node, copy, False)]
+        while stack:
+            source, target, ready = stack.pop()
+            if ready:
+                target.size = sum(child.size if type(child) is DirNode else len(child.content)
+                                  for child in target.children.values())
+                target.count = sum(child.count + 1 if type(child) is DirNode else 1
+                                   for child in target.children.values())
+                continue
+            stack.append((source, target, True))
+            for name, child in self._children(source).items():
+                if type(child) is DirNode:
+                    child_copy = target.children[name] = DirNode({})
+                    stack.append((child, child_copy, False))
+                    continue
+                content = self.body(child)
+                if content is None:
+                    continue  # Файл исчез во время обхода
+                if type(content) is mmap.mmap:
+                    with content:
+                        content = content[:]
+                target.children[name] = FileNode(self.blobs.add(content))
+        
+        if not self._add_node(dst_path, copy):
+            stack = [copy]
+            while stack:
+                for child in stack.pop().children.values():
+                    if type(child) is DirNode:
+                        stack.append(child)
+                    else:
+                        self.blobs.release(child.content)
+            return False
+        if self._trigrams is not None:
+            stack = [copy]
+            while stack:
+                for child in stack.pop().children.values():
+                    if type(child) is DirNode:
+                        stack.append(child)
+                    else:
+                        self._trigrams.add(child)
+        return True
+
+
+class VFSVersion:
+    """Неизменяемая версия дерева VFS (см. VFS.version)
+
+    Читает дерево от своего корня без общего кеша путей VFS, поэтому
+    безопасна для параллельного чтения из нескольких потоков, пока
+    другие потоки меняют VFS. version - поколение дерева при публикации.
+    """
+    __slots__ = ("vfs", "root", "version")
+
+    def __init__(self, vfs, root, version):
+        self.vfs = vfs
+        self.root = root
+        self.version = version
+
+    def _lookup(self, path):
+        """Возвращает узел по пути или None"""
+        vfs = self.vfs
+        node = self.root
+        for part in vfs.get_path_parts(vfs.normalize_path(path)):
+            if type(node) is not DirNode:
+                return None
+            node = vfs._children(node).get(part)
+            if node is None:
+                return None
+        return node
+
+    def get_node(self, path):
+        """Получает узел директории по пути"""
+        node = self._lookup(path)
+        return node if type(node) is DirNode else None
+
+    def get_file_content(self, path):
+        """Получает содержимое файла"""
+        node = self._lookup(path)
+        return self.vfs.body(node) if type(node) is FileNode else None
+
+    def list_directory(self, path="/", long=False, offset=0, limit=None):
+        """Содержимое директории в этой версии (как VFS.list_directory)"""
+        node = self.get_node(path)
+        if node is None:
+            return None
+        return self.vfs._iter_order(node, long, offset, limit)
+
+    def usage(self, path):
+        """Возвращает (байт, узлов) для файла или поддерева директории path или None"""
+        node = self._lookup(path)
+        if node is None:
+            return None
+        return self.vfs._usage(node)
+
+
+# Лексемы командной строки: пробелы, '...', "...", экранированный символ,
+# оператор конвейера или перенаправления, слово
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>[ \t\r\n]+)
+  | '(?P<single>[^']*)'
+  | "(?P<double>(?:[^"\\]|\\.)*)"
+  | \\(?P<escaped>.)
+  | (?P<operator>\||>>|>)
+  | (?P<word>[^ \t\r\n'"\\|>]+)
+  | (?P<unclosed>['"])
+  | (?P<backslash>\\)
+""", re.VERBOSE | re.DOTALL)
+# Внутри двойных кавычек обратная косая черта экранирует только $, " и \
+DOUBLE_QUOTE_ESCAPE = re.compile(r'\\([$"\\])')
+# Переменные окружения $VAR и ${VAR}
+VAR_PATTERN = re.compile(r'\$(?:\{([^}]+)\}|([A-Za-z_][A-Za-z0-9_]*))')
+
+
+class Operator(str):
+    """Оператор командной строки (|, >, >>), записанный без кавычек
+
+    Отдельный тип отличает оператор от аргумента с тем же текстом в кавычках.
+    """
+    __slots__ = ()
+
+
+def _expand_var(match):
+    """Подставляет значение переменной окружения (неизвестные остаются как есть)"""
+    value = os.environ.get(match.group(1) or match.group(2))
+    return match.group(0) if value is None else value
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def tokenize_command(command):
+    """Разбирает строку команды в шаблон за один проход
+
+    Возвращает кортеж аргументов. Аргумент без переменных - готовая
+    строка, иначе кортеж частей (текст, раскрывать ли переменные):
+    значения переменных окружения подставляются при каждом выполнении,
+    поэтому кешируется шаблон, а не результат.
+    Кавычки удаляются; в одинарных кавычках переменные не раскрываются.
+    Операторы |, > и >> без кавычек возвращаются как Operator.
+    """
+    tokens = []
+    parts = None
+    for match in TOKEN_PATTERN.finditer(command):
+        kind = match.lastgroup
+        if kind == "space" or kind == "operator":
+            if parts is not None:
+                tokens.append(_finish_token(parts))
+                parts = None
+            if kind == "operator":
+                tokens.append(Operator(match.group(kind)))
+            continue
+        if kind == "unclosed":
+            raise ValueError(f"unterminated quote {match.group(kind)}")
+
+        if parts is None:
+            parts = []
+        if kind == "double":
+            # Чётные элементы - раскрываемый текст, нечётные - экранированные символы
+            for index, piece in enumerate(DOUBLE_QUOTE_ESCAPE.split(match.group(kind))):
+                if piece:
+                    parts.append((piece, index % 2 == 0 and "$" in piece))
+        elif kind == "word":
+            text = match.group(kind)
+            parts.append((text, "$" in text))
+        elif kind == "backslash":
+            parts.append(("\\", False))
+        else:
+            # single и escaped - буквальный текст
+            parts.append((match.group(kind), False))
+
+    if parts is not None:
+        tokens.append(_finish_token(parts))
+    return tuple(tokens)
+
+
+def _finish_token(parts):
+    """Склеивает соседние части аргумента; аргумент без переменных становится строкой"""
+    if not any(expand for _, expand in parts):
+        return "".join(text for text, _ in parts)
+
+    merged = []
+    for text, expand in parts:
+        if merged and merged[-1][1] == expand:
+            merged[-1] = (merged[-1][0] + text, expand)
+        else:
+            merged.append((text, expand))
+    return tuple(merged)
+
+
+def parse_command_line(command):
+    """Разбирает строку команды в список аргументов с раскрытием переменных окружения"""
+    args = []
+    for token in tokenize_command(command):
+        if isinstance(token, str):
+            args.append(token)
+        else:
+            args.append("".join(VAR_PATTERN.sub(_expand_var, text) if expand else text
+                                for text, expand in token))
+    return args
+
+
+# Параллельный grep: процессы создаются через fork и наследуют тела файлов
+# (на платформах без fork grep -P выполняется в одном процессе)
+PARALLEL_START_METHOD = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+# Тела файлов текущего grep -P: (имя, байты), задаётся перед созданием процессов
+_parallel_bodies = None
+
+
+def _grep_task(task):
+    """Задание процесса grep -P: подходящие строки файлов с номерами [start, end) одним блоком"""
+    start, end, pattern, flags, invert, prefixed = task
+    regex = re.compile(pattern, flags)
+    lines = []
+    for filename, content in _parallel_bodies[start:end]:
+        prefix = f"{filename}:".encode('utf-8') if prefixed else b""
+        lines.extend(Shell._grep_lines(regex, iter_chunks(content), invert, prefix))
+    return b"".join(lines)
+
 
 class Shell:
-    def __init__(self, vfs_path=None, startup_script=None):
-        self.username = os.getlogin()
+    def __init__(self, vfs_path=None, startup_script=None, lazy_vfs=False, snapshot=True,
+                 persist=False, quiet=False, output=None, profile=False, vfs=None, mounts=()):
+        try:
+            self.username = os.getlogin()
+        except OSError:
+            # Нет управляющего терминала (CI, cron, docker) - берём имя из окружения
+            self.username = getpass.getuser()
         self.hostname = os.uname().nodename
+        # Весь вывод команд идёт через буферизованный приёмник
+        self.out = output if output is not None else OutputSink()
         self.current_dir = os.getcwd()
         self.home_dir = os.path.expanduser("~")
         
@@ -193,16 +2600,30 @@ class Shell:
         self.config = {
             'vfs_path': vfs_path,
             'startup_script': startup_script,
+            'lazy_vfs': lazy_vfs,
+            'persist': persist,
+            'mounts': list(mounts),
+            'profile': profile,
             'username': self.username,
             'hostname': self.hostname,
             'current_dir': self.current_dir,
             'home_dir': self.home_dir
         }
         
-        # VFS
-        self.vfs = VFS(vfs_path)
+        # VFS (сервер передаёт всем сессиям одну уже загруженную VFS)
+        if vfs is None:
+            vfs = VFS(vfs_path, lazy=lazy_vfs, snapshot=snapshot, persist=persist, verbose=not quiet,
+                      mounts=mounts)
+        self.vfs = vfs
         self.vfs_current_path = "/"
         
+        # Код возврата последней выполненной команды
+        self.last_status = 0
+        # Задержки команд (--profile или stats on); None - замеры выключены
+        self.profiler = CommandProfiler() if profile else None
+        # Потоки для stat пачек записей в ls -l реальной ФС (создаются при первой большой пачке)
+        self._stat_pool = None
+        
         self.update_prompt()
         self.commands = {
             'ls': self.ls_command,
@@ -215,9 +2636,27 @@ class Shell:
             'mkdir': self.mkdir_command,
             'cp': self.cp_command,
             'touch': self.touch_command,
+            'sync': self.sync_command,
+            'vfs-stats': self.vfs_stats_command,
+            'stats': self.stats_command,
+            'time': self.time_command,
             'conf-dump': self.conf_dump_command,
+            'grep': self.grep_command,
+            'find': self.find_command,
+            'du': self.du_command,
+            'head': self.head_command,
+            'tail': self.tail_command,
+            'mount': self.mount_command,
             'exit': self.exit_command
         }
+        # Команды, которые в конвейере читают вход и отдают вывод лениво:
+        # обработчик (args, stdin) - генератор блоков байтов, возвращающий код
+        self.stream_commands = {
+            'cat': self.cat_stream,
+            'grep': self.grep_stream,
+            'head': self.head_stream,
+            'tail': self.tail_stream,
+        }
     
     def update_prompt(self):
         """Обновляет приглашение с учетом текущей директории"""
@@ -236,179 +2675,466 @@ class Shell:
             
             self.prompt = f"{self.username}@{self.hostname}:{dir_display}$ "
 
+    def print_timing(self, startup_seconds):
+        """Выводит время холодного старта (флаг --timing)"""
+        stats = self.vfs.load_stats
+        sources = {"xml": "XML", "index": "индекс XML", "snapshot": "снимок"}
+        self.out.line("Время запуска:")
+        if stats:
+            self.out.line(f"  загрузка VFS ({sources[stats['source']]}): {stats['seconds']:.3f} с")
+            if stats["source"] == "snapshot":
+                xml_seconds = stats["xml_seconds"]
+                self.out.line(f"  load_from_xml при создании снимка: {xml_seconds:.3f} с")
+                if stats["seconds"] > 0:
+                    self.out.line(f"  ускорение: {xml_seconds / stats['seconds']:.1f}x")
+        self.out.line(f"  всего: {startup_seconds:.3f} с")
+
+    def resolve_vfs_path(self, path):
+        """Приводит путь из аргумента команды к абсолютному пути VFS"""
+        return self.vfs.normalize_path(path, self.vfs_current_path)
+
     def run(self):
         """Основной цикл REPL"""
-        print("Добро пожаловать в эмулятор командной строки!")
+        try:
+            import readline  # noqa: F401 - история и редактирование строки в input()
+        except ImportError:
+            pass
+        
+        self.out.line("Добро пожаловать в эмулятор командной строки!")
         if self.vfs_path:
-            print("Доступные команды: ls, cd, echo, cat, pwd, date, whoami, mkdir, cp, touch, conf-dump, exit")
+            self.out.line("Доступные команды: ls, cd, echo, cat, grep, find, du, head, tail, pwd, date, whoami, mkdir, cp, touch, mount, sync, vfs-stats, stats, time, conf-dump, exit")
         else:
-            print("Доступные команды: ls, cd, echo, date, whoami, mkdir, cp, touch, conf-dump, exit")
-        print("Поддерживаются переменные окружения: $VAR, ${VAR}")
-        print("Для выхода используйте команду 'exit' или Ctrl+C")
-        print("-" * 50)
+            self.out.line("Доступные команды: ls, cd, echo, cat, head, tail, date, whoami, mkdir, cp, touch, stats, time, conf-dump, exit")
+        self.out.line("Поддерживаются переменные окружения: $VAR, ${VAR}")
+        self.out.line("Конвейеры и перенаправление: cmd | cmd, cmd > file, cmd >> file")
+        self.out.line("Для выхода используйте команду 'exit' или Ctrl+C")
+        self.out.line("-" * 50)
         
         # Выполнение стартового скрипта, если указан
         if self.startup_script:
             self.execute_startup_script()
         
-        while True:
-            try:
-                user_input = input(self.prompt)
-                self.execute(user_input)
-            except (EOFError, KeyboardInterrupt):
-                print("\nExiting shell")
-                break
-            except Exception as e:
-                print(f"Ошибка: {e}")
+        try:
+            while True:
+                try:
+                    # Точка сброса: весь вывод команды виден до приглашения
+                    self.out.flush()
+                    user_input = input(self.prompt)
+                    self.execute(user_input)
+                except (EOFError, KeyboardInterrupt):
+                    self.out.line("\nExiting shell")
+                    break
+                except Exception as e:
+                    self.out.line(f"Ошибка: {e}")
+        finally:
+            self.out.flush()
     
     def execute_startup_script(self):
         """Выполняет стартовый скрипт"""
         if not os.path.exists(self.startup_script):
-            print(f"Ошибка: стартовый скрипт не найден: {self.startup_script}")
+            self.out.line(f"Ошибка: стартовый скрипт не найден: {self.startup_script}")
             return
         
-        print(f"Выполнение стартового скрипта: {self.startup_script}")
-        print("-" * 50)
+        self.out.line(f"Выполнение стартового скрипта: {self.startup_script}")
+        self.out.line("-" * 50)
         
         try:
             with open(self.startup_script, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            
-            for line_num, line in enumerate(lines, 1):
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue  # Пропускаем пустые строки и комментарии
-                
-                print(f"{self.prompt}{line}")
-                try:
-                    self.execute(line)
-                except Exception as e:
-                    print(f"Ошибка в строке {line_num}: {e}")
-                    continue  # Пропускаем ошибочные строки
+                for line_num, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue  # Пропускаем пустые строки и комментарии
+                    
+                    self.out.line(f"{self.prompt}{line}")
+                    try:
+                        self.execute(line)
+                    except Exception as e:
+                        self.out.line(f"Ошибка в строке {line_num}: {e}")
+                        continue  # Пропускаем ошибочные строки
             
-            print("-" * 50)
-            print("Стартовый скрипт выполнен")
+            self.out.line("-" * 50)
+            self.out.line("Стартовый скрипт выполнен")
             
         except Exception as e:
-            print(f"Ошибка чтения стартового скрипта: {e}")
+            self.out.line(f"Ошибка чтения стартового скрипта: {e}")
+
+    def run_batch(self, lines):
+        """Неинтерактивный режим (--batch / -c): выполняет строки без эха и баннера
+
+        Строки читаются по одной (файл или stdin не загружаются целиком),
+        вывод копится в буфере BATCH_BUFFER_SIZE и сбрасывается в конце.
+        Возвращает код возврата последней команды; exit завершает
+        выполнение со своим кодом.
+        """
+        buffer_size = self.out.buffer_size
+        self.out.buffer_size = max(buffer_size, BATCH_BUFFER_SIZE)
+        try:
+            for line in lines:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    self.execute(line)
+            return self.last_status
+        finally:
+            self.out.flush()
+            self.out.buffer_size = buffer_size
 
     def execute(self, command):
-        """Выполняет команду"""
+        """Выполняет команду и возвращает её код возврата"""
+        profiler = self.profiler
+        if profiler is not None:
+            start_time = time.perf_counter()
+            written = self.out.written
+        
         # Парсинг команды
         try:
             parts = self.parse_command(command)
-            if not parts:
-                return
+        except Exception as e:
+            self.out.line(f"Ошибка парсинга команды: {e}")
+            self.last_status = 2
+            return self.last_status
+        if not parts:
+            return self.last_status
+
+        if profiler is None:
+            self.last_status = self._dispatch(parts)
+            return self.last_status
+        
+        parsed_time = time.perf_counter()
+        self.last_status = self._dispatch(parts)
+        # stats off могла выключить замеры во время выполнения
+        if self.profiler is profiler:
+            profiler.record(self._command_name(parts), parsed_time - start_time,
+                            time.perf_counter() - parsed_time, self.out.written - written)
+        return self.last_status
 
-            cmd = parts[0]
-            args = parts[1:]
+    def _dispatch(self, parts):
+        """Выполняет разобранную команду, конвейер или time CMD"""
+        if parts[0] == "time" and type(parts[0]) is not Operator:
+            return self.time_command(parts[1:])
+        if any(type(part) is Operator for part in parts):
+            return self.execute_pipeline(parts)
+        return self._call(parts[0], parts[1:])
 
-            # Выполнение команды
-            if cmd in self.commands:
-                try:
-                    self.commands[cmd](args)
-                except Exception as e:
-                    print(f"Ошибка выполнения команды '{cmd}': {e}")
-            else:
-                print(f"Command not found: {cmd}")
+    @staticmethod
+    def _command_name(parts):
+        """Имя команды для статистики: у конвейера - имена этапов через '|'
+
+        Префикс time не входит в имя: замер относится к самой команде.
+        """
+        if parts[0] == "time" and len(parts) > 1:
+            parts = parts[1:]
+        names = [parts[0]]
+        for index, part in enumerate(parts[:-1]):
+            if type(part) is Operator and part == "|":
+                names.append(parts[index + 1])
+        return "|".join(names)
+
+    def _call(self, cmd, args):
+        """Вызывает обработчик команды и возвращает её код возврата"""
+        handler = self.commands.get(cmd)
+        if handler is None:
+            self.out.line(f"Command not found: {cmd}")
+            return 127
+        try:
+            return handler(args) or 0
         except Exception as e:
-            print(f"Ошибка парсинга команды: {e}")
+            self.out.line(f"Ошибка выполнения команды '{cmd}': {e}")
+            return 1
 
-    def parse_command(self, command):
-        """Парсит команду с поддержкой переменных окружения"""
-        if not command.strip():
-            return []
-        
-        # Поддержка переменных окружения в формате $VAR или ${VAR}
-        def expand_vars(text):
-            # Обработка ${VAR} формата
-            text = re.sub(r'\$\{([^}]+)\}', lambda m: os.getenv(m.group(1), f"${{{m.group(1)}}}"), text)
-            # Обработка $VAR формата
-            text = re.sub(r'\$([A-Za-z_][A-Za-z0-9_]*)', lambda m: os.getenv(m.group(1), f"${m.group(1)}"), text)
-            return text
+    def execute_pipeline(self, parts):
+        """Выполняет конвейер cmd | cmd ... с необязательным перенаправлением > или >> в конце"""
+        stages = [[]]
+        redirect = None
+        for index, part in enumerate(parts):
+            if type(part) is not Operator:
+                stages[-1].append(part)
+                continue
+            if not stages[-1]:
+                self.out.line(f"syntax error near unexpected token '{part}'")
+                return 2
+            if part == "|":
+                stages.append([])
+                continue
+            # Перенаправление допускается только в конце: оператор и имя файла
+            if index != len(parts) - 2 or type(parts[-1]) is Operator:
+                self.out.line(f"syntax error near unexpected token '{part}'")
+                return 2
+            redirect = (part, parts[-1])
+            break
+        if not stages[-1]:
+            self.out.line("syntax error near unexpected token '|'")
+            return 2
+        if redirect is not None and not self.vfs_path:
+            self.out.line(f"{redirect[1]}: cannot redirect: VFS is not loaded")
+            return 1
+        return self._run_stages(stages, redirect)
+
+    def _run_stages(self, stages, redirect=None):
+        """Связывает этапы конвейера ленивыми генераторами и выводит результат
+
+        Каждый этап забирает у предыдущего блоки байтов по мере надобности,
+        поэтому, например, head останавливает весь конвейер, прочитав нужное
+        число строк, а память не зависит от объёма данных в конвейере.
+        Код возврата конвейера - код последнего этапа.
+        """
+        statuses = [0] * len(stages)
+        generators = []
+        stream = None
+        for index, (cmd, *args) in enumerate(stages):
+            handler = self.stream_commands.get(cmd)
+            source = handler(args, stream) if handler else self._captured(cmd, args)
+            stream = self._stage(cmd, source, statuses, index)
+            generators.append(stream)
         
-        # Разбиваем команду на части, сохраняя кавычки
-        parts = []
-        current_part = ""
-        in_quotes = False
-        quote_char = None
-        
-        for char in command:
-            if char in ['"', "'"] and not in_quotes:
-                in_quotes = True
-                quote_char = char
-                current_part += char
-            elif char == quote_char and in_quotes:
-                in_quotes = False
-                quote_char = None
-                current_part += char
-            elif char == ' ' and not in_quotes:
-                if current_part.strip():
-                    parts.append(expand_vars(current_part.strip()))
-                current_part = ""
+        try:
+            if redirect is None:
+                self._emit(stream)
             else:
-                current_part += char
-        
-        if current_part.strip():
-            parts.append(expand_vars(current_part.strip()))
+                operator, target = redirect
+                data = b"".join(stream)
+                if not self.vfs.write_file(self.resolve_vfs_path(target), data,
+                                           append=operator == ">>"):
+                    self.out.line(f"{target}: cannot write: Is a directory or parent directory does not exist")
+                    return 1
+        finally:
+            # Останавливает этапы, которые не дочитали свой вход
+            for generator in generators:
+                generator.close()
+        return statuses[-1]
+
+    def _stage(self, cmd, source, statuses, index):
+        """Этап конвейера: передаёт блоки дальше и запоминает код возврата"""
+        try:
+            statuses[index] = (yield from source) or 0
+        except Exception as e:
+            self.out.line(f"Ошибка выполнения команды '{cmd}': {e}")
+            statuses[index] = 1
+
+    def _captured(self, cmd, args):
+        """Выполняет обычную команду как этап конвейера: её вывод становится потоком"""
+        out = self.out
+        self.out = OutputSink(io.BytesIO())
+        try:
+            status = self._call(cmd, args)
+            self.out.flush()
+            data = self.out.stream.getvalue()
+        finally:
+            self.out = out
+        if data:
+            yield data
+        return status
+
+    def _emit(self, stream):
+        """Выводит поток блоков байтов через приёмник вывода"""
+        last = b""
+        for chunk in stream:
+            if chunk:
+                self.out.write_bytes(chunk)
+                last = chunk
+        self.out.end_output(last)
+
+    def _inputs(self, cmd, files, stdin):
+        """Источники данных команды: [(имя файла, блоки байтов)] и код возврата
+
+        Без файлов источник один - вход конвейера (пустой вне конвейера).
+        """
+        if not files:
+            return [(None, stdin if stdin is not None else ())], 0
+        if not self.vfs_path:
+            return self._host_inputs(cmd, files)
         
-        return parts
+        bodies, status = self._file_bodies(cmd, files)
+        return [(filename, iter_chunks(content)) for filename, content in bodies], status
+    
+    def _host_inputs(self, cmd, files, offsets=None):
+        """Файлы реальной ОС из аргументов команды: [(имя файла, блоки байтов)] и код возврата
+
+        Файлы проверяются сразу, а открываются, только когда их начнут читать.
+        offsets(path, size) - смещение, с которого читать файл (по умолчанию 0).
+        """
+        sources = []
+        status = 0
+        for filename in files:
+            try:
+                size = os.stat(filename).st_size
+                if os.path.isdir(filename):
+                    raise IsADirectoryError(errno.EISDIR, "Is a directory")
+                if not os.access(filename, os.R_OK):
+                    raise PermissionError(errno.EACCES, "Permission denied")
+            except OSError as e:
+                self.out.line(f"{cmd}: {filename}: {e.strerror}")
+                status = 1
+                continue
+            offset = offsets(filename, size) if offsets else 0
+            sources.append((filename, host_file_chunks(filename, offset)))
+        return sources, status
+
+    def _file_bodies(self, cmd, files):
+        """Тела файлов VFS из аргументов команды: [(имя файла, байты)] и код возврата"""
+        bodies = []
+        status = 0
+        for filename in files:
+            if not self.vfs_path:
+                self.out.line(f"{cmd}: {filename}: VFS is not loaded")
+                status = 1
+                continue
+            content = self.vfs.get_file_content(self.resolve_vfs_path(filename))
+            if content is None:
+                self.out.line(f"{cmd}: {filename}: No such file or directory")
+                status = 1
+            else:
+                bodies.append((filename, content))
+        return bodies, status
+
+    def parse_command(self, command):
+        """Парсит команду с поддержкой переменных окружения"""
+        return parse_command_line(command)
 
     def ls_command(self, args):
-        """Команда ls - список содержимого директории"""
+        """Команда ls - список содержимого директории
+
+        -l - с размерами; в реальной ФС также -a (включая скрытые записи)
+        и -R (рекурсивно). Флаги можно объединять: -laR.
+        """
+        long = show_all = recursive = False
+        offset = 0
+        limit = None
+        operands = []
+        args = iter(args)
+        for arg in args:
+            if len(arg) > 1 and arg[0] == "-" and set(arg[1:]) <= set("laR"):
+                long = long or "l" in arg
+                show_all = show_all or "a" in arg
+                recursive = recursive or "R" in arg
+            elif arg.split("=", 1)[0] in ("--limit", "--offset"):
+                option, _, value = arg.partition("=")
+                if not _:
+                    value = next(args, "")
+                if not value.isdigit():
+                    self.out.line(f"ls: invalid {option[2:]}: '{value}'")
+                    return 1
+                if option == "--limit":
+                    limit = int(value)
+                else:
+                    offset = int(value)
+            else:
+                operands.append(arg)
+        
         if self.vfs_path:
             # Режим VFS
-            if args:
-                target_path = args[0]
-                # Нормализуем путь
-                if not target_path.startswith("/"):
-                    if self.vfs_current_path == "/":
-                        target_path = "/" + target_path
-                    else:
-                        target_path = self.vfs_current_path + "/" + target_path
+            if operands:
+                target_path = self.resolve_vfs_path(operands[0])
             else:
                 target_path = self.vfs_current_path
+            if recursive:
+                self.out.line("ls: -R is only supported for host directories")
+                return 1
             
-            items = self.vfs.list_directory(target_path)
+            items = self.vfs.list_directory(target_path, long=long, offset=offset, limit=limit)
             if items is None:
-                print(f"ls: {target_path}: No such file or directory")
-                return
+                self.out.line(f"ls: {target_path}: No such file or directory")
+                return 1
             
-            if not items:
-                return  # Пустая директория
+            if long:
+                # Итог директории берётся из её узла, без обхода поддерева
+                size, _ = self.vfs.usage(target_path)
+                self.out.line(f"total {format_size(size)}")
+                for name, is_dir, size, entries in items:
+                    mode = "drwxr-xr-x" if is_dir else "-rw-r--r--"
+                    suffix = "/" if is_dir else ""
+                    self.out.line(f"{mode} {entries:>7} {self.username} {size:>12} {name}{suffix}")
+                return
             
-            # Выводим содержимое
-            for item in items:
-                if item["type"] == "directory":
-                    print(f"{item['name']}/")
-                else:
-                    print(item["name"])
+            # Записи выводятся по мере обхода, без промежуточного списка
+            for name, is_dir in items:
+                self.out.line(f"{name}/" if is_dir else name)
         else:
             # Обычный режим - реальная логика
-            if args:
-                target_path = args[0]
+            if operands:
+                target_path = operands[0]
             else:
                 target_path = self.current_dir
             
+            if not os.path.exists(target_path):
+                self.out.line(f"ls: {target_path}: No such file or directory")
+                return 1
+            if not os.path.isdir(target_path):
+                self.out.line(f"ls: {target_path}: Not a directory")
+                return 1
+            return self._host_ls(target_path, long, show_all, recursive, offset, limit)
+
+    def _host_ls(self, path, long, show_all, recursive, offset=0, limit=None):
+        """ls директории реальной ФС
+
+        Тип записи берётся из os.scandir (d_type) без stat на каждую
+        запись; stat нужен только для -l и делается пачками. -R обходит
+        поддиректории в глубину (без перехода по символьным ссылкам),
+        выводя каждую директорию по мере обхода.
+        """
+        status = None
+        stack = [path]
+        while stack:
+            directory = stack.pop()
             try:
-                if os.path.exists(target_path):
-                    if os.path.isdir(target_path):
-                        items = os.listdir(target_path)
-                        if items:
-                            for item in sorted(items):
-                                item_path = os.path.join(target_path, item)
-                                if os.path.isdir(item_path):
-                                    print(f"{item}/")
-                                else:
-                                    print(item)
-                    else:
-                        print(f"ls: {target_path}: Not a directory")
-                else:
-                    print(f"ls: {target_path}: No such file or directory")
+                with os.scandir(directory) as scan:
+                    entries = sorted((entry for entry in scan if show_all or entry.name[0] != "."),
+                                     key=lambda entry: entry.name)
             except PermissionError:
-                print(f"ls: {target_path}: Permission denied")
-            except Exception as e:
-                print(f"ls: {target_path}: {e}")
+                self.out.line(f"ls: {directory}: Permission denied")
+                status = 1
+                continue
+            except OSError as e:
+                self.out.line(f"ls: {directory}: {e.strerror or e}")
+                status = 1
+                continue
+            
+            if recursive:
+                if directory is not path:
+                    self.out.line()
+                self.out.line(f"{directory}:")
+                stack.extend(entry.path for entry in reversed(entries) if entry.is_dir(follow_symlinks=False))
+            
+            page = entries[offset:None if limit is None else offset + limit]
+            if long:
+                self._host_ls_long(page)
+            else:
+                for entry in page:
+                    self.out.line(f"{entry.name}/" if entry.is_dir() else entry.name)
+        return status
+
+    def _host_ls_long(self, entries):
+        """Выводит записи ls -l реальной ФС, получая lstat пачками"""
+        # Время изменения с точностью до минуты: у соседних записей обычно совпадает
+        mtimes = {}
+        for start in range(0, len(entries), LS_STAT_BATCH):
+            batch = entries[start:start + LS_STAT_BATCH]
+            if len(batch) < LS_STAT_PARALLEL_MIN:
+                stats = lstat_entries(batch)
+            else:
+                if self._stat_pool is None:
+                    self._stat_pool = ThreadPoolExecutor(LS_STAT_WORKERS)
+                step = -(-len(batch) // LS_STAT_WORKERS)
+                stats = [result for part in self._stat_pool.map(
+                    lstat_entries, [batch[i:i + step] for i in range(0, len(batch), step)]) for result in part]
+            
+            for entry, st in zip(batch, stats):
+                if st is None:
+                    self.out.line(f"ls: cannot access '{entry.path}'")
+                    continue
+                name = entry.name
+                if S_ISLNK(st.st_mode):
+                    try:
+                        name += " -> " + os.readlink(entry.path)
+                    except OSError:
+                        pass
+                elif entry.is_dir():
+                    name += "/"
+                minute = int(st.st_mtime) // 60
+                mtime = mtimes.get(minute)
+                if mtime is None:
+                    mtime = mtimes[minute] = time.strftime("%b %d %H:%M", time.localtime(minute * 60))
+                self.out.line(f"{filemode(st.st_mode)} {st.st_nlink:>7} {host_owner(st.st_uid)} "
+                              f"{st.st_size:>12} {mtime} {name}")
 
     def cd_command(self, args):
         """Команда cd - смена директории"""
@@ -419,37 +3145,18 @@ class Shell:
                 self.vfs_current_path = "/"
             elif len(args) == 1:
                 target_dir = args[0]
-                
-                # Нормализуем путь
-                if target_dir == "/":
-                    new_path = "/"
-                elif target_dir.startswith("/"):
-                    new_path = target_dir
-                elif target_dir == "..":
-                    # Переход в родительскую директорию
-                    if self.vfs_current_path == "/":
-                        new_path = "/"  # Уже в корне
-                    else:
-                        parts = self.vfs_current_path.split("/")
-                        if len(parts) <= 2:  # /root -> /
-                            new_path = "/"
-                        else:
-                            new_path = "/" + "/".join(parts[1:-1])
-                else:
-                    # Относительный путь
-                    if self.vfs_current_path == "/":
-                        new_path = "/" + target_dir
-                    else:
-                        new_path = self.vfs_current_path + "/" + target_dir
+                new_path = self.resolve_vfs_path(target_dir)
                 
                 # Проверяем, существует ли директория
                 if self.vfs.get_node(new_path) is not None:
                     self.vfs_current_path = new_path
                 else:
-                    print(f"cd: {target_dir}: No such file or directory")
+                    self.out.line(f"cd: {target_dir}: No such file or directory")
+                    return 1
             else:
-                print("cd: too many arguments")
-                print("Usage: cd [directory]")
+                self.out.line("cd: too many arguments")
+                self.out.line("Usage: cd [directory]")
+                return 1
             
             self.update_prompt()
         else:
@@ -461,7 +3168,8 @@ class Shell:
                     self.current_dir = os.getcwd()
                     self.update_prompt()
                 except Exception as e:
-                    print(f"cd: {self.home_dir}: {e}")
+                    self.out.line(f"cd: {self.home_dir}: {e}")
+                    return 1
             elif len(args) == 1:
                 target_dir = args[0]
                 try:
@@ -479,61 +3187,424 @@ class Shell:
                         self.current_dir = os.getcwd()
                         self.update_prompt()
                     else:
-                        print(f"cd: {target_dir}: No such file or directory")
+                        self.out.line(f"cd: {target_dir}: No such file or directory")
+                        return 1
                 except PermissionError:
-                    print(f"cd: {target_dir}: Permission denied")
+                    self.out.line(f"cd: {target_dir}: Permission denied")
+                    return 1
                 except Exception as e:
-                    print(f"cd: {target_dir}: {e}")
+                    self.out.line(f"cd: {target_dir}: {e}")
+                    return 1
             else:
-                print("cd: too many arguments")
-                print("Usage: cd [directory]")
+                self.out.line("cd: too many arguments")
+                self.out.line("Usage: cd [directory]")
+                return 1
 
     def echo_command(self, args):
         """Команда echo - выводит аргументы"""
         if args:
             # Объединяем все аргументы в одну строку
             output = ' '.join(args)
-            print(output)
+            self.out.line(output)
         else:
             # echo без аргументов выводит пустую строку
-            print()
+            self.out.line()
 
     def cat_command(self, args):
         """Команда cat - выводит содержимое файла"""
+        if not self.vfs_path and args:
+            return self._host_cat(args)
+        return self._run_stages([["cat", *args]])
+
+    def _host_cat(self, files):
+        """cat файлов реальной ОС вне конвейера: файлы передаются в вывод целиком (см. OutputSink.write_file)"""
+        status = 0
+        last = b""
+        for filename in files:
+            try:
+                with open(filename, 'rb') as f:
+                    last = self.out.write_file(f) or last
+            except OSError as e:
+                self.out.line(f"cat: {filename}: {e.strerror}")
+                status = 1
+        self.out.end_output(last)
+        return status
+
+    def cat_stream(self, args, stdin=None):
+        """cat как этап конвейера: отдаёт содержимое файлов (или вход) блоками"""
         if not args:
-            print("cat: missing file operand")
-            print("Usage: cat <file>")
-            return
+            if stdin is None:
+                self.out.line("cat: missing file operand")
+                self.out.line("Usage: cat <file>")
+                return 1
+            yield from stdin
+            return 0
         
-        if self.vfs_path:
-            # Режим VFS
-            for filename in args:
-                # Нормализуем путь
-                if not filename.startswith("/"):
-                    if self.vfs_current_path == "/":
-                        file_path = "/" + filename
-                    else:
-                        file_path = self.vfs_current_path + "/" + filename
-                else:
-                    file_path = filename
-                
-                content = self.vfs.get_file_content(file_path)
-                if content is None:
-                    print(f"cat: {filename}: No such file or directory")
+        # Тела файлов отдаются блоками memoryview, без декодирования и копирования
+        # (в обычном режиме - блоками отображения файлов реальной ОС)
+        sources, status = self._inputs("cat", args, stdin)
+        for _, chunks in sources:
+            yield from chunks
+        return status
+
+    def grep_command(self, args):
+        """Команда grep - поиск строк по регулярному выражению"""
+        return self._run_stages([["grep", *args]])
+
+    def grep_stream(self, args, stdin=None):
+        """grep как этап конвейера: отдаёт подходящие строки по мере чтения"""
+        flags = 0
+        invert = False
+        recursive = False
+        fixed = False
+        workers = None
+        operands = []
+        args = iter(args)
+        for arg in args:
+            if arg == "-P" and not operands:
+                value = next(args, "")
+                if not value.isdigit():
+                    self.out.line(f"grep: invalid number of workers: '{value}'")
+                    return 2
+                workers = int(value) or os.cpu_count() or 1
+            elif arg == "-i" and not operands:
+                flags |= re.IGNORECASE
+            elif arg == "-v" and not operands:
+                invert = True
+            elif arg in ("-r", "-R") and not operands:
+                recursive = True
+            elif arg == "-F" and not operands:
+                fixed = True
+            else:
+                operands.append(arg)
+        
+        if not operands:
+            self.out.line("grep: missing pattern")
+            self.out.line("Usage: grep [-i] [-v] [-F] [-r] [-P N] PATTERN [file...]")
+            return 2
+        
+        pattern = re.escape(operands[0]) if fixed else operands[0]
+        try:
+            # MULTILINE: ^ и $ совпадают на границах строк внутри блока
+            regex = re.compile(pattern.encode('utf-8'), flags | re.MULTILINE)
+        except re.error as e:
+            self.out.line(f"grep: invalid pattern: {e}")
+            return 2
+        
+        files = operands[1:]
+        prefixed = len(files) > 1 or recursive
+        if recursive:
+            bodies, status = self._recursive_bodies(files or ["."], regex, invert)
+        elif files:
+            bodies, status = self._file_bodies("grep", files)
+        else:
+            bodies, status = None, 0
+        
+        if workers is not None and workers > 1 and bodies is not None and PARALLEL_START_METHOD:
+            matched = yield from self._parallel_grep(regex, bodies, invert, prefixed, workers)
+        else:
+            matched = False
+            sources = [(None, stdin if stdin is not None else ())] if bodies is None else (
+                (filename, iter_chunks(content)) for filename, content in bodies)
+            for filename, chunks in sources:
+                prefix = f"{filename}:".encode('utf-8') if prefixed else b""
+                for line in self._grep_lines(regex, chunks, invert, prefix):
+                    matched = True
+                    yield line
+        if status:
+            return 2
+        return 0 if matched else 1
+    
+    def _parallel_grep(self, regex, bodies, invert, prefixed, workers):
+        """Распределяет тела файлов по процессам и отдаёт результат в порядке файлов
+
+        Процессы создаются через fork и наследуют список тел, поэтому тела
+        не сериализуются: байты остаются в общей памяти процессов, а тела
+        из снимка - в общем отображении файла снимка. Задание - диапазон
+        номеров файлов объёмом около PARALLEL_TASK_SIZE байт; imap
+        возвращает результаты по порядку, как только готово очередное задание.
+        Возвращает, было ли хотя бы одно совпадение.
+        """
+        global _parallel_bodies
+        _parallel_bodies = bodies = list(bodies)
+        tasks = []
+        start = 0
+        size = 0
+        for index, (_, content) in enumerate(bodies, 1):
+            size += len(content)
+            if size >= PARALLEL_TASK_SIZE or index == len(bodies):
+                tasks.append((start, index, regex.pattern, regex.flags, invert, prefixed))
+                start = index
+                size = 0
+        
+        matched = False
+        if not tasks:
+            return matched
+        try:
+            context = multiprocessing.get_context(PARALLEL_START_METHOD)
+            with context.Pool(min(workers, len(tasks))) as pool:
+                for block in pool.imap(_grep_task, tasks):
+                    if block:
+                        matched = True
+                        yield block
+        finally:
+            _parallel_bodies = None
+        return matched
+
+    def _recursive_bodies(self, paths, regex, invert=False):
+        """Файлы grep -r под paths, отобранные по триграммному индексу: (имя, байты) и код возврата
+
+        Индекс отсеивает файлы, в которых нет обязательных строк выражения;
+        остальные проверяются самим выражением. С -v подходит любой файл,
+        поэтому индекс не используется.
+        """
+        if not self.vfs_path:
+            self.out.line("grep: -r: VFS is not loaded")
+            return [], 1
+        
+        candidates = None
+        if not invert:
+            literals = [literal.encode('utf-8') for literal in regex_literals(regex.pattern.decode('utf-8'))]
+            candidates = self.vfs.trigram_index().candidates(literals)
+        
+        roots = []
+        status = 0
+        for path in paths:
+            full_path = self.resolve_vfs_path(path)
+            if self.vfs.get_node(full_path) is None and self.vfs.get_file_content(full_path) is None:
+                self.out.line(f"grep: {path}: No such file or directory")
+                status = 1
+            else:
+                roots.append((path.rstrip("/"), full_path))
+        
+        # Файлы обходятся лениво, по мере чтения вывода
+        # Файлы смонтированных директорий не индексируются и проверяются всегда
+        bodies = ((display + relative, body)
+                  for display, full_path in roots
+                  for relative, node in self.vfs.walk_files(full_path)
+                  if candidates is None or node in candidates or type(node.content) is HostFile
+                  for body in (self.vfs.body(node),) if body is not None)
+        return bodies, status
+    
+    @staticmethod
+    def _grep_lines(regex, chunks, invert=False, prefix=b""):
+        """Подходящие строки с префиксом имени файла и переводом строки на конце"""
+        for line in Shell._grep_blocks(regex, chunks, invert):
+            if line[-1:] != b"\n":
+                line += b"\n"
+            yield prefix + line if prefix else line
+    
+    @staticmethod
+    def _grep_blocks(regex, chunks, invert=False):
+        """Подходящие строки: выражение ищется сразу по блоку из целых строк,
+        поэтому строки без совпадений не выделяются вовсе (кроме -v)"""
+        for block in iter_line_blocks(chunks):
+            pos = 0
+            while pos < len(block):
+                if invert:
+                    start = pos
                 else:
-                    print(content)
+                    match = regex.search(block, pos)
+                    if match is None:
+                        break
+                    start = block.rfind(b"\n", 0, match.start()) + 1
+                end = block.find(b"\n", start) + 1 or len(block)
+                # Строка проверяется без перевода строки, как в grep (например, для \s)
+                line_end = end - 1 if block[end - 1] == 0x0A else end
+                pos = end
+                if invert:
+                    if regex.search(block, start, line_end) is None:
+                        yield block[start:end]
+                elif match.end() <= line_end or regex.search(block, start, line_end) is not None:
+                    yield block[start:end]
+
+    def find_command(self, args):
+        """Команда find - поиск файлов и директорий по имени"""
+        paths = []
+        pattern = "*"
+        kind = None
+        args = iter(args)
+        for arg in args:
+            if arg == "-name":
+                pattern = next(args, None)
+                if pattern is None:
+                    self.out.line("find: missing argument to '-name'")
+                    return 1
+            elif arg == "-type":
+                kind = next(args, None)
+                if kind not in ("f", "d"):
+                    self.out.line(f"find: unknown argument to -type: {kind}")
+                    self.out.line("Usage: find [path...] [-name GLOB] [-type f|d]")
+                    return 1
+            elif arg.startswith("-"):
+                self.out.line(f"find: unknown predicate '{arg}'")
+                self.out.line("Usage: find [path...] [-name GLOB] [-type f|d]")
+                return 1
+            else:
+                paths.append(arg)
+        
+        if not self.vfs_path:
+            self.out.line("find: VFS is not loaded")
+            return 1
+        
+        status = 0
+        for path in paths or ["."]:
+            full_path = self.resolve_vfs_path(path)
+            results = self.vfs.find(full_path, pattern, kind)
+            if results is None:
+                self.out.line(f"find: '{path}': No such file or directory")
+                status = 1
+                continue
+            # Пути выводятся относительно аргумента в том виде, как он задан
+            display = path.rstrip("/") if full_path != "/" else path.rstrip("/") + "/"
+            skip = len(full_path.rstrip("/")) + (full_path == "/")
+            for result in results:
+                self.out.line(display + result[skip:])
+        return status
+
+    def du_command(self, args):
+        """Команда du - размер директорий (-s - только итог, -h - в K/M/G)"""
+        summarize = False
+        human = False
+        paths = []
+        for arg in args:
+            if arg.startswith("-") and len(arg) > 1 and set(arg[1:]) <= {"s", "h"}:
+                summarize = summarize or "s" in arg
+                human = human or "h" in arg
+            elif arg.startswith("-") and len(arg) > 1:
+                self.out.line(f"du: invalid option '{arg}'")
+                self.out.line("Usage: du [-s] [-h] [path...]")
+                return 1
+            else:
+                paths.append(arg)
+        
+        if not self.vfs_path:
+            self.out.line("du: VFS is not loaded")
+            return 1
+        
+        status = 0
+        for path in paths or ["."]:
+            full_path = self.resolve_vfs_path(path)
+            usage = self.vfs.usage(full_path)
+            if usage is None:
+                self.out.line(f"du: cannot access '{path}': No such file or directory")
+                status = 1
+                continue
+            if summarize or self.vfs.get_node(full_path) is None:
+                self.out.line(f"{format_size(usage[0], human)}\t{path}")
+                continue
+            display = path.rstrip("/")
+            for relative, size in self.vfs.walk_usage(full_path):
+                self.out.line(f"{format_size(size, human)}\t{display + relative or path}")
+        return status
+
+    def head_command(self, args):
+        """Команда head - первые строки файла"""
+        return self._run_stages([["head", *args]])
+
+    def head_stream(self, args, stdin=None):
+        """head как этап конвейера: прекращает чтение входа после count строк"""
+        parsed = self._line_count_args("head", args)
+        if parsed is None:
+            return 1
+        count, files = parsed
+        
+        sources, status = self._inputs("head", files, stdin)
+        for index, (filename, chunks) in enumerate(sources):
+            if len(files) > 1:
+                yield self._file_header(filename, index)
+            yield from islice(iter_lines(chunks), count)
+        return status
+
+    def _line_count_args(self, cmd, args):
+        """Разбирает аргументы head/tail: (число строк, файлы) или None при ошибке"""
+        count = 10
+        files = []
+        args = iter(args)
+        for arg in args:
+            if arg == "-n":
+                value = next(args, "")
+            elif arg.startswith("-n"):
+                value = arg[2:]
+            elif arg.startswith("-") and arg[1:].isdigit():
+                value = arg[1:]
+            else:
+                files.append(arg)
+                continue
+            if not value.isdigit():
+                self.out.line(f"{cmd}: invalid number of lines: '{value}'")
+                return None
+            count = int(value)
+        return count, files
+
+    @staticmethod
+    def _file_header(filename, index):
+        """Заголовок файла в выводе head/tail с несколькими файлами"""
+        header = f"==> {filename} <==\n" if index == 0 else f"\n==> {filename} <==\n"
+        return header.encode('utf-8')
+
+    def tail_command(self, args):
+        """Команда tail - последние строки файла"""
+        return self._run_stages([["tail", *args]])
+
+    def tail_stream(self, args, stdin=None):
+        """tail как этап конвейера
+
+        Файлы читаются с конца (см. tail_start) и не читаются целиком;
+        вход конвейера просматривается один раз с последними count строками в памяти.
+        """
+        parsed = self._line_count_args("tail", args)
+        if parsed is None:
+            return 1
+        count, files = parsed
+        
+        if not files:
+            if stdin is not None and count:
+                yield from deque(iter_lines(stdin), maxlen=count)
+            return 0
+        
+        if self.vfs_path:
+            bodies, status = self._file_bodies("tail", files)
+            sources = []
+            for filename, content in bodies:
+                view = memoryview(content)
+                start = tail_start(lambda offset, length: view[offset:offset + length].tobytes(),
+                                   len(view), count)
+                sources.append((filename, iter_chunks(view[start:])))
         else:
-            # Обычный режим - заглушка
-            print(f"cat: would display contents of: {args}")
+            # У файлов /proc, /sys и устройств нет размера: их хвост ищется
+            # чтением подряд, как у входа конвейера
+            unsized = set()
+            
+            def offsets(path, size):
+                if not size or not S_ISREG(os.stat(path).st_mode):
+                    unsized.add(path)
+                    return 0
+                with open(path, 'rb') as f:
+                    def read(offset, length):
+                        f.seek(offset)
+                        return f.read(length)
+                    return tail_start(read, size, count)
+            sources, status = self._host_inputs("tail", files, offsets)
+        
+        for index, (filename, chunks) in enumerate(sources):
+            if len(files) > 1:
+                yield self._file_header(filename, index)
+            if not self.vfs_path and filename in unsized:
+                if count:
+                    yield from deque(iter_lines(chunks), maxlen=count)
+                continue
+            yield from chunks
+        return status
 
     def pwd_command(self, args):
         """Команда pwd - выводит текущую директорию"""
         if self.vfs_path:
             # Режим VFS
-            print(self.vfs_current_path)
+            self.out.line(self.vfs_current_path)
         else:
             # Обычный режим
-            print(self.current_dir)
+            self.out.line(self.current_dir)
 
     def date_command(self, args):
         """Команда date - выводит текущую дату и время"""
@@ -541,149 +3612,397 @@ class Shell:
         
         # Проверяем аргументы для форматирования
         if args and args[0] == "+%Y-%m-%d":
-            print(now.strftime("%Y-%m-%d"))
+            self.out.line(now.strftime("%Y-%m-%d"))
         elif args and args[0] == "+%H:%M:%S":
-            print(now.strftime("%H:%M:%S"))
+            self.out.line(now.strftime("%H:%M:%S"))
         elif args and len(args) >= 2 and args[0] == "+%Y-%m-%d" and args[1] == "%H:%M:%S":
-            print(now.strftime("%Y-%m-%d %H:%M:%S"))
+            self.out.line(now.strftime("%Y-%m-%d %H:%M:%S"))
         else:
             # Стандартный формат
-            print(now.strftime("%a %b %d %H:%M:%S %Z %Y"))
+            self.out.line(now.strftime("%a %b %d %H:%M:%S %Z %Y"))
 
     def whoami_command(self, args):
         """Команда whoami - выводит имя текущего пользователя"""
         if args:
-            print("whoami: too many arguments")
-            print("Usage: whoami")
+            self.out.line("whoami: too many arguments")
+            self.out.line("Usage: whoami")
+            return 1
         else:
-            print(self.username)
+            self.out.line(self.username)
 
     def conf_dump_command(self, args):
         """Команда conf-dump - выводит конфигурацию эмулятора"""
-        print("Конфигурация эмулятора:")
-        print("=" * 30)
+        self.out.line("Конфигурация эмулятора:")
+        self.out.line("=" * 30)
         for key, value in self.config.items():
             if value is None:
                 value = "не задано"
-            print(f"{key}: {value}")
-        print("=" * 30)
+            self.out.line(f"{key}: {value}")
+        self.out.line("=" * 30)
 
     def mkdir_command(self, args):
         """Команда mkdir - создание директории"""
         if not args:
-            print("mkdir: missing operand")
-            print("Usage: mkdir directory...")
-            return
+            self.out.line("mkdir: missing operand")
+            self.out.line("Usage: mkdir directory...")
+            return 1
         
         if self.vfs_path:
             # Режим VFS
+            status = 0
             for dir_path in args:
-                # Нормализуем путь
-                if not dir_path.startswith("/"):
-                    if self.vfs_current_path == "/":
-                        full_path = "/" + dir_path
-                    else:
-                        full_path = self.vfs_current_path + "/" + dir_path
-                else:
-                    full_path = dir_path
-                
+                full_path = self.resolve_vfs_path(dir_path)
                 if self.vfs.create_directory(full_path):
-                    print(f"mkdir: created directory '{dir_path}'")
+                    self.out.line(f"mkdir: created directory '{dir_path}'")
                 else:
-                    print(f"mkdir: cannot create directory '{dir_path}': File exists or parent directory does not exist")
+                    self.out.line(f"mkdir: cannot create directory '{dir_path}': File exists or parent directory does not exist")
+                    status = 1
+            return status
         else:
             # Обычный режим - заглушка
             for dir_path in args:
-                print(f"mkdir: would create directory: {dir_path}")
+                self.out.line(f"mkdir: would create directory: {dir_path}")
+
+    def mount_command(self, args):
+        """Команда mount - монтирование директории реальной ОС в VFS (без аргументов - список)"""
+        if not self.vfs_path:
+            self.out.line("mount: VFS is not loaded")
+            return 1
+        if not args:
+            for path, host_path in sorted(self.vfs.mounts.items()):
+                self.out.line(f"{host_path} on {path}")
+            return 0
+        if len(args) != 2:
+            self.out.line("mount: wrong number of arguments")
+            self.out.line("Usage: mount [HOSTDIR VFSDIR]")
+            return 1
+        
+        host_path, path = args
+        host_path = os.path.expanduser(host_path)
+        if not os.path.isabs(host_path):
+            host_path = os.path.join(self.current_dir, host_path)
+        if not os.path.isdir(host_path):
+            self.out.line(f"mount: {args[0]}: No such directory")
+            return 1
+        if not self.vfs.mount(host_path, self.resolve_vfs_path(path)):
+            self.out.line(f"mount: cannot mount on '{path}': not an empty directory, "
+                          "inside a mount or parent directory does not exist")
+            return 1
+        return 0
 
     def cp_command(self, args):
-        """Команда cp - копирование файлов"""
-        if len(args) < 2:
-            print("cp: missing file operand")
-            print("Usage: cp source_file target_file")
-            return
+        """Команда cp - копирование файлов и директорий (-r)"""
+        recursive = False
+        operands = []
+        for arg in args:
+            if arg in ("-r", "-R", "--recursive"):
+                recursive = True
+            else:
+                operands.append(arg)
         
-        if len(args) > 2:
-            print("cp: too many arguments")
-            print("Usage: cp source_file target_file")
-            return
+        if len(operands) < 2:
+            self.out.line("cp: missing file operand")
+            self.out.line("Usage: cp [-r] source target")
+            return 1
         
-        src_path = args[0]
-        dst_path = args[1]
+        if len(operands) > 2:
+            self.out.line("cp: too many arguments")
+            self.out.line("Usage: cp [-r] source target")
+            return 1
+        
+        src_path = operands[0]
+        dst_path = operands[1]
         
         if self.vfs_path:
             # Режим VFS
-            # Нормализуем исходный путь
-            if not src_path.startswith("/"):
-                if self.vfs_current_path == "/":
-                    full_src_path = "/" + src_path
-                else:
-                    full_src_path = self.vfs_current_path + "/" + src_path
-            else:
-                full_src_path = src_path
+            full_src_path = self.resolve_vfs_path(src_path)
+            full_dst_path = self.resolve_vfs_path(dst_path)
             
-            # Нормализуем целевой путь
-            if not dst_path.startswith("/"):
-                if self.vfs_current_path == "/":
-                    full_dst_path = "/" + dst_path
-                else:
-                    full_dst_path = self.vfs_current_path + "/" + dst_path
+            if recursive:
+                copied = self.vfs.copy_tree(full_src_path, full_dst_path)
+            elif self.vfs.get_node(full_src_path) is not None:
+                self.out.line(f"cp: -r not specified; omitting directory '{src_path}'")
+                return 1
             else:
-                full_dst_path = dst_path
+                copied = self.vfs.copy_file(full_src_path, full_dst_path)
             
-            if self.vfs.copy_file(full_src_path, full_dst_path):
-                print(f"cp: copied '{src_path}' to '{dst_path}'")
+            if copied:
+                self.out.line(f"cp: copied '{src_path}' to '{dst_path}'")
             else:
-                print(f"cp: cannot copy '{src_path}' to '{dst_path}': Source file does not exist or target already exists")
+                self.out.line(f"cp: cannot copy '{src_path}' to '{dst_path}': Source file does not exist or target already exists")
+                return 1
         else:
             # Обычный режим - заглушка
-            print(f"cp: would copy '{src_path}' to '{dst_path}'")
+            self.out.line(f"cp: would copy '{src_path}' to '{dst_path}'")
 
     def touch_command(self, args):
         """Команда touch - создание файлов"""
         if len(args) < 1:
-            print("touch: missing file operand")
-            print("Usage: touch file...")
-            return
+            self.out.line("touch: missing file operand")
+            self.out.line("Usage: touch file...")
+            return 1
         
         if self.vfs_path:
             # Режим VFS
             success_count = 0
             for filename in args:
-                # Нормализуем путь
-                if not filename.startswith("/"):
-                    if self.vfs_current_path == "/":
-                        full_path = "/" + filename
-                    else:
-                        full_path = self.vfs_current_path + "/" + filename
-                else:
-                    full_path = filename
-                
+                full_path = self.resolve_vfs_path(filename)
                 if self.vfs.create_file(full_path, ""):
-                    print(f"touch: created file '{filename}'")
+                    self.out.line(f"touch: created file '{filename}'")
                     success_count += 1
                 else:
-                    print(f"touch: cannot create '{filename}': File already exists or parent directory does not exist")
+                    self.out.line(f"touch: cannot create '{filename}': File already exists or parent directory does not exist")
             
             if success_count > 0:
-                print(f"touch: created {success_count} file(s)")
+                self.out.line(f"touch: created {success_count} file(s)")
+            if success_count < len(args):
+                return 1
         else:
             # Обычный режим - заглушка
-            print(f"touch: would create file(s): {', '.join(args)}")
+            self.out.line(f"touch: would create file(s): {', '.join(args)}")
+
+    def vfs_stats_command(self, args):
+        """Команда vfs-stats - статистика дедупликации тел файлов VFS"""
+        if not self.vfs_path:
+            self.out.line("vfs-stats: VFS is not loaded")
+            return 1
+        
+        self.out.line("Статистика VFS:")
+        self.out.line("=" * 30)
+        for key, value in self.vfs.stats().items():
+            if key == "dedup_ratio":
+                value = f"{value:.2f}"
+            self.out.line(f"{key}: {value}")
+        self.out.line("=" * 30)
+
+    def stats_command(self, args):
+        """Команда stats - процентили задержек команд (stats on|off|reset|--json)"""
+        action = args[0] if args else None
+        if action == "on":
+            if self.profiler is None:
+                self.profiler = CommandProfiler()
+            self.out.line("stats: profiling enabled")
+            return
+        if action == "off":
+            self.profiler = None
+            self.out.line("stats: profiling disabled")
+            return
+        if action not in (None, "reset", "--json"):
+            self.out.line(f"stats: unknown argument '{action}'")
+            self.out.line("Usage: stats [on|off|reset|--json]")
+            return 1
+        if self.profiler is None:
+            self.out.line("stats: profiling is disabled (use --profile or 'stats on')")
+            return 1
+        if action == "reset":
+            self.profiler = CommandProfiler()
+            return
+        if action == "--json":
+            self.out.line(json.dumps(self.profiler.to_dict(), indent=2))
+            return
+        
+        self.out.line(f"{'command':16} {'count':>7}   {'parse, мкс':>26}   {'handler, мкс':>26}   {'output, байт':>26}")
+        self.out.line(f"{'':16} {'':>7}   " + "   ".join(f"{'p50':>8}{'p95':>9}{'p99':>9}" for _ in range(3)))
+        for name, histograms in sorted(self.profiler.commands.items()):
+            columns = []
+            for metric, histogram in zip(CommandProfiler.METRICS, histograms):
+                scale = 1 if metric == "output" else 1e6
+                columns.append("".join(f"{histogram.percentile(percent) * scale:{8 if percent == 50 else 9}.0f}"
+                                       for percent in (50, 95, 99)))
+            self.out.line(f"{name:16} {histograms[0].count:>7}   " + "   ".join(columns))
+
+    def dump_profile(self, path):
+        """Записывает гистограммы задержек в JSON файл (--profile-output, при выходе)"""
+        if self.profiler is None or not path:
+            return
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.profiler.to_dict(), f, indent=2)
+                f.write("\n")
+        except OSError as e:
+            print(f"Предупреждение: не удалось записать профиль {path}: {e}")
+
+    def time_command(self, args):
+        """Команда time - выполняет команду (или конвейер) и выводит время её выполнения"""
+        if not args:
+            self.out.line("Usage: time command [args...]")
+            return 1
+        
+        start_times = os.times()
+        start_time = time.perf_counter()
+        status = self._dispatch(args)
+        elapsed = time.perf_counter() - start_time
+        end_times = os.times()
+        
+        self.out.line()
+        self.out.line(f"real\t{format_duration(elapsed)}")
+        self.out.line(f"user\t{format_duration(end_times.user - start_times.user)}")
+        self.out.line(f"sys\t{format_duration(end_times.system - start_times.system)}")
+        return status
+
+    def sync_command(self, args):
+        """Команда sync - уплотняет журнал изменений VFS в XML"""
+        if not self.vfs_path:
+            self.out.line("sync: VFS is not loaded")
+            return 1
+        if not self.vfs.compact():
+            self.out.line("sync: persistence is disabled (use --persist)")
+            return 1
+        self.out.line(f"sync: changes written to {self.vfs_path}")
 
     def exit_command(self, args):
         """Команда exit - завершение работы эмулятора"""
         if args:
             try:
                 exit_code = int(args[0])
-                print(f"Exiting with code: {exit_code}")
-                sys.exit(exit_code)
+                self.out.line(f"Exiting with code: {exit_code}")
             except ValueError:
-                print("exit: numeric argument required")
-                sys.exit(1)
+                self.out.line("exit: numeric argument required")
+                exit_code = 1
         else:
-            print("Exiting shell")
-            sys.exit(0)
+            self.out.line("Exiting shell")
+            exit_code = self.last_status
+        self.out.flush()
+        sys.exit(exit_code)
+
+class ShellServer:
+    """Сервер сессий: одна загруженная VFS на много клиентов через Unix сокет
+
+    Каждое подключение - отдельная сессия Shell со своей текущей
+    директорией VFS, приглашением и приёмником вывода; VFS, её кеши и
+    индексы общие. Команды выполняются в цикле событий asyncio по одной,
+    поэтому изменения VFS не пересекаются между сессиями.
+
+    Протокол: клиент посылает строку команды с '\\n'; сервер отвечает
+    заголовком "<код возврата> <длина вывода> <приглашение>\\n" и выводом
+    указанной длины. Сразу после подключения сервер присылает заголовок
+    с пустым выводом и приглашением; после exit соединение закрывается.
+    """
+
+    def __init__(self, socket_path, vfs_path, lazy_vfs=False, snapshot=True, persist=False,
+                 mounts=()):
+        self.socket_path = socket_path
+        self.vfs_path = vfs_path
+        self.vfs = VFS(vfs_path, lazy=lazy_vfs, snapshot=snapshot, persist=persist, mounts=mounts)
+        self.active_sessions = 0
+        self.total_sessions = 0
+
+    def new_session(self):
+        """Создаёт сессию Shell над общей VFS с перехватом вывода"""
+        return Shell(vfs_path=self.vfs_path, vfs=self.vfs, quiet=True,
+                     output=OutputSink(io.BytesIO()))
+
+    @staticmethod
+    def run_command(shell, command):
+        """Выполняет команду сессии: возвращает (код возврата, вывод, закрыть ли сессию)"""
+        closing = False
+        try:
+            status = shell.execute(command)
+        except SystemExit as e:
+            # exit завершает только сессию, а не сервер
+            status = e.code if isinstance(e.code, int) else 0
+            closing = True
+        shell.out.flush()
+        stream = shell.out.stream
+        data = stream.getvalue()
+        stream.seek(0)
+        stream.truncate()
+        return status, data, closing
+
+    @staticmethod
+    def frame(status, data, prompt):
+        """Ответ сервера: заголовок и вывод"""
+        return f"{status} {len(data)} {prompt}\n".encode('utf-8') + data
+
+    async def handle(self, reader, writer):
+        """Обслуживает одно подключение"""
+        shell = self.new_session()
+        self.active_sessions += 1
+        self.total_sessions += 1
+        try:
+            writer.write(self.frame(0, b"", shell.prompt))
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                status, data, closing = self.run_command(shell, line.decode('utf-8', 'replace').rstrip("\r\n"))
+                writer.write(self.frame(status, data, shell.prompt))
+                await writer.drain()
+                if closing:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.active_sessions -= 1
+            writer.close()
+
+    async def serve(self):
+        """Принимает подключения до остановки"""
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        print(f"Сервер слушает {self.socket_path} (VFS: {self.vfs_path})")
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        """Запускает сервер; Ctrl+C останавливает его и удаляет сокет"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print(f"\nСервер остановлен (сессий обслужено: {self.total_sessions})")
+        finally:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+class ShellClient:
+    """Клиент сервера сессий (--connect)"""
+
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.reader = self.sock.makefile('rb')
+        self.prompt = self._read()[2]
+
+    def _read(self):
+        """Читает ответ сервера: (код возврата, вывод, приглашение)"""
+        header = self.reader.readline()
+        if not header:
+            raise EOFError("server closed the connection")
+        status, length, prompt = header.decode('utf-8').rstrip("\n").split(" ", 2)
+        return int(status), self.reader.read(int(length)), prompt
+
+    def execute(self, command):
+        """Выполняет команду на сервере: возвращает (код возврата, вывод)"""
+        self.sock.sendall(command.encode('utf-8') + b"\n")
+        status, data, self.prompt = self._read()
+        return status, data
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def run(self):
+        """Интерактивный цикл поверх сервера; возвращает код последней команды"""
+        status = 0
+        try:
+            while True:
+                try:
+                    command = input(self.prompt)
+                except (EOFError, KeyboardInterrupt):
+                    print()
+                    break
+                status, data = self.execute(command)
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            self.close()
+        return status
+
 
 def parse_arguments():
     """Парсит аргументы командной строки"""
@@ -696,6 +4015,9 @@ def parse_arguments():
   python3 shell.py --vfs-path /path/to/vfs.xml       # С VFS
   python3 shell.py --startup-script script.txt       # Со стартовым скриптом
   python3 shell.py --vfs-path vfs.xml --startup-script script.txt  # Оба параметра
+  python3 shell.py --vfs-path vfs.xml --batch < script.txt       # Пакетный режим (CI)
+  python3 shell.py --vfs-path vfs.xml -c 'ls /'                  # Выполнить команду и выйти
+  python3 shell.py --vfs-path vfs.xml --mount ~/src:/src         # Смонтировать директорию ОС
         """
     )
     
@@ -711,6 +4033,77 @@ def parse_arguments():
         help='Путь к стартовому скрипту для выполнения команд эмулятора'
     )
     
+    parser.add_argument(
+        '--lazy-vfs',
+        action='store_true',
+        help='Разбирать поддеревья VFS только при первом обращении к ним'
+    )
+    
+    parser.add_argument(
+        '--no-snapshot',
+        action='store_true',
+        help='Не читать и не записывать бинарный снимок VFS рядом с XML'
+    )
+    
+    parser.add_argument(
+        '--persist',
+        action='store_true',
+        help='Сохранять изменения VFS: журнал изменений с периодическим уплотнением в XML'
+    )
+    
+    parser.add_argument(
+        '--mount',
+        action='append',
+        default=[],
+        metavar='HOSTDIR:VFSDIR',
+        help='Смонтировать директорию реальной ОС в VFS (можно указать несколько раз); '
+             'записи и тела файлов читаются при обращении'
+    )
+    
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='Пакетный режим: выполнить --startup-script (или stdin) без эха и баннера '
+             'и завершиться с кодом последней команды'
+    )
+    
+    parser.add_argument(
+        '-c',
+        dest='command',
+        metavar='COMMANDS',
+        help='Выполнить команды (по одной на строку) в пакетном режиме'
+    )
+    
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Собирать задержки команд (разбор, выполнение, объём вывода) для команды stats'
+    )
+    
+    parser.add_argument(
+        '--profile-output',
+        metavar='FILE',
+        help='Записать гистограммы задержек в JSON файл при выходе (включает --profile)'
+    )
+    
+    parser.add_argument(
+        '--serve',
+        metavar='SOCKET',
+        help='Режим сервера: загрузить --vfs-path один раз и обслуживать сессии через Unix сокет'
+    )
+    
+    parser.add_argument(
+        '--connect',
+        metavar='SOCKET',
+        help='Подключиться к серверу сессий и работать с ним интерактивно'
+    )
+    
+    parser.add_argument(
+        '--timing',
+        action='store_true',
+        help='Вывести время холодного старта (загрузки VFS)'
+    )
+    
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -728,10 +4121,63 @@ if __name__ == "__main__":
         print("=" * 40)
         print(f"vfs_path: {args.vfs_path}")
         print(f"startup_script: {args.startup_script}")
+        print(f"lazy_vfs: {args.lazy_vfs}")
+        print(f"no_snapshot: {args.no_snapshot}")
+        print(f"persist: {args.persist}")
+        print(f"mount: {args.mount}")
+        print(f"batch: {args.batch}")
+        print(f"command: {args.command}")
+        print(f"profile: {args.profile}")
+        print(f"profile_output: {args.profile_output}")
+        print(f"serve: {args.serve}")
+        print(f"connect: {args.connect}")
+        print(f"timing: {args.timing}")
         print(f"debug: {args.debug}")
         print("=" * 40)
         print()
     
+    if args.connect:
+        sys.exit(ShellClient(args.connect).run())
+    mounts = []
+    for spec in args.mount:
+        host_path, _, path = spec.rpartition(":")
+        if not host_path or not path.startswith("/"):
+            print(f"Ошибка: --mount ожидает HOSTDIR:/vfs/path, получено: {spec}")
+            sys.exit(1)
+        mounts.append((host_path, path))
+    if mounts and not args.vfs_path:
+        print("Ошибка: --mount требует --vfs-path")
+        sys.exit(1)
+    if args.serve:
+        if not args.vfs_path:
+            print("Ошибка: режим сервера требует --vfs-path")
+            sys.exit(1)
+        ShellServer(args.serve, args.vfs_path, lazy_vfs=args.lazy_vfs,
+                    snapshot=not args.no_snapshot, persist=args.persist, mounts=mounts).run()
+        sys.exit(0)
+    
     # Создание и запуск эмулятора
-    shell = Shell(vfs_path=args.vfs_path, startup_script=args.startup_script)
-    shell.run()
+    batch = args.batch or args.command is not None
+    start_time = time.perf_counter()
+    shell = Shell(vfs_path=args.vfs_path, startup_script=args.startup_script,
+                  lazy_vfs=args.lazy_vfs, snapshot=not args.no_snapshot,
+                  persist=args.persist, quiet=batch, mounts=mounts,
+                  profile=args.profile or args.profile_output is not None)
+    if args.timing:
+        shell.print_timing(time.perf_counter() - start_time)
+    
+    try:
+        if args.command is not None:
+            sys.exit(shell.run_batch(args.command.splitlines()))
+        if args.batch:
+            if args.startup_script:
+                if not os.path.exists(args.startup_script):
+                    print(f"Ошибка: стартовый скрипт не найден: {args.startup_script}")
+                    sys.exit(1)
+                with open(args.startup_script, 'r', encoding='utf-8') as script:
+                    sys.exit(shell.run_batch(script))
+            sys.exit(shell.run_batch(sys.stdin))
+        shell.run()
+    finally:
+        # Профиль пишется при любом выходе, в том числе по команде exit
+        shell.dump_profile(args.profile_output)